@@ -1,73 +1,343 @@
+import time
+from datetime import datetime
+
 import chainlit as cl
-import chainlit.data as cl_data
-from chainlit.data.sql_alchemy import SQLAlchemyDataLayer
-from chainlit.data.storage_clients.azure_blob import AzureBlobStorageClient
-from openai import AsyncAzureOpenAI
-from settings import Config, chat_settings
-
-# モンキーパッチの適用
-from azure.storage.blob.aio import BlobServiceClient
-original_from_connection_string = BlobServiceClient.from_connection_string
-
-def patched_from_connection_string(connection_string, **kwargs):
-    # Azuriteエミュレーター向けに接続文字列を変更
-    if "devstoreaccount1" in connection_string:
-        # ここでHTTPSからHTTPに変更
-        connection_string = connection_string.replace("DefaultEndpointsProtocol=https", "DefaultEndpointsProtocol=http")
-        # エンドポイントを追加
-        if "EndpointSuffix" in connection_string:
-            connection_string = connection_string.replace("EndpointSuffix=core.windows.net", "BlobEndpoint=http://azurite:10000/devstoreaccount1")
-        else:
-            connection_string += ";BlobEndpoint=http://azurite:10000/devstoreaccount1"
+from chainlit.data.acl import is_thread_author
+from chainlit.server import UserParam, sio
+from chainlit.session import ws_sessions_id
+from chainlit.types import ThreadDict
+from fastapi import Depends, HTTPException
+from fastapi.responses import PlainTextResponse
+import metrics
+import warmup
+from conversation import ConversationContext, count_tokens
+from lazy import Lazy
+from rollups import query_rollups
+from routes import add_route, require_metrics_token
+from settings import Config, chat_settings, pool_stats
+from streaming import StreamStats, TokenCoalescer, cancel_on_disconnect, cancel_reason, record_cancelled, relay_until_cancelled
+from tracing import configure_tracing, shutdown_tracing, span
+from usage import GenerationMessage, UsageRecorder, build_generation
+
+# OpenAI・Azure Storage の SDK と SQLAlchemy の読み込み、クライアントの作成は最初に使う時まで遅らせる
+# （ウォームアップが有効なら起動フックで作成し、リクエストの受け付け前に接続まで済ませる）
+
+def create_openai_router():
+    # デプロイメントごとにクライアントを作成し、負荷と応答速度で振り分ける
+    from openai_router import DeploymentRouter
+    return DeploymentRouter.from_config()
+
+def create_openai_scheduler():
+    from scheduler import RequestScheduler
+    return RequestScheduler()
+
+def create_storage_client():
+    from blob_storage import BlobStorageClient
+    return BlobStorageClient(
+        container_name=Config.BLOB_CONTAINER_NAME,
+        storage_account=Config.AZURE_STORAGE_ACCOUNT,
+        storage_key=Config.AZURE_STORAGE_KEY,
+    )
+
+def create_data_layer():
+    from data_layer import DataLayer
+    return DataLayer(storage_provider=storage_client())
+
+def create_completion_cache():
+    from completion_cache import CompletionCache
+    return CompletionCache()
+
+def create_retention_job():
+    from retention import RetentionJob
+    return RetentionJob(storage_client())
+
+def install_socketio_adapter():
+    # ワーカー間の配信を設定した場合（複数ワーカーなど）のみ asyncpg・pub/sub のマネージャーを読み込む
+    if not Config.SOCKETIO_ADAPTER:
+        return False
+    from socketio_adapter import install_client_manager
+    return install_client_manager(sio)
+
+def create_session_store():
+    # 複数ワーカーで起動した場合も、会話履歴をワーカー間で共有する
+    from session_store import create_session_store
+    return create_session_store()
+
+openai_router = Lazy(create_openai_router)
+openai_scheduler = Lazy(create_openai_scheduler)
+storage_client = Lazy(create_storage_client)
+data_layer = Lazy(create_data_layer)
+completion_cache = Lazy(create_completion_cache)
+retention_job = Lazy(create_retention_job)
+session_store = Lazy(create_session_store)
+usage_recorder = UsageRecorder()
+
+# Chainlit も最初にデータレイヤーを使う時に作成する
+cl.data_layer(data_layer)
+
+# socket.io の配信先は最初の接続より前に差し替える必要があるため import 時に設定する
+install_socketio_adapter()
+
+async def prometheus_metrics():
+    """全メトリクスを Prometheus のテキスト形式で返すエンドポイント"""
+    return PlainTextResponse(metrics.render_prometheus(), media_type=metrics.CONTENT_TYPE)
+
+metrics.gauge(
+    "process_resident_memory_bytes",
+    "Resident memory of the server process",
+).set_function(metrics.resident_memory_bytes)
+metrics.gauge(
+    "chainlit_websocket_sessions",
+    "Websocket sessions currently held by this process",
+).set_function(lambda: len(ws_sessions_id))
+
+add_route("/metrics", prometheus_metrics, methods=["GET"], dependencies=[Depends(require_metrics_token)])
+
+async def db_pool_metrics():
+    """DB コネクションプールの利用状況を返すエンドポイント"""
+    return pool_stats()
+
+add_route("/metrics/db-pool", db_pool_metrics, methods=["GET"], dependencies=[Depends(require_metrics_token)])
+
+async def startup_metrics():
+    """起動からウォームアップ完了・最初のトークンまでの秒数を返すエンドポイント"""
+    return warmup.startup_timings()
+
+add_route("/metrics/startup", startup_metrics, methods=["GET"], dependencies=[Depends(require_metrics_token)])
+
+async def thread_steps(thread_id: str, current_user: UserParam, before: str | None = None, limit: int | None = None):
+    """再開時に読み込まなかった古いステップを before より前からページごとに返すエンドポイント"""
+    await is_thread_author(current_user.identifier, thread_id)
+    return await data_layer().get_thread_steps(thread_id, before=before, limit=limit and min(limit, Config.THREAD_STEPS_PAGE_SIZE))
+
+add_route("/project/thread/{thread_id}/steps", thread_steps, methods=["GET"])
 
-    return original_from_connection_string(connection_string, **kwargs)
+async def thread_search(current_user: UserParam, q: str, cursor: str | None = None, limit: int | None = None):
+    """ログイン中のユーザーのスレッドを名前とメッセージの本文から検索し、関連度の高い順にページごとに返すエンドポイント"""
+    return await data_layer().search_threads(current_user.identifier, q, cursor=cursor, limit=limit and min(limit, Config.SEARCH_PAGE_SIZE))
 
-# モンキーパッチ適用
-BlobServiceClient.from_connection_string = patched_from_connection_string
+add_route("/project/search", thread_search, methods=["GET"])
 
-# OpenAI クライアントの初期化
-async_openai_client = AsyncAzureOpenAI(
-    api_key=Config.OPENAI_API_KEY,
-    azure_endpoint=Config.AZURE_OPENAI_ENDPOINT,
-    api_version=Config.OPENAI_API_VERSION,
-)
+async def response_rollups(
+    current_user: UserParam,
+    grain: str = "day",
+    start: datetime | None = None,
+    end: datetime | None = None,
+    user: str | None = None,
+    model: str | None = None,
+    group_by: str = "model",
+):
+    """応答の使用量と 👍 の割合を時間・日ごとに返すエンドポイント（管理者以外は自分の分のみ）"""
+    if current_user.metadata.get("role") != "admin":
+        user = current_user.identifier
+    try:
+        return await query_rollups(grain, start, end, user=user, model=model, group_by=[c for c in group_by.split(",") if c])
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
-storage_client = AzureBlobStorageClient(
-    container_name=Config.BLOB_CONTAINER_NAME,
-    storage_account=Config.AZURE_STORAGE_ACCOUNT,
-    storage_key=Config.AZURE_STORAGE_KEY,
-)
-cl_data._data_layer = SQLAlchemyDataLayer(conninfo=Config.ASYNC_DATABASE_URL, storage_provider=storage_client)
+add_route("/project/rollups", response_rollups, methods=["GET"])
+
+SYSTEM_PROMPT = "あなたは親切なAIアシスタントです。"
+
+def new_message_history() -> ConversationContext:
+    # 古いターンの本文は保存済みの steps から必要な時だけ読み戻す
+    return ConversationContext(SYSTEM_PROMPT, loader=data_layer().get_step_outputs)
+
+def history_key() -> str:
+    # 再接続時も同じセッション ID が使われるため、別のワーカーに振り分けられても同じ履歴を参照できる
+    return f"history:{cl.context.session.id}"
+
+async def load_message_history() -> ConversationContext:
+    """
+    このワーカーが保持している会話履歴を返す。無い場合（別のワーカーからの再接続など）だけ
+    セッションストアから読み込む（保存されていなければ空の履歴）
+    """
+    if (message_history := cl.user_session.get("message_history")) is not None:
+        return message_history
+    if (state := await session_store().get(history_key())) is None:
+        message_history = new_message_history()
+    else:
+        message_history = ConversationContext.from_state(SYSTEM_PROMPT, state, loader=data_layer().get_step_outputs)
+    cl.user_session.set("message_history", message_history)
+    return message_history
+
+async def has_message_history() -> bool:
+    return cl.user_session.get("message_history") is not None or await session_store().get(history_key()) is not None
+
+def session_cleared() -> bool:
+    """新しいチャットへの切り替えなどで終了したセッションなら True（to_clear は websocket のセッションだけが持つ）"""
+    return getattr(cl.context.session, "to_clear", False)
+
+def save_message_history(message_history: ConversationContext) -> None:
+    """このワーカーの会話履歴を更新し、セッションストアへの書き込みは待たずにバックグラウンドで反映する"""
+    if session_cleared():
+        # 終了したセッション（取り消された応答の保存など）の履歴は残さない
+        return
+    cl.user_session.set("message_history", message_history)
+    session_store().set_later(history_key(), message_history.to_state())
+
+def scheduler_key() -> str:
+    """公平にキューイングするためのユーザー単位のキー"""
+    if user := cl.user_session.get("user"):
+        return user.identifier
+    return cl.context.session.id
 
 @cl.on_chat_start
 async def start():
     """チャットセッション開始時に実行される関数"""
-    cl.user_session.set(
-        "message_history",
-        [{"role": "system", "content": "あなたは親切なAIアシスタントです。"}]
-    )
+    # threadId の無い再接続が別のワーカーに振り分けられた場合も呼ばれるため、保存済みの履歴は上書きしない
+    if await has_message_history():
+        return
+    save_message_history(new_message_history())
     await cl.Message(content="こんにちは！何かお手伝いできることはありますか？").send()
 
+@cl.on_chat_resume
+async def resume(thread: ThreadDict):
+    """過去のスレッドを再開した時に、取得済みのステップから会話履歴を組み立てる"""
+    # 別のワーカーへの再接続では保存済みの履歴を使う（ステップの書き込みが未反映の場合がある）
+    # 切断したワーカーが後で on_chat_end を呼ぶため、新しいチャットへの切り替え以外では履歴を削除せずに SESSION_STORE_TTL で失効させる
+    if await has_message_history():
+        return
+    message_history = new_message_history()
+    message_history.extend_steps(thread["steps"])
+    save_message_history(message_history)
+
+@cl.on_chat_end
+async def end():
+    """チャットセッション終了時に未反映の書き込みをデータベースに反映する"""
+    # 再接続しないまま STREAM_DISCONNECT_GRACE 秒経過したら、実行中の応答のストリームを閉じる
+    cancel_on_disconnect(cl.context.session)
+    await data_layer().flush()
+    if session_cleared():
+        # 新しいチャットへの切り替え（開いているスレッドの削除を含む）ではセッションが終了するため履歴を削除する
+        await session_store().delete(history_key())
+        return
+    # 別のワーカーに再接続した場合も最新の履歴を読めるよう反映し、
+    # このワーカーに戻ってきた場合は保存先から読み直す（別のワーカーで続けた会話を取り込む）
+    await session_store().flush()
+    cl.user_session.set("message_history", None)
+
+@cl.on_app_startup
+async def startup():
+    """DB・OpenAI・Blob への接続を確立してからリクエストの受け付けを開始する"""
+    configure_tracing()
+    if Config.WARMUP_ENABLED:
+        await warmup.warm_up(router=openai_router(), storage_client=storage_client())
+    else:
+        # ウォームアップしない場合、クライアントは最初のリクエストで作成する
+        await warmup.warm_up()
+    if Config.RETENTION_ENABLED:
+        retention_job().start()
+
+@cl.on_app_shutdown
+async def shutdown():
+    """サーバー停止時に未反映の書き込みを反映してから終了する（作成していないクライアントは何もしない）"""
+    if (job := retention_job.peek()) is not None:
+        await job.close()
+    await usage_recorder.close()
+    if (layer := data_layer.peek()) is not None:
+        await layer.close()
+    if (client := storage_client.peek()) is not None:
+        await client.close()
+    if (store := session_store.peek()) is not None:
+        await store.close()
+    if openai_router.peek() is not None:
+        from transport import close_transports
+        await close_transports()
+    shutdown_tracing()
+
 @cl.on_message
 async def main(message: cl.Message):
     """ユーザーメッセージを受け取った時に実行される関数"""
-    message_history = cl.user_session.get("message_history")
-    message_history.append({"role": "user", "content": message.content})
+    with span("chat.message"):
+        await reply(message)
 
-    msg = cl.Message(content="")
+async def reply(message: cl.Message):
+    """会話履歴に追加して応答をストリーミングし、履歴とキャッシュに保存する"""
+    if not await usage_recorder.check_quota(scheduler_key()):
+        await cl.Message(content="本日のトークン使用量の上限に達しました。明日以降に再度お試しください。").send()
+        return
 
-    stream = await async_openai_client.chat.completions.create(
-        messages=message_history,
-        **chat_settings()
-    )
+    message_history = await load_message_history()
+    message_history.append("user", message.content, step_id=message.id)
+
+    msg = GenerationMessage(content="")
+    settings = chat_settings()
+    with span("chat.load_history"):
+        messages = await message_history.load_messages()
+    with span("chat.cache_lookup"):
+        cached = await completion_cache().get(messages, settings)
+    tokens = []
+    finish_reason = None
+    cancelled = None
+    stats = StreamStats()
 
-    async for part in stream:
-        if part.choices and len(part.choices) > 0:
-            if token := part.choices[0].delta.content or "":
-                await msg.stream_token(token)
+    # 差分トークンをまとめて送信し、emit 回数を抑える（終了時に残りを送信）
+    async with TokenCoalescer(msg, stats=stats) as coalescer:
+        if cached is not None:
+            # キャッシュヒット時も通常の応答と同じ経路でトークンを送信する
+            for token in cached:
+                await coalescer.add(token)
+        else:
+            # 推定トークン数（プロンプト + 最大出力）で枠を確保し、ストリーム終了まで保持する
+            cost = message_history.token_count + settings["max_tokens"]
+            async with openai_scheduler().slot(scheduler_key(), cost):
+                # 最初のトークンを受け取るまでに失敗した場合は別のデプロイメントに切り替える
+                started = time.perf_counter()
+                with span("openai.first_token"):
+                    stream = await openai_scheduler().call(lambda: openai_router().stream(messages, settings, cost))
+                ttft = time.perf_counter() - started
+                warmup.record_first_token()
+                # 停止ボタン・切断では続きを読まずにレスポンスを閉じ、受け取った分を応答として保存する
+                with span("openai.stream", deployment=stream.deployment.name):
+                    finish_reason, cancelled = await relay_until_cancelled(stream, coalescer, tokens, stats)
+                duration = time.perf_counter() - started
 
-    message_history.append({"role": "assistant", "content": msg.content})
-    await msg.update()
+    if cached is None:
+        # 使用量の概算にはバッファに残っていた分を含めた本文を使う
+        record_usage(
+            msg, stream.deployment, settings, stats, message_history.token_count, ttft, duration,
+            cancelled=cancel_reason(cancelled) if cancelled else None,
+        )
+    message_history.append("assistant", msg.content, step_id=msg.id)
+    save_message_history(message_history)
+    with span("chat.persist"):
+        await msg.update()
+
+    if cancelled is not None:
+        record_cancelled(cancel_reason(cancelled), settings["max_tokens"], msg.generation["outputTokenCount"])
+        raise cancelled
+    if finish_reason == "stop":
+        await completion_cache().set(messages, settings, tokens)
+
+def record_usage(
+    msg: GenerationMessage,
+    deployment,
+    settings: dict,
+    stats: StreamStats,
+    prompt_estimate: int,
+    ttft: float,
+    duration: float,
+    cancelled: str | None = None,
+) -> None:
+    """応答の使用量をステップの generation に設定し、ユーザー・日ごとの合計に加算する（cancelled は取り消しの理由）"""
+    if usage := stats.usage:
+        prompt_tokens, completion_tokens = usage.prompt_tokens, usage.completion_tokens
+    else:
+        # 使用量が返らない場合（ストリームの途中終了など）は手元の概算値で記録する
+        prompt_tokens, completion_tokens = prompt_estimate, count_tokens(msg.content)
+    msg.generation = build_generation(
+        deployment.model,
+        settings,
+        prompt_tokens,
+        completion_tokens,
+        ttft,
+        duration,
+        estimated=usage is None,
+        deployment=deployment.name,
+        **({"cancelled": cancelled} if cancelled else {}),
+    )
+    usage_recorder.record(scheduler_key(), prompt_tokens, completion_tokens, ttft, duration)
 
 @cl.password_auth_callback
 def auth_callback(username: str, password: str) -> bool:
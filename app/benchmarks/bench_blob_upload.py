@@ -0,0 +1,129 @@
+"""
+添付ファイルのアップロード・ダウンロードを Azurite で計測します。
+ファイル全体を読み込んで 1 回で送る従来の方法と、ブロック単位の並列アップロード・
+範囲読み込みを比較し、ファイルサイズごとのピークメモリ（tracemalloc）とスループットを表示します。
+
+    cd app && python -m benchmarks.bench_blob_upload --sizes-mb 1,16,64,256
+"""
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+import tracemalloc
+import uuid
+
+from azure.core.exceptions import ResourceExistsError
+from azure.storage.blob.aio import BlobServiceClient
+from chainlit.data.storage_clients.azure_blob import AzureBlobStorageClient
+
+from benchmarks.common import print_table, write_json
+from blob_storage import BlobStorageClient
+from settings import Config
+
+AZURITE_ACCOUNT = "devstoreaccount1"
+AZURITE_KEY = "Eby8vdM02xNOcqFlqUwJPLlmEtlCDXJ1OUzFT50uSRZ6IFsuFq2UVErCz4I6tq/K1SZFPTOtr/KBHBeksoGMGw=="
+
+
+def use_endpoint(endpoint: str) -> None:
+    """接続文字列の向き先を Azurite に差し替えます（比較用の Chainlit のクライアントはパッチで差し替える）"""
+    Config.AZURITE_BLOB_ENDPOINT = endpoint
+    original = BlobServiceClient.from_connection_string
+
+    def patched(connection_string, **kwargs):
+        connection_string = connection_string.replace("DefaultEndpointsProtocol=https", "DefaultEndpointsProtocol=http")
+        connection_string = connection_string.replace("EndpointSuffix=core.windows.net", f"BlobEndpoint={endpoint}")
+        return original(connection_string, **kwargs)
+
+    BlobServiceClient.from_connection_string = patched
+
+
+def make_file(directory: str, size: int) -> str:
+    path = os.path.join(directory, f"bench-{size}.bin")
+    with open(path, "wb") as f:
+        remaining = size
+        while remaining:
+            chunk = os.urandom(min(remaining, 1024 * 1024))
+            f.write(chunk)
+            remaining -= len(chunk)
+    return path
+
+
+async def measure(fn) -> tuple[float, int]:
+    """fn() の所要時間と、その間に確保されたメモリのピークを返します"""
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    started = time.perf_counter()
+    try:
+        await fn()
+        return time.perf_counter() - started, tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Blob アップロード・ダウンロードのベンチマーク")
+    parser.add_argument("--sizes-mb", default="1,16,64,256", help="ファイルサイズ（MB、カンマ区切り）")
+    parser.add_argument("--endpoint", default=os.getenv("AZURITE_BLOB_ENDPOINT", "http://azurite:10000/devstoreaccount1"))
+    parser.add_argument("--container", default="bench-uploads")
+    parser.add_argument("--output", help="結果を保存する JSON ファイル")
+    args = parser.parse_args()
+
+    use_endpoint(args.endpoint)
+    baseline = AzureBlobStorageClient(args.container, AZURITE_ACCOUNT, AZURITE_KEY)
+    blocked = BlobStorageClient(args.container, AZURITE_ACCOUNT, AZURITE_KEY)
+    try:
+        await blocked.container_client.create_container()
+    except ResourceExistsError:
+        pass
+
+    rows = []
+    with tempfile.TemporaryDirectory() as directory:
+        try:
+            for size_mb in (int(s) for s in args.sizes_mb.split(",")):
+                size = size_mb * 1024 * 1024
+                path = make_file(directory, size)
+                key = f"bench/{uuid.uuid4()}/file.bin"
+
+                async def buffered_upload():
+                    with open(path, "rb") as f:
+                        await baseline.upload_file(key, f.read())
+
+                async def buffered_download():
+                    blob = baseline.container_client.get_blob_client(key)
+                    await (await blob.download_blob()).readall()
+
+                async def block_upload():
+                    await blocked.upload_path(key, path)
+
+                async def ranged_download():
+                    async for _ in blocked.download_stream(key):
+                        pass
+
+                for method, fn in (
+                    ("buffered_upload", buffered_upload),
+                    ("block_upload", block_upload),
+                    ("buffered_download", buffered_download),
+                    ("ranged_download", ranged_download),
+                ):
+                    elapsed, peak = await measure(fn)
+                    rows.append({
+                        "size_mb": size_mb,
+                        "method": method,
+                        "seconds": elapsed,
+                        "mb_per_s": size_mb / elapsed,
+                        "peak_mb": peak / 1024 / 1024,
+                    })
+                await blocked.delete_file(key)
+                os.remove(path)
+        finally:
+            await baseline.service_client.close()
+            await blocked.close()
+
+    print_table(rows)
+    if args.output:
+        write_json(args.output, rows)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
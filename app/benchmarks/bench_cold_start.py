@@ -0,0 +1,91 @@
+"""
+コールドスタートから最初のトークンまでの時間を、ウォームアップの有無で比較します。
+偽の OpenAI サーバーを起動し、子プロセスで app.py の読み込み → 起動フック → 最初の応答を計測します。
+DB や Azurite に接続できない場合も、該当するウォームアップは失敗扱いで計測を続けます。
+
+    cd app && python -m benchmarks.bench_cold_start --runs 3
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+
+from benchmarks.common import print_table, write_json
+from benchmarks.fake_openai import create_app, start_server
+
+
+async def child() -> None:
+    spawned_at = float(os.environ["BENCH_SPAWNED_AT"])
+    import_started = time.time()
+    import app
+    from settings import chat_settings
+
+    imported = time.time()
+    await app.startup()
+    ready = time.time()
+    request_started = time.perf_counter()
+    stream = await app.openai_router().stream([{"role": "user", "content": "こんにちは"}], chat_settings(), cost=100)
+    first_token = time.time()
+    ttft = time.perf_counter() - request_started
+    await stream.close()
+    await app.shutdown()
+    print(json.dumps({
+        "interpreter_s": import_started - spawned_at,
+        "import_s": imported - import_started,
+        "startup_hook_s": ready - imported,
+        "ready_s": ready - spawned_at,
+        "first_request_ttft_ms": ttft * 1000,
+        "cold_start_to_first_token_s": first_token - spawned_at,
+    }))
+
+
+async def run_child(endpoint: str, warm: bool) -> dict:
+    env = {
+        **os.environ,
+        "AZURE_OPENAI_ENDPOINT": endpoint,
+        "AZURE_OPENAI_DEPLOYMENTS": "",
+        "OPENAI_API_KEY": "fake",
+        "OPENAI_API_VERSION": os.getenv("OPENAI_API_VERSION") or "2024-02-01",
+        "WARMUP_ENABLED": "true" if warm else "false",
+        "BENCH_SPAWNED_AT": str(time.time()),
+    }
+    process = await asyncio.create_subprocess_exec(
+        sys.executable, "-m", "benchmarks.bench_cold_start", "--child",
+        env=env,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.DEVNULL,
+    )
+    stdout, _ = await process.communicate()
+    if process.returncode != 0:
+        raise SystemExit("子プロセスの計測に失敗しました")
+    return json.loads(stdout.decode().strip().splitlines()[-1])
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="コールドスタートのベンチマーク")
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--ttft", type=float, default=0.1, help="偽サーバーの TTFT")
+    parser.add_argument("--output", help="結果を保存する JSON ファイル")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        await child()
+        return
+
+    runner, endpoint = await start_server(create_app(ttft=args.ttft))
+    rows = []
+    try:
+        for warm in (False, True):
+            for _ in range(args.runs):
+                rows.append({"warmup": warm, **await run_child(endpoint, warm)})
+    finally:
+        await runner.cleanup()
+    print_table(rows)
+    if args.output:
+        write_json(args.output, rows)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,101 @@
+"""
+セッションごとの会話履歴のメモリ使用量を計測します。
+従来の dict のリストと ConversationContext（直近のみ本文を保持）を、ターン数ごとに比較します。
+セッションストアに保持される to_state() の状態（memory では SESSION_STORE_MEMORY_SIZE 件までプロセス内に残る）と、
+別のワーカーで from_state() から復元した履歴のメモリも計測します。
+
+    cd app && python -m benchmarks.bench_history_memory --sessions 200
+"""
+import argparse
+import random
+import tracemalloc
+import uuid
+
+from benchmarks.common import print_table, write_json
+from conversation import ConversationContext
+
+SYSTEM_PROMPT = "あなたは親切なAIアシスタントです。"
+SAMPLE_TEXT = "Azure OpenAI と Chainlit を使ったチャットアプリケーションの構成について質問があります。"
+
+
+async def _never_called(step_ids):
+    raise AssertionError("計測中は読み戻さない")
+
+
+def make_turns(n_turns: int, rng: random.Random) -> list[tuple[str, int, str]]:
+    """(role, 本文の長さ, ステップ ID) のリストを作ります。本文は履歴に追加する直前に作ります"""
+    return [("user" if i % 2 == 0 else "assistant", rng.randint(1, 6), str(uuid.uuid4())) for i in range(n_turns)]
+
+
+def render(repeat: int, i: int) -> str:
+    # 実際の入力と同様に、毎回別の文字列オブジェクトにする
+    return SAMPLE_TEXT * repeat + f" ({i})"
+
+
+def build_list(turns) -> list[dict]:
+    history = [{"role": "system", "content": SYSTEM_PROMPT}]
+    for i, (role, repeat, _) in enumerate(turns):
+        history.append({"role": role, "content": render(repeat, i)})
+    return history
+
+
+def build_context(turns, budget: int) -> ConversationContext:
+    context = ConversationContext(SYSTEM_PROMPT, budget=budget, loader=_never_called)
+    for i, (role, repeat, step_id) in enumerate(turns):
+        context.append(role, render(repeat, i), step_id=step_id)
+    return context
+
+
+def build_state(turns, budget: int) -> dict:
+    return build_context(turns, budget).to_state()
+
+
+def restore_context(turns, budget: int) -> ConversationContext:
+    return ConversationContext.from_state(SYSTEM_PROMPT, build_state(turns, budget), loader=_never_called)
+
+
+def measure(build, inputs: list) -> int:
+    """inputs の各要素から履歴を作り、保持されたメモリのセッションあたりの平均バイト数を返します"""
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    sessions = [build(turns) for turns in inputs]
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del sessions
+    return (after - before) // len(inputs)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="会話履歴のメモリベンチマーク")
+    parser.add_argument("--sessions", type=int, default=200)
+    parser.add_argument("--turns", default="10,100,1000")
+    parser.add_argument("--budget", type=int, default=10**9, help="トークン予算（既定では削除しない）")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", help="結果を保存する JSON ファイル")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    # トークナイザーの読み込みを計測に含めない
+    build_context(make_turns(2, rng), args.budget)
+    rows = []
+    for n_turns in (int(t) for t in args.turns.split(",")):
+        inputs = [make_turns(n_turns, rng) for _ in range(args.sessions)]
+        list_bytes = measure(build_list, inputs)
+        context_bytes = measure(lambda turns: build_context(turns, args.budget), inputs)
+        state_bytes = measure(lambda turns: build_state(turns, args.budget), inputs)
+        restored_bytes = measure(lambda turns: restore_context(turns, args.budget), inputs)
+        rows.append({
+            "turns": n_turns,
+            "list_of_dicts_bytes": list_bytes,
+            "compact_bytes": context_bytes,
+            "ratio": list_bytes / max(context_bytes, 1),
+            "state_bytes": state_bytes,
+            "restored_bytes": restored_bytes,
+        })
+    print_table(rows)
+    if args.output:
+        write_json(args.output, rows)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+"""
+チャットのストリーム処理に計装（span とチャンクごとのヒストグラム）を入れた場合の
+オーバーヘッドを計測します。AsyncAzureOpenAI が SSE を解析する処理も含めるため、
+httpx の MockTransport で用意した応答を実際のクライアントで読み込みます。
+
+    cd app && python -m benchmarks.bench_instrumentation --tokens 500 --rounds 10
+"""
+import argparse
+import asyncio
+import statistics
+import time
+
+import httpx
+from openai import AsyncAzureOpenAI
+
+from benchmarks.bench_streaming import FakeMessage
+from benchmarks.common import print_table, write_json
+from benchmarks.fake_openai import SAMPLE_TEXT, make_chunk, split_tokens
+from streaming import StreamStats, TokenCoalescer, relay_stream
+from tracing import span
+
+
+def make_body(n_tokens: int) -> bytes:
+    """n_tokens 個の差分と終了チャンクからなる SSE の本文を作ります"""
+    completion_id = "chatcmpl-bench"
+    chunks = [make_chunk(token, completion_id=completion_id) for token in split_tokens(SAMPLE_TEXT, n_tokens)]
+    chunks.append(make_chunk(None, finish_reason="stop", completion_id=completion_id))
+    lines = [f"data: {chunk.model_dump_json(exclude_unset=True)}\n\n" for chunk in chunks]
+    return ("".join(lines) + "data: [DONE]\n\n").encode()
+
+
+def make_client(body: bytes) -> AsyncAzureOpenAI:
+    async def handler(request: httpx.Request) -> httpx.Response:
+        return httpx.Response(200, headers={"content-type": "text/event-stream"}, content=body)
+
+    return AsyncAzureOpenAI(
+        api_key="bench",
+        api_version="2024-06-01",
+        azure_endpoint="http://bench.invalid",
+        http_client=httpx.AsyncClient(transport=httpx.MockTransport(handler)),
+    )
+
+
+async def run_stream(client: AsyncAzureOpenAI, instrumented: bool) -> int:
+    """app.main と同じ経路で 1 本のストリームを処理し、チャンク数を返します"""
+    stats = StreamStats() if instrumented else None
+    tokens = []
+    msg = FakeMessage(emit_cost_us=0)
+    async with TokenCoalescer(msg, stats=stats) as coalescer:
+        stream = await client.chat.completions.create(
+            model="bench", messages=[{"role": "user", "content": "bench"}], stream=True
+        )
+        if instrumented:
+            with span("openai.stream"):
+                await relay_stream(stream, coalescer, tokens, stats)
+        else:
+            await relay_stream(stream, coalescer, tokens)
+    return len(tokens) + 1
+
+
+async def measure(client: AsyncAzureOpenAI, instrumented: bool, streams: int) -> float:
+    """streams 本を順に処理し、チャンクあたりの CPU 時間（マイクロ秒）を返します"""
+    chunks = 0
+    started = time.process_time()
+    for _ in range(streams):
+        chunks += await run_stream(client, instrumented)
+    return (time.process_time() - started) / chunks * 1_000_000
+
+
+def measure_hook(iterations: int) -> float:
+    """チャンクごとに追加される処理（StreamStats.chunk）単体のコスト（マイクロ秒）"""
+    stats = StreamStats()
+    started = time.process_time()
+    for _ in range(iterations):
+        stats.chunk()
+    return (time.process_time() - started) / iterations * 1_000_000
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="計装のオーバーヘッドのベンチマーク")
+    parser.add_argument("--tokens", type=int, default=500, help="1 ストリームあたりのトークン数")
+    parser.add_argument("--streams", type=int, default=10, help="1 ラウンドあたりのストリーム数")
+    parser.add_argument("--rounds", type=int, default=10, help="計装あり・なしを交互に計測する回数")
+    parser.add_argument("--output", help="結果を保存する JSON ファイル")
+    args = parser.parse_args()
+
+    client = make_client(make_body(args.tokens))
+    # 初回のみの import やクライアントの初期化を計測に含めない
+    await measure(client, True, 2)
+    await measure(client, False, 2)
+
+    baseline, instrumented = [], []
+    for _ in range(args.rounds):
+        baseline.append(await measure(client, False, args.streams))
+        instrumented.append(await measure(client, True, args.streams))
+    await client.close()
+
+    baseline_us = statistics.median(baseline)
+    instrumented_us = statistics.median(instrumented)
+    hook_us = measure_hook(1_000_000)
+    rows = [
+        {"variant": "baseline", "us_per_chunk": baseline_us, "overhead_pct": 0.0},
+        {
+            "variant": "instrumented",
+            "us_per_chunk": instrumented_us,
+            "overhead_pct": (instrumented_us - baseline_us) / baseline_us * 100,
+        },
+        # ラウンド間のばらつきに左右されない、チャンクごとの追加処理の上限
+        {"variant": "per_chunk_hook", "us_per_chunk": hook_us, "overhead_pct": hook_us / baseline_us * 100},
+    ]
+    print_table(rows)
+    if args.output:
+        write_json(args.output, rows)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,94 @@
+"""
+複数デプロイメントへのルーティングとフェイルオーバーを偽サーバーで確認します。
+レイテンシの異なる偽サーバーを起動し、途中で 1 台を障害状態にして振り分け結果を集計します。
+
+    cd app && python -m benchmarks.bench_routing --requests 300 --concurrency 20
+"""
+import argparse
+import asyncio
+import time
+from collections import Counter
+
+from openai import AsyncAzureOpenAI
+
+from benchmarks.common import percentile, print_table, write_json
+from benchmarks.fake_openai import create_app, start_server
+from openai_router import Deployment, DeploymentRouter
+
+MESSAGES = [{"role": "user", "content": "こんにちは"}]
+SETTINGS = {"max_tokens": 50, "stream": True}
+
+
+async def run_request(router: DeploymentRouter, results: list[dict]) -> None:
+    started = time.perf_counter()
+    try:
+        stream = await router.stream(MESSAGES, SETTINGS, cost=100)
+    except Exception as e:
+        results.append({"deployment": None, "error": type(e).__name__})
+        return
+    ttft = time.perf_counter() - started
+    async for _ in stream:
+        pass
+    results.append({"deployment": stream.deployment.name, "ttft": ttft, "total": time.perf_counter() - started})
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="デプロイメントルーティングのベンチマーク")
+    parser.add_argument("--requests", type=int, default=300)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--ttfts", default="0.05,0.1,0.3", help="各偽サーバーの TTFT（カンマ区切り）")
+    parser.add_argument("--tps", type=float, default=200.0)
+    parser.add_argument("--fail-after", type=float, default=0.3, help="この割合のリクエスト後に先頭のサーバーを障害状態にする")
+    parser.add_argument("--output", help="結果を保存する JSON ファイル")
+    args = parser.parse_args()
+
+    apps, runners, deployments = [], [], []
+    for i, ttft in enumerate(float(t) for t in args.ttfts.split(",")):
+        app = create_app(ttft=ttft, tokens_per_second=args.tps, seed=i)
+        runner, endpoint = await start_server(app)
+        client = AsyncAzureOpenAI(api_key="fake", azure_endpoint=endpoint, api_version="2024-02-01", max_retries=0)
+        apps.append(app)
+        runners.append(runner)
+        deployments.append(Deployment(f"fake-{i}", client, "gpt-35-turbo"))
+    router = DeploymentRouter(deployments)
+
+    results: list[dict] = []
+    semaphore = asyncio.Semaphore(args.concurrency)
+    fail_at = int(args.requests * args.fail_after)
+
+    async def worker(n: int):
+        async with semaphore:
+            if n == fail_at:
+                apps[0]["faults"]["error_rate"] = 1.0
+            await run_request(router, results)
+
+    started = time.perf_counter()
+    try:
+        await asyncio.gather(*(worker(n) for n in range(args.requests)))
+    finally:
+        for deployment in deployments:
+            await deployment.client.close()
+        for runner in runners:
+            await runner.cleanup()
+    elapsed = time.perf_counter() - started
+
+    counts = Counter(r["deployment"] for r in results)
+    rows = []
+    for deployment, app in zip(deployments, apps):
+        ttfts = [r["ttft"] for r in results if r["deployment"] == deployment.name]
+        rows.append({
+            "deployment": deployment.name,
+            "served": counts[deployment.name],
+            "server_errors": app["stats"]["errors"],
+            "p50_ttft_ms": percentile(ttfts, 50) * 1000,
+            "p95_ttft_ms": percentile(ttfts, 95) * 1000,
+            "circuit_open": not deployment.available,
+        })
+    print_table(rows)
+    print(f"requests={len(results)} failed={counts[None]} elapsed={elapsed:.2f}s")
+    if args.output:
+        write_json(args.output, {"deployments": rows, "failed": counts[None], "elapsed_seconds": elapsed})
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,162 @@
+"""
+スレッド名・メッセージ本文の検索のレイテンシを大量データで計測します。
+seeds.py の一括投入（seed-user-*）で数百万ステップを投入してから、ユーザーごとに
+ランク付き検索（search_threads）、サイドバーの検索（list_threads の search）、
+N-gram インデックスを使わない従来の ILIKE による検索を比較します。
+
+検索語は出現頻度ごとに分けて計測します。
+  common: 多くのステップに含まれる語（一致が多く、関連度の計算件数が多い）
+  rare:   候補の本文ごとの番号（一致が少なく、インデックスで絞り込める）
+  short:  1 文字の語（N-gram を作れないため、所有者で絞り込んだステップの本文を走査する）
+
+    cd app && python -m benchmarks.bench_search --users 500 --threads-per-user 500
+    cd app && python -m benchmarks.bench_search --skip-seed --samples 500
+"""
+import argparse
+import asyncio
+import os
+import random
+import time
+from datetime import datetime, timezone
+
+from chainlit.types import Pagination, ThreadFilter
+
+from benchmarks.common import percentile, print_table, write_json
+from data_layer import DataLayer
+from seeds import SEED_OUTPUT_BITS, SEED_USER_PREFIX, SeedPlan, seed_bulk
+from settings import get_engine
+
+TERMS = {
+    "common": ["議事録", "デプロイメント", "インデックス", "quarterly sales", "storage account"],
+    "rare": [f"ticket {i:04d}" for i in range(0, 1 << SEED_OUTPUT_BITS, 97)],
+    "short": ["会", "東", "x"],
+}
+
+# 比較用: 変更前の list_threads の検索条件（本文の ILIKE による走査）
+LEGACY_QUERY = """
+    SELECT "id" FROM threads
+    WHERE "userId" = :user_id
+      AND EXISTS (SELECT 1 FROM steps s WHERE s."threadId" = threads."id" AND s."output" ILIKE :search ESCAPE '\\')
+    ORDER BY "createdAtTs" DESC, "id" DESC
+    LIMIT :limit
+"""
+
+SIZE_QUERY = """
+    SELECT c.relname AS relation, pg_relation_size(c.oid) AS bytes
+    FROM pg_class c
+    WHERE c.relname IN ('threads', 'steps', 'ix_threads_searchGrams', 'ix_steps_searchGrams', 'ix_steps_threadId_createdAtTs')
+    ORDER BY c.relname
+"""
+
+
+def _escape_like(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+async def seed(args) -> None:
+    plan = SeedPlan(
+        users=args.users,
+        threads_per_user=args.threads_per_user,
+        steps_per_thread=args.steps_per_thread,
+        feedbacks_per_thread=0,
+        seed=args.seed,
+    )
+    print(f"{plan.rows('steps')} ステップを {args.workers} プロセスで投入します（検索用の N-gram はトリガーで作成）")
+    print_table(await seed_bulk(plan, args.workers, replace=args.replace))
+
+
+async def measure(data_layer: DataLayer, samples: int, page_size: int, rng: random.Random) -> list[dict]:
+    users = await data_layer.execute_sql(
+        query='SELECT "id", "identifier" FROM users WHERE "identifier" LIKE :prefix',
+        parameters={"prefix": f"{SEED_USER_PREFIX}%"},
+    )
+    if not isinstance(users, list) or not users:
+        raise SystemExit("一括投入したデータがありません。--skip-seed を外して実行してください")
+
+    latencies: dict[tuple[str, str], list[float]] = {}
+    results: dict[tuple[str, str], list[int]] = {}
+
+    async def timed(name: str, kind: str, call):
+        started = time.perf_counter()
+        count = await call()
+        latencies.setdefault((name, kind), []).append(time.perf_counter() - started)
+        results.setdefault((name, kind), []).append(count)
+
+    for _ in range(samples):
+        user = rng.choice(users)
+        for kind, terms in TERMS.items():
+            term = rng.choice(terms)
+
+            async def ranked():
+                return len((await data_layer.search_threads(user["identifier"], term, limit=page_size))["data"])
+
+            async def sidebar():
+                page = await data_layer._query_threads(
+                    Pagination(first=page_size), ThreadFilter(userId=str(user["id"]), search=term)
+                )
+                return len(page.data)
+
+            async def legacy():
+                rows = await data_layer.execute_sql(
+                    query=LEGACY_QUERY,
+                    parameters={"user_id": user["id"], "search": f"%{_escape_like(term)}%", "limit": page_size},
+                )
+                return len(rows) if isinstance(rows, list) else 0
+
+            await timed("search_threads", kind, ranked)
+            await timed("list_threads_search", kind, sidebar)
+            await timed("legacy_ilike", kind, legacy)
+
+    return [
+        {
+            "query": name,
+            "terms": kind,
+            "samples": len(values),
+            "avg_results": sum(results[(name, kind)]) / len(values),
+            "p50_ms": percentile(values, 50) * 1000,
+            "p95_ms": percentile(values, 95) * 1000,
+            "p99_ms": percentile(values, 99) * 1000,
+        }
+        for (name, kind), values in latencies.items()
+    ]
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="スレッド名・メッセージ本文の検索のベンチマーク")
+    # 既定は 1 ユーザーあたり 1 万ステップ × 500 ユーザー（500 万ステップ）
+    parser.add_argument("--users", type=int, default=500, help="一括投入するユーザー数")
+    parser.add_argument("--threads-per-user", type=int, default=500)
+    parser.add_argument("--steps-per-thread", type=int, default=20)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="COPY を並列に実行するプロセス数")
+    parser.add_argument("--samples", type=int, default=200, help="検索語の種類ごとの計測回数")
+    parser.add_argument("--page-size", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=42, help="乱数シード")
+    parser.add_argument("--skip-seed", action="store_true", help="投入済みのデータで計測のみ行う")
+    parser.add_argument("--replace", action="store_true", help="投入済みの一括投入データを削除してから投入する")
+    parser.add_argument("--output", help="結果を保存する JSON ファイル")
+    args = parser.parse_args()
+
+    engine = get_engine()
+    data_layer = DataLayer(engine=engine)
+    try:
+        if not args.skip_seed:
+            await seed(args)
+        sizes = await data_layer.execute_sql(query=SIZE_QUERY, parameters={})
+        sizes = [{"relation": row["relation"], "mb": row["bytes"] / 2**20} for row in sizes] if isinstance(sizes, list) else []
+        print_table(sizes)
+        rows = await measure(data_layer, args.samples, args.page_size, random.Random(args.seed))
+        print_table(rows)
+        if args.output:
+            write_json(args.output, {
+                "created_at": datetime.now(timezone.utc).isoformat(),
+                "config": vars(args),
+                "sizes": sizes,
+                "results": rows,
+            })
+    finally:
+        await data_layer.close()
+        await engine.dispose()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,114 @@
+"""
+サーバープロセスの起動からリクエストを受け付けるまで（time-to-ready）の時間を計測します。
+偽の OpenAI サーバーに向けて chainlit run（--workers 指定時は serve.py）を起動し、
+/metrics/startup が応答するまでの時間と、その時点の app.py の読み込み完了・起動フック完了の時刻を記録します。
+ウォームアップの有無それぞれで計測し、起動時に行う処理の増減を比較できるようにします。
+
+    cd app && python -m benchmarks.bench_startup --runs 5
+    cd app && python -m benchmarks.bench_startup --baseline benchmarks/results/bench_startup-abc123-20250101-000000.json
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import time
+from datetime import datetime, timezone
+
+import aiohttp
+
+from benchmarks.common import percentile, print_table, write_json
+from benchmarks.fake_openai import create_app, start_server
+from benchmarks.load_test import METRICS_HEADERS, RESULTS_DIR, compare, git_commit, start_app
+
+
+async def wait_ready(http: aiohttp.ClientSession, base_url: str, timeout: float) -> dict:
+    """/metrics/startup が応答するまで短い間隔で待ち、起動の各段階の秒数を返します"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            async with http.get(f"{base_url}/metrics/startup", headers=METRICS_HEADERS) as response:
+                if response.status == 200:
+                    return await response.json()
+        except aiohttp.ClientError:
+            pass
+        await asyncio.sleep(0.02)
+    raise SystemExit(f"{base_url} が {timeout:.0f} 秒以内に起動しませんでした")
+
+
+async def measure(endpoint: str, port: int, warmup: bool, workers: int, timeout: float) -> dict:
+    started = time.monotonic()
+    process = await start_app(port, endpoint, workers, extra_env={"WARMUP_ENABLED": "true" if warmup else "false"})
+    try:
+        async with aiohttp.ClientSession() as http:
+            timings = await wait_ready(http, f"http://127.0.0.1:{port}", timeout)
+        return {
+            "warmup": warmup,
+            "time_to_ready_s": time.monotonic() - started,
+            "app_loaded_s": timings.get("app_loaded"),
+            "startup_hook_s": timings["ready"] - timings["app_loaded"] if "ready" in timings else None,
+        }
+    finally:
+        process.terminate()
+        process.wait(timeout=30)
+
+
+def summarize(rows: list[dict]) -> dict:
+    results = {}
+    for warmup in (False, True):
+        label = "warmup" if warmup else "no_warmup"
+        values = [row["time_to_ready_s"] for row in rows if row["warmup"] == warmup]
+        if not values:
+            continue
+        results[f"time_to_ready_{label}_p50_s"] = statistics.median(values)
+        results[f"time_to_ready_{label}_max_s"] = percentile(values, 100)
+        hooks = [row["startup_hook_s"] for row in rows if row["warmup"] == warmup and row["startup_hook_s"] is not None]
+        if hooks:
+            results[f"startup_hook_{label}_p50_s"] = statistics.median(hooks)
+    return results
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="起動からリクエストの受け付けまでの時間のベンチマーク")
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--workers", type=int, default=1, help="app.py のワーカー数（> 1 なら serve.py で起動）")
+    parser.add_argument("--port", type=int, default=8110, help="app.py を起動するポート")
+    parser.add_argument("--ttft", type=float, default=0.1, help="偽サーバーの TTFT")
+    parser.add_argument("--timeout", type=float, default=120, help="起動を待つ秒数")
+    parser.add_argument("--no-warmup-only", action="store_true", help="ウォームアップ無しの場合のみ計測する")
+    parser.add_argument("--output", help="結果を保存する JSON ファイル（既定は benchmarks/results/ 配下）")
+    parser.add_argument("--baseline", help="比較する以前の結果の JSON ファイル")
+    args = parser.parse_args()
+
+    runner, endpoint = await start_server(create_app(ttft=args.ttft))
+    rows = []
+    try:
+        for warmup in (False,) if args.no_warmup_only else (False, True):
+            for _ in range(args.runs):
+                rows.append(await measure(endpoint, args.port, warmup, args.workers, args.timeout))
+    finally:
+        await runner.cleanup()
+    print_table(rows)
+
+    report = {
+        "commit": git_commit(),
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "config": vars(args),
+        "results": summarize(rows),
+        "runs": rows,
+    }
+    print_table([{"metric": key, "value": value} for key, value in report["results"].items()])
+
+    output = args.output
+    if output is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+        output = os.path.join(RESULTS_DIR, f"bench_startup-{report['commit'] or 'unknown'}-{stamp}.json")
+    write_json(output, report)
+    print(f"結果を保存しました: {output}")
+
+    if args.baseline:
+        print_table(compare(report, args.baseline))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,109 @@
+"""
+N 本の同時ストリームを偽の OpenAI ストリームで再現し、
+差分ごとに emit する場合と TokenCoalescer でまとめた場合を比較します。
+--stall-after を指定すると各ストリームが途中で --stall 秒止まり、
+停滞の直前に届いたトークンが画面に届くまでの遅延（max_token_delay_ms）を確認できます。
+
+    cd app && python -m benchmarks.bench_streaming --streams 200
+    cd app && python -m benchmarks.bench_streaming --streams 50 --stall-after 100 --stall 2
+"""
+import argparse
+import asyncio
+import json
+import time
+
+from benchmarks.common import percentile, print_table
+from benchmarks.fake_openai import FakeStream
+from streaming import TokenCoalescer
+
+
+class FakeMessage:
+    """socket.io への emit を模倣し、送信時刻を記録するメッセージ"""
+
+    def __init__(self, emit_cost_us: float):
+        self.content = ""
+        self.emit_cost = emit_cost_us / 1_000_000
+        self.emitted_at = []
+        self.emitted_chars = []
+
+    async def stream_token(self, token: str):
+        self.content += token
+        # emit ごとのシリアライズとイベントループ上の処理コストを再現する
+        json.dumps({"id": "step-id", "token": token, "isSequence": False})
+        deadline = time.perf_counter() + self.emit_cost
+        while time.perf_counter() < deadline:
+            pass
+        await asyncio.sleep(0)
+        self.emitted_at.append(time.perf_counter())
+        self.emitted_chars.append(len(self.content))
+
+
+async def run_stream(args, coalesce: bool):
+    stream = FakeStream(
+        n_tokens=args.tokens, ttft=args.ttft, tokens_per_second=args.tps, stall_after=args.stall_after, stall=args.stall
+    )
+    msg = FakeMessage(args.emit_cost_us)
+    if coalesce:
+        coalescer = TokenCoalescer(msg, interval_ms=args.interval_ms, max_chars=args.max_chars)
+    else:
+        coalescer = TokenCoalescer(msg, interval_ms=0, max_chars=1)
+
+    async with coalescer:
+        async for part in stream:
+            if part.choices and (token := part.choices[0].delta.content or ""):
+                await coalescer.add(token)
+
+    # 各トークンが生成されてから画面に届くまでの遅延
+    produced_chars = []
+    total = 0
+    for token in stream.tokens:
+        total += len(token)
+        produced_chars.append(total)
+    delays = []
+    emit_index = 0
+    for produced_at, chars in zip(stream.produced_at, produced_chars):
+        while msg.emitted_chars[emit_index] < chars:
+            emit_index += 1
+        delays.append(msg.emitted_at[emit_index] - produced_at)
+    gaps = [b - a for a, b in zip(msg.emitted_at, msg.emitted_at[1:])]
+    return len(msg.emitted_at), gaps, delays
+
+
+async def run_mode(args, coalesce: bool) -> dict:
+    started = time.perf_counter()
+    results = await asyncio.gather(*(run_stream(args, coalesce) for _ in range(args.streams)))
+    elapsed = time.perf_counter() - started
+    emits = sum(r[0] for r in results)
+    gaps = [g for r in results for g in r[1]]
+    delays = [d for r in results for d in r[2]]
+    return {
+        "mode": "coalesced" if coalesce else "per-delta",
+        "streams": args.streams,
+        "emits": emits,
+        "emits_per_sec": emits / elapsed,
+        "p99_inter_token_ms": percentile(gaps, 99) * 1000,
+        "p99_token_delay_ms": percentile(delays, 99) * 1000,
+        "max_token_delay_ms": max(delays) * 1000,
+        "elapsed_s": elapsed,
+    }
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="ストリーミング送信のベンチマーク")
+    parser.add_argument("--streams", type=int, default=200, help="同時ストリーム数")
+    parser.add_argument("--tokens", type=int, default=300, help="1ストリームあたりのトークン数")
+    parser.add_argument("--ttft", type=float, default=0.2, help="最初のトークンまでの秒数")
+    parser.add_argument("--tps", type=float, default=60.0, help="1ストリームあたりの毎秒トークン数")
+    parser.add_argument("--emit-cost-us", type=float, default=80.0, help="1回の emit にかかる CPU 時間（マイクロ秒）")
+    parser.add_argument("--interval-ms", type=float, default=30.0, help="まとめて送信する間隔")
+    parser.add_argument("--max-chars", type=int, default=256, help="まとめて送信する最大文字数")
+    parser.add_argument("--stall-after", type=int, help="このトークン数の後にストリームを停滞させる")
+    parser.add_argument("--stall", type=float, default=2.0, help="停滞する秒数")
+    args = parser.parse_args()
+
+    rows = [await run_mode(args, coalesce=False), await run_mode(args, coalesce=True)]
+    print_table(rows)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,159 @@
+"""
+スレッド一覧とスレッド再開のレイテンシを大量データで計測します。
+ベンチマーク用のユーザー（bench-user-*）とスレッド・ステップを投入してから計測します。
+
+    cd app && python -m benchmarks.bench_thread_queries --steps 1000000
+    cd app && python -m benchmarks.bench_thread_queries --skip-seed
+"""
+import argparse
+import asyncio
+import random
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+
+from chainlit.data.sql_alchemy import SQLAlchemyDataLayer
+from sqlalchemy import delete, insert, select
+
+from benchmarks.common import percentile, print_table
+from data_layer import DataLayer
+from models import Step, Thread, User
+from settings import get_engine
+
+USER_PREFIX = "bench-user-"
+INSERT_BATCH_SIZE = 2000
+
+
+def _timestamp(moment: datetime) -> str:
+    # Chainlit と同じ ISO 8601 + Z 形式
+    return moment.replace(tzinfo=None).isoformat() + "Z"
+
+
+async def _insert_batches(conn, table, rows):
+    for i in range(0, len(rows), INSERT_BATCH_SIZE):
+        await conn.execute(insert(table), rows[i:i + INSERT_BATCH_SIZE])
+
+
+async def seed(engine, users: int, threads_per_user: int, steps_per_thread: int, rng: random.Random):
+    """ベンチマーク用のデータを投入し、挿入したステップ数を返します"""
+    now = datetime.now(timezone.utc)
+    inserted = 0
+    started = time.perf_counter()
+    for u in range(users):
+        user_id = uuid.uuid4()
+        identifier = f"{USER_PREFIX}{u}"
+        user_rows = [{"id": user_id, "identifier": identifier, "metadata": {}, "createdAt": _timestamp(now)}]
+        thread_rows, step_rows = [], []
+        for _ in range(threads_per_user):
+            thread_id = uuid.uuid4()
+            created = now - timedelta(minutes=rng.randint(0, 525600))
+            thread_rows.append({
+                "id": thread_id,
+                "createdAt": _timestamp(created),
+                "name": f"ベンチマーク用スレッド {rng.randint(0, 10**6)}",
+                "userId": user_id,
+                "userIdentifier": identifier,
+                "metadata": {},
+            })
+            for s in range(steps_per_thread):
+                step_time = _timestamp(created + timedelta(seconds=s * 5))
+                step_rows.append({
+                    "id": uuid.uuid4(),
+                    "name": "user" if s % 2 == 0 else "Assistant",
+                    "type": "user_message" if s % 2 == 0 else "assistant_message",
+                    "threadId": thread_id,
+                    "streaming": False,
+                    "metadata": {},
+                    "output": "こんにちは、ベンチマーク用のメッセージです。" * rng.randint(1, 8),
+                    "createdAt": step_time,
+                    "start": step_time,
+                    "end": step_time,
+                    "generation": {},
+                    "showInput": "json",
+                })
+        async with engine.begin() as conn:
+            await _insert_batches(conn, User.__table__, user_rows)
+            await _insert_batches(conn, Thread.__table__, thread_rows)
+            await _insert_batches(conn, Step.__table__, step_rows)
+        inserted += len(step_rows)
+        if (u + 1) % 10 == 0 or u + 1 == users:
+            elapsed = time.perf_counter() - started
+            print(f"seeded {inserted} steps ({inserted / elapsed:.0f} rows/s)")
+    return inserted
+
+
+async def cleanup(engine):
+    async with engine.begin() as conn:
+        await conn.execute(delete(User).where(User.identifier.like(f"{USER_PREFIX}%")))
+
+
+async def measure(data_layer: DataLayer, engine, samples: int, rng: random.Random) -> list[dict]:
+    async with engine.connect() as conn:
+        users = (await conn.execute(select(User.id).where(User.identifier.like(f"{USER_PREFIX}%")))).scalars().all()
+        threads = (await conn.execute(
+            select(Thread.id).where(Thread.userIdentifier.like(f"{USER_PREFIX}%")).limit(10000)
+        )).scalars().all()
+    if not users or not threads:
+        raise SystemExit("ベンチマーク用のデータがありません。--skip-seed を外して実行してください")
+
+    list_latencies, resume_latencies, legacy_latencies = [], [], []
+    for _ in range(samples):
+        user_id = str(rng.choice(users))
+        started = time.perf_counter()
+        await data_layer.get_all_user_threads(user_id=user_id)
+        list_latencies.append(time.perf_counter() - started)
+
+        thread_id = str(rng.choice(threads))
+        started = time.perf_counter()
+        await data_layer.get_thread(thread_id)
+        resume_latencies.append(time.perf_counter() - started)
+
+        # 比較用: スレッド・ステップ・エレメントを別々のクエリで取得する従来の再開
+        started = time.perf_counter()
+        await SQLAlchemyDataLayer.get_thread(data_layer, thread_id)
+        legacy_latencies.append(time.perf_counter() - started)
+
+    return [
+        {
+            "query": name,
+            "samples": len(values),
+            "p50_ms": percentile(values, 50) * 1000,
+            "p95_ms": percentile(values, 95) * 1000,
+            "p99_ms": percentile(values, 99) * 1000,
+        }
+        for name, values in (
+            ("thread_list", list_latencies),
+            ("thread_resume", resume_latencies),
+            ("thread_resume_legacy", legacy_latencies),
+        )
+    ]
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="スレッド一覧・再開クエリのベンチマーク")
+    parser.add_argument("--steps", type=int, default=1_000_000, help="投入するステップ数")
+    parser.add_argument("--threads-per-user", type=int, default=50)
+    parser.add_argument("--steps-per-thread", type=int, default=20)
+    parser.add_argument("--samples", type=int, default=200, help="計測回数")
+    parser.add_argument("--seed", type=int, default=42, help="乱数シード")
+    parser.add_argument("--skip-seed", action="store_true", help="既存のベンチマーク用データで計測のみ行う")
+    parser.add_argument("--cleanup", action="store_true", help="計測後にベンチマーク用データを削除する")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    engine = get_engine()
+    data_layer = DataLayer(engine=engine)
+    try:
+        if not args.skip_seed:
+            users = max(1, args.steps // (args.threads_per_user * args.steps_per_thread))
+            await seed(engine, users, args.threads_per_user, args.steps_per_thread, rng)
+        print_table(await measure(data_layer, engine, args.samples, rng))
+        if args.cleanup:
+            await cleanup(engine)
+    finally:
+        await data_layer.close()
+        await engine.dispose()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,34 @@
+import json
+import math
+
+
+def percentile(values, p: float) -> float:
+    """values の p パーセンタイル（0-100）を返します"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, math.ceil(p / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def print_table(rows: list[dict]) -> None:
+    """結果を表形式で標準出力に表示します"""
+    if not rows:
+        return
+    headers = list(rows[0].keys())
+    widths = [max(len(str(h)), *(len(_format(row[h])) for row in rows)) for h in headers]
+    print("  ".join(str(h).ljust(w) for h, w in zip(headers, widths)))
+    for row in rows:
+        print("  ".join(_format(row[h]).ljust(w) for h, w in zip(headers, widths)))
+
+
+def write_json(path: str, payload) -> None:
+    """結果を JSON ファイルに保存します"""
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(payload, f, ensure_ascii=False, indent=2)
+
+
+def _format(value) -> str:
+    if isinstance(value, float):
+        return f"{value:.2f}"
+    return str(value)
@@ -0,0 +1,220 @@
+"""
+Azure OpenAI のストリーミング応答を模倣する偽サーバーとストリーム。
+ルーティングや負荷試験をネットワークに出ずに確認するために使います。
+
+    cd app && python -m benchmarks.fake_openai --port 8081 --ttft 0.3 --tps 40
+    AZURE_OPENAI_ENDPOINT=http://localhost:8081 chainlit run app.py
+"""
+import argparse
+import asyncio
+import random
+import time
+import uuid
+
+from aiohttp import web
+from openai.types.chat import ChatCompletionChunk
+
+SAMPLE_TEXT = "こんにちは！ご質問ありがとうございます。Azure OpenAI を使ったチャットアプリケーションについて説明します。"
+
+
+def make_chunk(content: str | None, finish_reason: str | None = None, completion_id: str | None = None) -> ChatCompletionChunk:
+    """OpenAI のストリーミングレスポンスと同じ形のチャンクを作成します"""
+    return ChatCompletionChunk.model_validate({
+        "id": completion_id or f"chatcmpl-{uuid.uuid4().hex}",
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": "gpt-35-turbo",
+        "choices": [{
+            "index": 0,
+            "delta": {"role": "assistant", "content": content} if content is not None else {},
+            "finish_reason": finish_reason,
+        }],
+    })
+
+
+def make_usage_chunk(prompt_tokens: int, completion_tokens: int, completion_id: str) -> ChatCompletionChunk:
+    """stream_options.include_usage を指定した場合に最後に送られる、使用量だけのチャンク"""
+    return ChatCompletionChunk.model_validate({
+        "id": completion_id,
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": "gpt-35-turbo",
+        "choices": [],
+        "usage": {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+        },
+    })
+
+
+def split_tokens(text: str, n_tokens: int) -> list[str]:
+    """text を繰り返して n_tokens 個の短いトークンに分割します"""
+    tokens = []
+    while len(tokens) < n_tokens:
+        for i in range(0, len(text), 2):
+            tokens.append(text[i:i + 2])
+            if len(tokens) >= n_tokens:
+                break
+    return tokens
+
+
+class FakeStream:
+    """
+    AsyncAzureOpenAI のストリームを模倣する非同期イテレーター。
+    最初のトークンまでの時間（ttft）と毎秒トークン数を指定できます。
+    stall_after を指定すると、その数のトークンを返した後に stall 秒止まります（モデルの生成の停滞）。
+    """
+
+    def __init__(
+        self,
+        n_tokens: int = 200,
+        ttft: float = 0.2,
+        tokens_per_second: float = 50.0,
+        text: str = SAMPLE_TEXT,
+        prompt_tokens: int | None = None,
+        stall_after: int | None = None,
+        stall: float = 0.0,
+    ):
+        self.tokens = split_tokens(text, n_tokens)
+        # None でなければ最後に使用量のチャンクを送る
+        self.prompt_tokens = prompt_tokens
+        self.ttft = ttft
+        self.interval = 1 / tokens_per_second if tokens_per_second > 0 else 0
+        self.stall_after = stall_after
+        self.stall = stall
+        self.completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+        self.produced_at = []
+        self.closed = False
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        await asyncio.sleep(self.ttft)
+        for i, token in enumerate(self.tokens):
+            if self.closed:
+                return
+            if i:
+                await asyncio.sleep(self.interval + (self.stall if i == self.stall_after else 0))
+            self.produced_at.append(time.perf_counter())
+            yield make_chunk(token, completion_id=self.completion_id)
+        yield make_chunk(None, finish_reason="stop", completion_id=self.completion_id)
+        if self.prompt_tokens is not None:
+            yield make_usage_chunk(self.prompt_tokens, len(self.tokens), self.completion_id)
+
+    async def close(self):
+        self.closed = True
+
+
+def create_app(
+    n_tokens: int = 200,
+    ttft: float = 0.2,
+    tokens_per_second: float = 50.0,
+    error_rate: float = 0.0,
+    error_status: int = 503,
+    seed: int | None = None,
+    stall_after: int | None = None,
+    stall: float = 0.0,
+) -> web.Application:
+    """
+    Azure OpenAI の chat/completions エンドポイントを模倣する aiohttp アプリを作成します。
+    error_rate の割合で error_status を返します（429 の場合は Retry-After を付与）。
+    stall_after・stall は各ストリームの途中の停滞です（FakeStream を参照）。
+    """
+    rng = random.Random(seed)
+    # unsent_tokens: 途中で切断されたため送らなかったトークン数の合計
+    stats = {"requests": 0, "errors": 0, "completed": 0, "disconnected": 0, "unsent_tokens": 0}
+    # 切断を検知した時刻（time.perf_counter()）
+    disconnected_at = []
+    # 実行中に障害を切り替えられるよう、起動後も変更可能な dict で持つ
+    faults = {"error_rate": error_rate}
+
+    async def chat_completions(request: web.Request) -> web.StreamResponse:
+        stats["requests"] += 1
+        body = await request.json()
+        if rng.random() < faults["error_rate"]:
+            stats["errors"] += 1
+            headers = {"retry-after": "1"} if error_status == 429 else {}
+            return web.json_response(
+                {"error": {"code": str(error_status), "message": "fake server error"}},
+                status=error_status,
+                headers=headers,
+            )
+        include_usage = (body.get("stream_options") or {}).get("include_usage")
+        # プロンプトのトークン数は文字数で概算する
+        prompt_tokens = sum(len(m.get("content") or "") for m in body.get("messages", [])) if include_usage else None
+        fake = FakeStream(
+            min(n_tokens, body.get("max_tokens") or n_tokens), ttft, tokens_per_second,
+            prompt_tokens=prompt_tokens, stall_after=stall_after, stall=stall,
+        )
+        if not body.get("stream"):
+            await asyncio.sleep(ttft + len(fake.tokens) * fake.interval + (fake.stall if stall_after else 0))
+            stats["completed"] += 1
+            return web.json_response({
+                "id": fake.completion_id,
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": request.match_info["deployment"],
+                "choices": [{
+                    "index": 0,
+                    "message": {"role": "assistant", "content": "".join(fake.tokens)},
+                    "finish_reason": "stop",
+                }],
+            })
+
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream", "Cache-Control": "no-cache"})
+        await response.prepare(request)
+        try:
+            async for chunk in fake:
+                await response.write(f"data: {chunk.model_dump_json(exclude_unset=True)}\n\n".encode())
+            await response.write(b"data: [DONE]\n\n")
+            await response.write_eof()
+        except ConnectionResetError:
+            # クライアントが途中で切断した（停止ボタンやフェイルオーバー）
+            stats["disconnected"] += 1
+            stats["unsent_tokens"] += len(fake.tokens) - len(fake.produced_at)
+            disconnected_at.append(time.perf_counter())
+            return response
+        stats["completed"] += 1
+        return response
+
+    app = web.Application()
+    app["stats"] = stats
+    app["disconnected_at"] = disconnected_at
+    app["faults"] = faults
+    app.router.add_post("/openai/deployments/{deployment}/chat/completions", chat_completions)
+    return app
+
+
+async def start_server(app: web.Application, host: str = "127.0.0.1", port: int = 0) -> tuple[web.AppRunner, str]:
+    """app をバックグラウンドで起動し、(runner, エンドポイント URL) を返します"""
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, f"http://{host}:{port}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Azure OpenAI の偽サーバー")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--tokens", type=int, default=200, help="1 応答あたりのトークン数")
+    parser.add_argument("--ttft", type=float, default=0.2, help="最初のトークンまでの秒数")
+    parser.add_argument("--tps", type=float, default=50.0, help="毎秒トークン数")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="エラーを返す割合（0-1）")
+    parser.add_argument("--error-status", type=int, default=503, help="エラー時のステータスコード")
+    parser.add_argument("--stall-after", type=int, help="このトークン数を返した後に停滞する")
+    parser.add_argument("--stall", type=float, default=0.0, help="停滞する秒数")
+    args = parser.parse_args()
+    app = create_app(
+        args.tokens, args.ttft, args.tps, args.error_rate, args.error_status,
+        stall_after=args.stall_after, stall=args.stall,
+    )
+    web.run_app(app, host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
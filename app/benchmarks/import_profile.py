@@ -0,0 +1,107 @@
+"""
+python -X importtime の出力から、モジュールの import にかかる時間を集計します。
+app は chainlit run と同様に Chainlit を読み込んだ後の差分を計測し、
+settings / models はマイグレーション（alembic の env.py）やスクリプトから読み込む場合の時間を計測します。
+
+    cd app && python -m benchmarks.import_profile --top 20
+    cd app && python -m benchmarks.import_profile --target app --output import_profile.json
+"""
+import argparse
+import statistics
+import subprocess
+import sys
+
+from benchmarks.common import print_table, write_json
+
+# 計測対象と、計測前に読み込んでおくモジュール（その分は集計に含めない）
+TARGETS = {
+    "app": ("app", ("chainlit.cli", "chainlit.server")),
+    "settings": ("settings", ()),
+    "models": ("models", ()),
+}
+
+MARKER = "-- import_profile --"
+
+
+def parse_importtime(stderr: str) -> list[dict]:
+    """MARKER 以降の -X importtime の行を {name, depth, self_ms, cumulative_ms} のリストにします"""
+    rows = []
+    started = False
+    for line in stderr.splitlines():
+        if line == MARKER:
+            started = True
+            continue
+        if not started or not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        rows.append({
+            "name": name.strip(),
+            "depth": (len(name) - len(name.lstrip()) - 1) // 2,
+            "self_ms": int(self_us) / 1000,
+            "cumulative_ms": int(cumulative_us) / 1000,
+        })
+    return rows
+
+
+def profile(module: str, preload=()) -> list[dict]:
+    code = "".join(f"import {m}\n" for m in preload)
+    code += f"import sys\nsys.stderr.write({MARKER!r} + '\\n')\nimport {module}\n"
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        capture_output=True,
+        text=True,
+    )
+    if result.returncode != 0:
+        raise SystemExit(f"{module} の import に失敗しました:\n{result.stderr[-2000:]}")
+    return parse_importtime(result.stderr)
+
+
+def total_ms(rows: list[dict]) -> float:
+    return sum(row["cumulative_ms"] for row in rows if row["depth"] == 0)
+
+
+def by_package(rows: list[dict]) -> dict[str, float]:
+    """トップレベルのパッケージごとの self 時間の合計（ミリ秒）"""
+    totals: dict[str, float] = {}
+    for row in rows:
+        package = row["name"].split(".")[0]
+        totals[package] = totals.get(package, 0) + row["self_ms"]
+    return dict(sorted(totals.items(), key=lambda item: -item[1]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="import 時間のプロファイル")
+    parser.add_argument("--target", action="append", choices=sorted(TARGETS), help="計測対象（複数指定可、既定は全て）")
+    parser.add_argument("--runs", type=int, default=3, help="合計時間の中央値を求める回数")
+    parser.add_argument("--top", type=int, default=15, help="表示するパッケージ数")
+    parser.add_argument("--output", help="結果を保存する JSON ファイル")
+    args = parser.parse_args()
+
+    report = {}
+    summary = []
+    for target in args.target or list(TARGETS):
+        module, preload = TARGETS[target]
+        runs = [profile(module, preload) for _ in range(args.runs)]
+        totals = [total_ms(rows) for rows in runs]
+        packages = by_package(runs[-1])
+        report[target] = {
+            "module": module,
+            "preload": list(preload),
+            "total_ms": statistics.median(totals),
+            "runs_ms": totals,
+            "modules": len(runs[-1]),
+            "packages_self_ms": packages,
+        }
+        summary.append({"target": target, "total_ms": statistics.median(totals), "modules": len(runs[-1])})
+        label = f"{', '.join(preload)} を読み込んだ後の import {module}" if preload else f"import {module}"
+        print(f"\n{target}（{label}）")
+        print_table([{"package": name, "self_ms": ms} for name, ms in list(packages.items())[:args.top]])
+
+    print()
+    print_table(summary)
+    if args.output:
+        write_json(args.output, report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,409 @@
+"""
+1 インスタンスで捌ける同時チャットセッション数を計測する負荷試験です。
+偽の OpenAI サーバーを起動し、app.py を chainlit run で子プロセスとして起動したうえで、
+N 人の仮想ユーザーが Chainlit の websocket プロトコル（socket.io）でログイン・会話します。
+DB と Azurite は docker-compose.yml のサービス（make load-test）を使います。
+
+スループット、TTFT とトークン間隔の p50/p95/p99、DB プールの使用状況、
+セッションあたりのメモリを表示し、コミットごとに比較できるよう JSON に保存します。
+
+    cd app && python -m benchmarks.load_test --users 50 --messages 5
+    cd app && python -m benchmarks.load_test --users 200 --workers 4
+    cd app && python -m benchmarks.load_test --target http://localhost:8000 --baseline benchmarks/results/load_test-abc123-20250101-000000.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+import uuid
+from datetime import datetime, timezone
+
+import aiohttp
+import socketio
+
+from benchmarks.common import percentile, print_table, write_json
+from benchmarks.fake_openai import create_app, start_server
+
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), "results")
+PROMPTS = (
+    "Azure OpenAI の料金体系を教えてください。",
+    "Chainlit でファイルをアップロードする方法は？",
+    "PostgreSQL のコネクションプールの設定について説明してください。",
+    "この会話を短く要約してください。",
+)
+# app.py の password_auth_callback で許可されているユーザー
+DEFAULT_USERNAME = "shuntagami23@gmail.com"
+DEFAULT_PASSWORD = "password123"
+# /metrics 以下の読み取りに使うトークン（起動するサーバーにも同じ値を渡す。--target の場合は環境変数で合わせる）
+METRICS_TOKEN = os.getenv("METRICS_TOKEN") or uuid.uuid4().hex
+METRICS_HEADERS = {"Authorization": f"Bearer {METRICS_TOKEN}"}
+
+
+class UserStats:
+    """仮想ユーザー 1 人分の計測結果"""
+
+    def __init__(self):
+        self.ttfts = []
+        self.intervals = []
+        self.completed = 0
+        self.errors = []
+
+
+class VirtualUser:
+    """1 つの websocket セッションでログインからメッセージ送信までを行う仮想ユーザー"""
+
+    def __init__(self, base_url: str, token: str, stats: UserStats, timeout: float):
+        self.base_url = base_url
+        self.token = token
+        self.stats = stats
+        self.timeout = timeout
+        self.client = socketio.AsyncClient(reconnection=False)
+        self.session_id = str(uuid.uuid4())
+        self._sent_at = None
+        self._last_token_at = None
+        self._first_token = True
+        self._ready = asyncio.Event()
+        self._done = asyncio.Event()
+        self.client.on("new_message", self._on_message)
+        self.client.on("update_message", self._on_message)
+        self.client.on("stream_token", self._on_token)
+        self.client.on("task_end", self._on_task_end)
+
+    async def _on_message(self, data):
+        if data.get("isError") and self._sent_at is not None:
+            self.stats.errors.append(f"server: {data.get('output')}")
+        # on_chat_start の挨拶が届いたら会話履歴の準備ができている
+        elif data.get("type") == "assistant_message":
+            self._ready.set()
+
+    async def _on_token(self, data):
+        now = time.perf_counter()
+        if self._sent_at is None:
+            return
+        if self._first_token:
+            self.stats.ttfts.append(now - self._sent_at)
+            self._first_token = False
+        else:
+            self.stats.intervals.append(now - self._last_token_at)
+        self._last_token_at = now
+
+    async def _on_task_end(self, data):
+        if self._sent_at is not None:
+            self._done.set()
+
+    async def connect(self) -> None:
+        await self.client.connect(
+            self.base_url,
+            socketio_path="/ws/socket.io",
+            transports=["websocket"],
+            # 既定の 1 秒では負荷が高いときに認証（DB 参照）が間に合わない
+            wait_timeout=self.timeout,
+            headers={"Cookie": f"access_token={self.token}"},
+            auth={
+                "clientType": "webapp",
+                "sessionId": self.session_id,
+                "threadId": None,
+                "userEnv": "{}",
+                "chatProfile": None,
+            },
+        )
+        await self.client.emit("connection_successful")
+        await asyncio.wait_for(self._ready.wait(), self.timeout)
+
+    async def send(self, text: str) -> None:
+        """メッセージを送信し、応答のストリームが終わるまで待ちます"""
+        self._done.clear()
+        self._first_token = True
+        self._sent_at = time.perf_counter()
+        await self.client.emit("client_message", {
+            "message": {
+                "id": str(uuid.uuid4()),
+                "name": "user",
+                "type": "user_message",
+                "output": text,
+                "createdAt": datetime.now(timezone.utc).isoformat().replace("+00:00", "Z"),
+            },
+            "fileReferences": None,
+        })
+        try:
+            await asyncio.wait_for(self._done.wait(), self.timeout)
+            self.stats.completed += 1
+        finally:
+            self._sent_at = None
+
+    async def close(self) -> None:
+        await self.client.disconnect()
+
+
+async def login(http: aiohttp.ClientSession, base_url: str, username: str, password: str) -> str:
+    """パスワード認証でログインし、アクセストークン（Cookie の値）を返します"""
+    async with http.post(f"{base_url}/login", data={"username": username, "password": password}) as response:
+        response.raise_for_status()
+        cookie = response.cookies.get("access_token")
+        if cookie is None:
+            raise SystemExit("ログインに失敗しました（access_token の Cookie がありません）")
+        return cookie.value
+
+
+def parse_metrics(text: str) -> dict:
+    """Prometheus のテキスト形式を {サンプル名（ラベル込み）: 値} に変換します"""
+    samples = {}
+    for line in text.splitlines():
+        if not line or line.startswith("#"):
+            continue
+        name, _, value = line.rpartition(" ")
+        samples[name] = float(value)
+    return samples
+
+
+def histogram_quantile(samples: dict, name: str, q: float) -> float | None:
+    """累積バケットから q 分位点が含まれるバケットの上限を返します"""
+    prefix = f'{name}_bucket{{le="'
+    buckets = sorted(
+        (float(key[len(prefix):-2]), count) for key, count in samples.items() if key.startswith(prefix)
+    )
+    if not buckets or not buckets[-1][1]:
+        return None
+    target = q * buckets[-1][1]
+    return next(bound for bound, count in buckets if count >= target)
+
+
+class ServerSampler:
+    """負荷をかけている間、対象サーバーの /metrics を定期的に取得します"""
+
+    def __init__(self, http: aiohttp.ClientSession, base_url: str, interval: float):
+        self.http = http
+        self.base_url = base_url
+        self.interval = interval
+        self.samples = []
+        self._task = None
+
+    async def fetch(self) -> dict:
+        async with self.http.get(f"{self.base_url}/metrics", headers=METRICS_HEADERS) as response:
+            response.raise_for_status()
+            return parse_metrics(await response.text())
+
+    async def _run(self):
+        while True:
+            try:
+                self.samples.append(await self.fetch())
+            except aiohttp.ClientError:
+                pass
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+
+    def peak(self, name: str) -> float:
+        return max((sample.get(name, 0) for sample in self.samples), default=0)
+
+
+async def run_user(base_url: str, token: str, args, stats: UserStats, connected: asyncio.Queue, rng: random.Random):
+    user = VirtualUser(base_url, token, stats, args.timeout)
+    try:
+        try:
+            await user.connect()
+        finally:
+            # 接続の成否にかかわらず、全員の接続待ちを進める
+            connected.put_nowait(user)
+        for i in range(args.messages):
+            await user.send(rng.choice(PROMPTS))
+            if args.think_time and i + 1 < args.messages:
+                await asyncio.sleep(rng.uniform(0, 2 * args.think_time))
+    except Exception as e:
+        stats.errors.append(f"{type(e).__name__}: {e}")
+    finally:
+        await user.close()
+
+
+async def start_app(port: int, endpoint: str, workers: int = 1, extra_env: dict | None = None) -> subprocess.Popen:
+    """偽の OpenAI サーバーに向けた app.py を子プロセスで起動します。workers > 1 なら serve.py で起動します"""
+    env = {
+        **os.environ,
+        "AZURE_OPENAI_ENDPOINT": endpoint,
+        "AZURE_OPENAI_DEPLOYMENTS": "",
+        "OPENAI_API_KEY": "fake",
+        "OPENAI_API_VERSION": os.getenv("OPENAI_API_VERSION") or "2024-02-01",
+        "CHAINLIT_AUTH_SECRET": os.getenv("CHAINLIT_AUTH_SECRET") or uuid.uuid4().hex,
+        "METRICS_TOKEN": METRICS_TOKEN,
+        "WEB_CONCURRENCY": str(workers),
+        **(extra_env or {}),
+    }
+    if workers > 1:
+        command = [sys.executable, "serve.py", "--workers", str(workers)]
+    else:
+        command = [sys.executable, "-m", "chainlit", "run", "app.py", "--headless"]
+    return subprocess.Popen(
+        [*command, "--host", "127.0.0.1", "--port", str(port)],
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+
+
+async def wait_ready(http: aiohttp.ClientSession, base_url: str, timeout: float) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            async with http.get(f"{base_url}/metrics", headers=METRICS_HEADERS) as response:
+                if response.status == 200:
+                    return
+        except aiohttp.ClientError:
+            pass
+        await asyncio.sleep(0.5)
+    raise SystemExit(f"{base_url} が {timeout:.0f} 秒以内に起動しませんでした")
+
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True, stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def summarize(args, stats: list[UserStats], sampler: ServerSampler, rss_before: float, rss_connected: float, elapsed: float) -> dict:
+    ttfts = [v for s in stats for v in s.ttfts]
+    intervals = [v for s in stats for v in s.intervals]
+    completed = sum(s.completed for s in stats)
+    errors = [e for s in stats for e in s.errors]
+    last = sampler.samples[-1] if sampler.samples else {}
+    wait_count = last.get("db_pool_checkout_wait_seconds_count", 0)
+    return {
+        "users": args.users,
+        "messages_per_user": args.messages,
+        "completed": completed,
+        "errors": len(errors),
+        "elapsed_s": elapsed,
+        "throughput_msgs_per_s": completed / elapsed if elapsed else 0.0,
+        "ttft_p50_ms": percentile(ttfts, 50) * 1000,
+        "ttft_p95_ms": percentile(ttfts, 95) * 1000,
+        "ttft_p99_ms": percentile(ttfts, 99) * 1000,
+        "inter_token_p50_ms": percentile(intervals, 50) * 1000,
+        "inter_token_p95_ms": percentile(intervals, 95) * 1000,
+        "inter_token_p99_ms": percentile(intervals, 99) * 1000,
+        "db_pool_peak_checked_out": sampler.peak("db_pool_checked_out_connections"),
+        "db_pool_checkout_wait_mean_ms": (
+            last.get("db_pool_checkout_wait_seconds_sum", 0) / wait_count * 1000 if wait_count else 0.0
+        ),
+        "db_pool_checkout_wait_p95_ms": (histogram_quantile(last, "db_pool_checkout_wait_seconds", 0.95) or 0.0) * 1000,
+        "openai_queue_peak": sampler.peak("openai_scheduler_queue_depth"),
+        "rss_before_mb": rss_before / 1024 / 1024,
+        "rss_peak_mb": sampler.peak("process_resident_memory_bytes") / 1024 / 1024,
+        "memory_per_session_kb": (rss_connected - rss_before) / max(args.users, 1) / 1024,
+        "error_samples": errors[:5],
+    }
+
+
+def compare(current: dict, baseline_path: str) -> list[dict]:
+    """以前の結果ファイルとの差分を数値の項目ごとに返します"""
+    with open(baseline_path, encoding="utf-8") as f:
+        baseline = json.load(f)
+    rows = []
+    for key, value in current["results"].items():
+        before = baseline["results"].get(key)
+        if isinstance(value, (int, float)) and isinstance(before, (int, float)):
+            rows.append({
+                "metric": key,
+                "baseline": float(before),
+                "current": float(value),
+                "change_pct": (value - before) / before * 100 if before else 0.0,
+            })
+    return rows
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="チャットセッションの負荷試験")
+    parser.add_argument("--users", type=int, default=50, help="同時に接続する仮想ユーザー数")
+    parser.add_argument("--spawn-rate", type=float, default=10, help="1 秒あたりに接続するユーザー数")
+    parser.add_argument("--messages", type=int, default=5, help="ユーザーごとのメッセージ数")
+    parser.add_argument("--think-time", type=float, default=1.0, help="メッセージ間の平均待ち時間（秒）")
+    parser.add_argument("--timeout", type=float, default=120, help="1 応答あたりのタイムアウト（秒）")
+    parser.add_argument("--ttft", type=float, default=0.3, help="偽サーバーの TTFT")
+    parser.add_argument("--tps", type=float, default=40, help="偽サーバーの毎秒トークン数")
+    parser.add_argument("--tokens", type=int, default=200, help="偽サーバーの応答トークン数")
+    parser.add_argument("--port", type=int, default=8100, help="app.py を起動するポート")
+    parser.add_argument("--workers", type=int, default=1, help="app.py のワーカー数（/metrics はいずれか 1 つのワーカーの値）")
+    parser.add_argument("--target", help="起動済みのサーバーに負荷をかける場合の URL（偽サーバーは起動しない）")
+    parser.add_argument("--username", default=DEFAULT_USERNAME)
+    parser.add_argument("--password", default=DEFAULT_PASSWORD)
+    parser.add_argument("--sample-interval", type=float, default=0.5, help="/metrics の取得間隔（秒）")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", help="結果を保存する JSON ファイル（既定は benchmarks/results/ 配下）")
+    parser.add_argument("--baseline", help="比較する以前の結果の JSON ファイル")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    runner = process = None
+    if args.target:
+        base_url = args.target.rstrip("/")
+    else:
+        runner, endpoint = await start_server(create_app(n_tokens=args.tokens, ttft=args.ttft, tokens_per_second=args.tps))
+        process = await start_app(args.port, endpoint, args.workers)
+        base_url = f"http://127.0.0.1:{args.port}"
+
+    try:
+        async with aiohttp.ClientSession() as http:
+            await wait_ready(http, base_url, timeout=120)
+            token = await login(http, base_url, args.username, args.password)
+            sampler = ServerSampler(http, base_url, args.sample_interval)
+            rss_before = (await sampler.fetch()).get("process_resident_memory_bytes", 0)
+            sampler.start()
+
+            stats = [UserStats() for _ in range(args.users)]
+            connected = asyncio.Queue()
+            started = time.perf_counter()
+            tasks = []
+            for user_stats in stats:
+                tasks.append(asyncio.create_task(run_user(base_url, token, args, user_stats, connected, rng)))
+                await asyncio.sleep(1 / args.spawn_rate)
+            # 全員の接続が済んだ時点の RSS をセッションあたりのメモリの計算に使う
+            for _ in range(args.users):
+                await connected.get()
+            rss_connected = (await sampler.fetch()).get("process_resident_memory_bytes", 0)
+            await asyncio.gather(*tasks)
+            elapsed = time.perf_counter() - started
+            await sampler.stop()
+            sampler.samples.append(await sampler.fetch())
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait(timeout=30)
+        if runner is not None:
+            await runner.cleanup()
+
+    results = summarize(args, stats, sampler, rss_before, rss_connected, elapsed)
+    report = {
+        "commit": git_commit(),
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "config": vars(args),
+        "results": results,
+    }
+    print_table([{"metric": key, "value": value} for key, value in results.items() if key != "error_samples"])
+    for error in results["error_samples"]:
+        print(f"error: {error}")
+
+    output = args.output
+    if output is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+        output = os.path.join(RESULTS_DIR, f"load_test-{report['commit'] or 'unknown'}-{stamp}.json")
+    write_json(output, report)
+    print(f"結果を保存しました: {output}")
+
+    if args.baseline:
+        print_table(compare(report, args.baseline))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
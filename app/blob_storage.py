@@ -0,0 +1,287 @@
+import asyncio
+import base64
+import mimetypes
+import uuid
+from datetime import datetime, timedelta, timezone
+from typing import Any, AsyncIterable, AsyncIterator, Dict, Iterable, Union
+from urllib.parse import quote
+
+import aiofiles
+from azure.core import MatchConditions
+from azure.storage.blob import BlobBlock, BlobSasPermissions, ContentSettings, generate_blob_sas
+from azure.storage.blob.aio import BlobServiceClient
+from chainlit.data.storage_clients.azure_blob import AzureBlobStorageClient
+
+import metrics
+from cache import TTLCache
+from settings import Config
+from tracing import traced
+from transport import PooledAioHttpTransport
+
+DEFAULT_MIME = "application/octet-stream"
+
+READ_URL_CACHE_REQUESTS = metrics.counter(
+    "blob_read_url_cache_requests_total",
+    "Signed read URL lookups by result",
+    labelnames=("result",),
+)
+
+# 先頭バイトから判定できる主なファイル形式
+MAGIC_NUMBERS = (
+    (b"%PDF-", "application/pdf"),
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"GIF87a", "image/gif"),
+    (b"GIF89a", "image/gif"),
+    (b"PK\x03\x04", "application/zip"),
+    (b"\x1f\x8b", "application/gzip"),
+)
+
+
+def sniff_mime(head: bytes, name: str | None = None) -> str:
+    """ファイル名と先頭バイトから MIME タイプを推定します"""
+    if name and (guessed := mimetypes.guess_type(name)[0]):
+        return guessed
+    for magic, mime in MAGIC_NUMBERS:
+        if head.startswith(magic):
+            return mime
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "image/webp"
+    try:
+        head.decode("utf-8")
+    except UnicodeDecodeError:
+        return DEFAULT_MIME
+    return "text/plain"
+
+
+async def rechunk(chunks: AsyncIterable[bytes], size: int) -> AsyncIterator[bytes]:
+    """任意の長さのチャンク列を size バイトのブロックに詰め直します（最後のブロックは短くなります）"""
+    buffer = bytearray()
+    async for chunk in chunks:
+        buffer += chunk
+        while len(buffer) >= size:
+            yield bytes(buffer[:size])
+            del buffer[:size]
+    if buffer:
+        yield bytes(buffer)
+
+
+async def read_file(path: str, size: int) -> AsyncIterator[bytes]:
+    """ファイルを size バイトずつ読み込みます"""
+    async with aiofiles.open(path, "rb") as f:
+        while chunk := await f.read(size):
+            yield chunk
+
+
+def azurite_connection_string(connection_string: str) -> str:
+    """Azurite エミュレーター（devstoreaccount1）向けに HTTP とエンドポイントを指定した接続文字列に変換します"""
+    if "devstoreaccount1" not in connection_string:
+        return connection_string
+    connection_string = connection_string.replace("DefaultEndpointsProtocol=https", "DefaultEndpointsProtocol=http")
+    if "EndpointSuffix" in connection_string:
+        return connection_string.replace("EndpointSuffix=core.windows.net", f"BlobEndpoint={Config.AZURITE_BLOB_ENDPOINT}")
+    return connection_string + f";BlobEndpoint={Config.AZURITE_BLOB_ENDPOINT}"
+
+
+async def _iterate_bytes(data: bytes, size: int) -> AsyncIterator[bytes]:
+    view = memoryview(data)
+    for i in range(0, len(view), size):
+        yield view[i:i + size]
+
+
+class BlobStorageClient(AzureBlobStorageClient):
+    """
+    接続プールを設定したトランスポートで Blob Storage にアクセスするクライアント。
+
+    ファイルは BLOB_BLOCK_SIZE ごとのブロックに分け、BLOB_UPLOAD_CONCURRENCY 個まで
+    並列に Put Block してから Put Block List で確定します。読み込み中のブロックは
+    同時実行数 + 1 個までしか保持しないため、ファイル全体をメモリに載せません。
+    サイズと MIME タイプはアップロードしながら求めます。
+
+    読み込み用の署名付き URL は BLOB_URL_EXPIRY 秒有効なものを発行し、
+    objectKey ごとに有効期限の BLOB_URL_SAFETY_MARGIN 秒前まで使い回します。
+    ファイルを削除するとその URL はキャッシュから破棄します。
+    """
+
+    def __init__(self, container_name: str, storage_account: str, storage_key: str):
+        # 親クラスは既定のトランスポートでクライアントを作るため、__init__ は呼ばずに同じ属性を設定する
+        self.container_name = container_name
+        self.storage_account = storage_account
+        self.storage_key = storage_key
+        connection_string = (
+            f"DefaultEndpointsProtocol=https;"
+            f"AccountName={storage_account};"
+            f"AccountKey={storage_key};"
+            f"EndpointSuffix=core.windows.net"
+        )
+        self.service_client = BlobServiceClient.from_connection_string(
+            azurite_connection_string(connection_string),
+            transport=PooledAioHttpTransport(),
+            # ダウンロードは BLOB_BLOCK_SIZE ごとの範囲読み込みにする
+            max_single_get_size=Config.BLOB_BLOCK_SIZE,
+            max_chunk_get_size=Config.BLOB_BLOCK_SIZE,
+        )
+        self.container_client = self.service_client.get_container_client(self.container_name)
+        self.block_size = Config.BLOB_BLOCK_SIZE
+        self.concurrency = Config.BLOB_UPLOAD_CONCURRENCY
+        self.read_urls = TTLCache(Config.BLOB_URL_CACHE_SIZE, Config.BLOB_URL_EXPIRY - Config.BLOB_URL_SAFETY_MARGIN)
+
+    async def warm_up(self) -> None:
+        """コンテナーのプロパティを取得して接続を確立します"""
+        await self.container_client.get_container_properties()
+
+    async def close(self) -> None:
+        await self.service_client.close()
+
+    async def get_read_url(self, object_key: str) -> str:
+        return (await self.get_read_urls([object_key]))[object_key]
+
+    @traced("blob.sign_read_urls")
+    async def get_read_urls(self, object_keys: Iterable[str]) -> Dict[str, str]:
+        """
+        複数の objectKey の署名付き URL をまとめて返します。
+        キャッシュに無いものだけ、同じ有効期間でまとめて署名します。
+        """
+        if not self.storage_key:
+            raise Exception("Not using Azure Storage")
+        urls, missing = {}, []
+        for object_key in dict.fromkeys(object_keys):
+            if (url := self.read_urls.get(object_key)) is not None:
+                urls[object_key] = url
+            else:
+                missing.append(object_key)
+        READ_URL_CACHE_REQUESTS.inc(len(urls), result="hit")
+        if not missing:
+            return urls
+        READ_URL_CACHE_REQUESTS.inc(len(missing), result="miss")
+
+        permission = BlobSasPermissions(read=True)
+        start = datetime.now(tz=timezone.utc)
+        expiry = start + timedelta(seconds=Config.BLOB_URL_EXPIRY)
+        base_url = f"https://{self.storage_account}.blob.core.windows.net/{self.container_name}"
+        for object_key in missing:
+            sas_token = generate_blob_sas(
+                account_name=self.storage_account,
+                container_name=self.container_name,
+                blob_name=object_key,
+                account_key=self.storage_key,
+                permission=permission,
+                start=start,
+                expiry=expiry,
+            )
+            urls[object_key] = f"{base_url}/{quote(object_key, safe='/')}?{sas_token}"
+            self.read_urls.set(object_key, urls[object_key])
+        return urls
+
+    @traced("blob.delete")
+    async def delete_file(self, object_key: str) -> bool:
+        self.read_urls.pop(object_key)
+        return await super().delete_file(object_key)
+
+    async def upload_file(
+        self,
+        object_key: str,
+        data: Union[bytes, str],
+        mime: str = DEFAULT_MIME,
+        overwrite: bool = True,
+    ) -> Dict[str, Any]:
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        return await self.upload_stream(object_key, _iterate_bytes(data, self.block_size), mime, overwrite)
+
+    async def upload_path(self, object_key: str, path: str, mime: str | None = None, overwrite: bool = True) -> Dict[str, Any]:
+        """ローカルファイルをブロック単位で読み込みながらアップロードします"""
+        return await self.upload_stream(object_key, read_file(path, self.block_size), mime, overwrite)
+
+    @traced("blob.upload")
+    async def upload_stream(
+        self,
+        object_key: str,
+        chunks: AsyncIterable[bytes],
+        mime: str | None = None,
+        overwrite: bool = True,
+    ) -> Dict[str, Any]:
+        """
+        チャンク列をアップロードし、upload_file と同じ形の dict を返します。
+        mime が未指定（または application/octet-stream）の場合は先頭ブロックから推定します。
+        """
+        try:
+            blob_client = self.container_client.get_blob_client(object_key)
+            blocks = rechunk(chunks, self.block_size)
+            first = await anext(blocks, b"")
+            if not mime or mime == DEFAULT_MIME:
+                mime = sniff_mime(first[:512], object_key.rsplit("/", 1)[-1])
+            content_settings = ContentSettings(content_type=mime)
+
+            second = await anext(blocks, None)
+            if second is None:
+                # 1 ブロックに収まる場合は 1 回の Put Blob で済ませる
+                result = await blob_client.upload_blob(first, overwrite=overwrite, content_settings=content_settings)
+                size = len(first)
+            else:
+                head, first, second = [first, second], None, None
+                result, size = await self._upload_blocks(blob_client, head, blocks, content_settings, overwrite)
+
+            return {
+                "path": object_key,
+                "object_key": object_key,
+                "url": await self.get_read_url(object_key),
+                "size": size,
+                "last_modified": result.get("last_modified"),
+                "etag": result.get("etag"),
+                "content_type": mime,
+            }
+        except Exception as e:
+            raise Exception(f"Failed to upload file to Azure Blob Storage: {e!s}")
+
+    async def _upload_blocks(self, blob_client, head: list[bytes], rest: AsyncIterator[bytes], content_settings, overwrite: bool):
+        prefix = uuid.uuid4().hex[:16]
+        semaphore = asyncio.Semaphore(self.concurrency)
+        block_ids: list[str] = []
+        tasks: list[asyncio.Task] = []
+        size = 0
+
+        async def stage(block_id: str, block: bytes):
+            try:
+                await blob_client.stage_block(block_id, block, length=len(block))
+            finally:
+                semaphore.release()
+
+        async def all_blocks():
+            # 送信済みのブロックを参照し続けないよう取り出しながら返す
+            while head:
+                yield head.pop(0)
+            async for block in rest:
+                yield block
+
+        try:
+            async for block in all_blocks():
+                # 空きが出るまで次のブロックを読み込まない（メモリ上のブロック数を抑える）
+                await semaphore.acquire()
+                for task in tasks:
+                    if task.done() and task.exception():
+                        raise task.exception()
+                block_id = base64.b64encode(f"{prefix}-{len(block_ids):08d}".encode()).decode()
+                block_ids.append(block_id)
+                size += len(block)
+                tasks.append(asyncio.create_task(stage(block_id, block)))
+            await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            raise
+
+        conditions = {} if overwrite else {"etag": "*", "match_condition": MatchConditions.IfMissing}
+        result = await blob_client.commit_block_list(
+            [BlobBlock(block_id=block_id) for block_id in block_ids],
+            content_settings=content_settings,
+            **conditions,
+        )
+        return result, size
+
+    async def download_stream(self, object_key: str, offset: int = 0, length: int | None = None) -> AsyncIterator[bytes]:
+        """Blob を BLOB_BLOCK_SIZE ごとの範囲読み込みで先頭から順に返します"""
+        blob_client = self.container_client.get_blob_client(object_key)
+        downloader = await blob_client.download_blob(offset=offset, length=length)
+        async for chunk in downloader.chunks():
+            yield chunk
@@ -0,0 +1,130 @@
+import hashlib
+import json
+import logging
+import unicodedata
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import delete, select, update
+from sqlalchemy.dialects.postgresql import insert
+
+import metrics
+from cache import TTLCache
+from models import CompletionCache as CompletionCacheRow
+from settings import Config, get_engine
+
+logger = logging.getLogger(__name__)
+
+COMPLETION_CACHE_REQUESTS = metrics.counter(
+    "completion_cache_requests_total",
+    "Completion cache lookups by result",
+    labelnames=("result",),
+)
+
+# キャッシュキーに含めない設定（結果に影響しないもの）
+IGNORED_SETTINGS = {"stream", "stream_options"}
+
+
+def normalize_text(text: str) -> str:
+    """全角・半角の揺れと空白の違いを吸収します"""
+    return " ".join(unicodedata.normalize("NFKC", text or "").split())
+
+
+def cache_key(messages: list[dict], settings: dict) -> str:
+    """正規化した会話履歴と設定から一意なキーを作成します"""
+    payload = {
+        "messages": [[m["role"], normalize_text(m["content"])] for m in messages],
+        "settings": {k: v for k, v in settings.items() if k not in IGNORED_SETTINGS},
+    }
+    encoded = json.dumps(payload, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(encoded.encode("utf-8")).hexdigest()
+
+
+class CompletionCache:
+    """
+    同じ会話履歴・設定に対する補完結果を再利用するキャッシュ。
+    プロセス内の LRU と Postgres の 2 段構成で、結果はトークン列のまま保存し、
+    ヒット時は通常の応答と同じストリーミング経路で再生します。
+    temperature によらず、有効にすると同じ会話履歴・設定には最初の応答を返し続けます
+    （サンプリングの揺らぎは無くなる）。設定はキーに含まれるため、設定を変えると別の結果になります。
+    """
+
+    def __init__(self, enabled: bool | None = None, engine=None):
+        self.enabled = Config.COMPLETION_CACHE_ENABLED if enabled is None else enabled
+        self.engine = engine
+        self.ttl = Config.COMPLETION_CACHE_TTL
+        self.memory = TTLCache(Config.COMPLETION_CACHE_MEMORY_SIZE, self.ttl)
+        self._sets_since_prune = 0
+
+    def _engine(self):
+        return self.engine or get_engine()
+
+    async def get(self, messages: list[dict], settings: dict) -> list[str] | None:
+        """キャッシュされたトークン列を返します。無ければ None"""
+        if not self.enabled:
+            COMPLETION_CACHE_REQUESTS.inc(result="skip")
+            return None
+        key = cache_key(messages, settings)
+        if (tokens := self.memory.get(key)) is not None:
+            COMPLETION_CACHE_REQUESTS.inc(result="memory_hit")
+            return tokens
+        if Config.COMPLETION_CACHE_DB_ENABLED and (tokens := await self._db_get(key)) is not None:
+            self.memory.set(key, tokens)
+            COMPLETION_CACHE_REQUESTS.inc(result="db_hit")
+            return tokens
+        COMPLETION_CACHE_REQUESTS.inc(result="miss")
+        return None
+
+    async def set(self, messages: list[dict], settings: dict, tokens: list[str]) -> None:
+        """完了した応答のトークン列を保存します"""
+        if not self.enabled or not tokens:
+            return
+        key = cache_key(messages, settings)
+        self.memory.set(key, tokens)
+        if Config.COMPLETION_CACHE_DB_ENABLED:
+            await self._db_set(key, settings.get("model"), tokens)
+
+    async def _db_get(self, key: str) -> list[str] | None:
+        table = CompletionCacheRow.__table__
+        try:
+            async with self._engine().begin() as conn:
+                result = await conn.execute(
+                    update(table)
+                    .where(table.c.key == key, table.c.expiresAt > datetime.now(timezone.utc))
+                    .values(hits=table.c.hits + 1)
+                    .returning(table.c.tokens)
+                )
+                return result.scalar()
+        except Exception as e:
+            logger.warning(f"補完キャッシュの読み込みに失敗しました: {e}")
+            return None
+
+    async def _db_set(self, key: str, model: str | None, tokens: list[str]) -> None:
+        table = CompletionCacheRow.__table__
+        expires_at = datetime.now(timezone.utc) + timedelta(seconds=self.ttl)
+        stmt = insert(table).values(key=key, model=model, tokens=tokens, expiresAt=expires_at)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[table.c.key],
+            set_={"tokens": stmt.excluded.tokens, "expiresAt": stmt.excluded.expiresAt},
+        )
+        try:
+            async with self._engine().begin() as conn:
+                await conn.execute(stmt)
+            self._sets_since_prune += 1
+            if self._sets_since_prune >= Config.COMPLETION_CACHE_PRUNE_EVERY:
+                self._sets_since_prune = 0
+                await self.prune()
+        except Exception as e:
+            logger.warning(f"補完キャッシュの保存に失敗しました: {e}")
+
+    async def prune(self) -> int:
+        """期限切れの行と上限件数を超えた古い行を削除し、削除件数を返します"""
+        table = CompletionCacheRow.__table__
+        async with self._engine().begin() as conn:
+            expired = await conn.execute(delete(table).where(table.c.expiresAt <= datetime.now(timezone.utc)))
+            keep = (
+                select(table.c.key)
+                .order_by(table.c.createdAt.desc())
+                .limit(Config.COMPLETION_CACHE_DB_MAX_ROWS)
+            )
+            overflow = await conn.execute(delete(table).where(table.c.key.not_in(keep)))
+        return expired.rowcount + overflow.rowcount
@@ -0,0 +1,247 @@
+import base64
+import logging
+import sys
+import uuid
+from array import array
+from collections import deque
+
+from settings import Config, chat_settings
+
+try:
+    import tiktoken
+except ImportError:  # tiktoken が無い環境では概算でトークン数を見積もる
+    tiktoken = None
+
+logger = logging.getLogger(__name__)
+
+# 1メッセージごとに role などの区切りとして加算されるトークン数
+MESSAGE_OVERHEAD_TOKENS = 4
+# アシスタントの返答の先頭に付与されるトークン数
+REPLY_PRIMING_TOKENS = 3
+# 手放したターンの role は ROLES の添字で保持する
+ROLES = ("system", "user", "assistant")
+# 会話履歴に含めるステップの type と role の対応
+MESSAGE_STEP_ROLES = {"user_message": "user", "assistant_message": "assistant"}
+
+_encoding = None
+
+
+def _get_encoding():
+    """tiktoken のエンコーディングを初回利用時に読み込みます"""
+    global _encoding
+    if _encoding is None and tiktoken is not None:
+        try:
+            _encoding = tiktoken.get_encoding(Config.TOKENIZER_ENCODING)
+        except Exception as e:
+            logger.warning(f"トークナイザーを読み込めないため概算値を使用します: {e}")
+            _encoding = False
+    return _encoding or None
+
+
+def count_tokens(text: str) -> int:
+    """テキストのトークン数を返します"""
+    if not text:
+        return 0
+    if encoding := _get_encoding():
+        return len(encoding.encode(text))
+    # 概算: 日本語は1文字あたり約1トークン、ASCIIは約4文字で1トークン
+    ascii_chars = sum(1 for c in text if c.isascii())
+    return (len(text) - ascii_chars) + (ascii_chars + 3) // 4
+
+
+def context_budget(settings: dict | None = None) -> int:
+    """プロンプトに使用できるトークン数の上限を返します"""
+    settings = settings or chat_settings()
+    budget = Config.MODEL_CONTEXT_WINDOW - settings["max_tokens"] - REPLY_PRIMING_TOKENS
+    if Config.CONTEXT_MAX_PROMPT_TOKENS:
+        budget = min(budget, Config.CONTEXT_MAX_PROMPT_TOKENS)
+    return max(budget, 0)
+
+
+# to_state() でステップ ID の無いターンを表す値
+NIL_STEP_ID = bytes(16)
+
+
+def _pack(data: bytes) -> str:
+    return base64.b64encode(data).decode()
+
+
+def _pack_uint32(values: array) -> str:
+    """トークン数の配列をリトルエンディアンのバイト列として base64 にします"""
+    if sys.byteorder == "big":
+        values = array("I", values)
+        values.byteswap()
+    return _pack(values.tobytes())
+
+
+def _unpack_uint32(data: str) -> array:
+    values = array("I", base64.b64decode(data))
+    if sys.byteorder == "big":
+        values.byteswap()
+    return values
+
+
+class Turn:
+    """会話の 1 メッセージ。role はインターンした文字列を共有します"""
+
+    __slots__ = ("role", "content", "tokens", "step_id")
+
+    def __init__(self, role: str, content: str, tokens: int, step_id: str | None = None):
+        self.role = sys.intern(role)
+        self.content = content
+        self.tokens = tokens
+        self.step_id = step_id
+
+    def message(self) -> dict:
+        return {"role": self.role, "content": self.content}
+
+
+class ConversationContext:
+    """
+    OpenAI に送信する会話履歴を保持します。
+    各メッセージのトークン数を追加時に一度だけ計算してキャッシュし、
+    合計がトークン予算を超えた場合は古いターンから削除します。
+
+    本文をメモリに持つのは直近 window 件のみです。それより古いターンは
+    steps テーブルに保存済みのため、ステップ ID（16 バイト）・トークン数・role だけを
+    配列に残して本文を手放し、load_messages() で必要になったときに loader で読み戻します。
+    ステップ ID の無いターンは読み戻せないため、常にメモリに残します。
+    """
+
+    def __init__(self, system_prompt: str, budget: int | None = None, window: int | None = None, loader=None):
+        self.system_message = {"role": "system", "content": system_prompt}
+        self.system_tokens = count_tokens(system_prompt) + MESSAGE_OVERHEAD_TOKENS
+        self.budget = budget if budget is not None else context_budget()
+        self.window = window if window is not None else Config.HISTORY_MEMORY_TURNS
+        # loader(step_ids) -> {step_id: content}
+        self.loader = loader
+        self._turns: deque[Turn] = deque()
+        self._turn_tokens = 0
+        # 本文を手放したターン（古い順）
+        self._spilled_ids = bytearray()
+        self._spilled_tokens = array("I")
+        self._spilled_roles = bytearray()
+        self.trimmed_count = 0
+
+    def __len__(self):
+        return len(self._spilled_roles) + len(self._turns)
+
+    @property
+    def token_count(self) -> int:
+        """現在の履歴全体のトークン数"""
+        return self.system_tokens + self._turn_tokens
+
+    @property
+    def spilled_count(self) -> int:
+        return len(self._spilled_roles)
+
+    def append(self, role: str, content: str, step_id: str | None = None) -> None:
+        """メッセージを追加し、予算を超えた分の古いターンを削除します"""
+        tokens = count_tokens(content) + MESSAGE_OVERHEAD_TOKENS
+        self._turns.append(Turn(role, content, tokens, step_id))
+        self._turn_tokens += tokens
+        self._trim()
+        self._spill()
+
+    def extend_steps(self, steps: list[dict]) -> None:
+        """保存済みのステップ（古い順）からユーザーとアシスタントのメッセージを追加します"""
+        for step in steps:
+            role = MESSAGE_STEP_ROLES.get(step.get("type"))
+            if role and step.get("output"):
+                self.append(role, step["output"], step_id=step.get("id"))
+
+    def to_state(self) -> dict:
+        """
+        セッションストアに保存するための、JSON に変換できる状態を返します。
+        メモリ上のターンも本文以外は role の添字・トークン数・ステップ ID（16 バイト）の配列に詰めて保持し、
+        ターンごとのリストや UUID の文字列を作りません。
+        """
+        return {
+            "budget": self.budget,
+            "window": self.window,
+            "contents": [turn.content for turn in self._turns],
+            "roles": _pack(bytes(ROLES.index(turn.role) for turn in self._turns)),
+            "tokens": _pack_uint32(array("I", (turn.tokens for turn in self._turns))),
+            "step_ids": _pack(b"".join(uuid.UUID(turn.step_id).bytes if turn.step_id else NIL_STEP_ID for turn in self._turns)),
+            "spilled_ids": _pack(self._spilled_ids),
+            "spilled_tokens": _pack_uint32(self._spilled_tokens),
+            "spilled_roles": _pack(self._spilled_roles),
+            "trimmed_count": self.trimmed_count,
+        }
+
+    @classmethod
+    def from_state(cls, system_prompt: str, state: dict, loader=None) -> "ConversationContext":
+        """to_state() で保存した状態から復元します。トークン数は再計算しません"""
+        context = cls(system_prompt, budget=state["budget"], window=state["window"], loader=loader)
+        if "turns" in state:
+            # 以前の形式（ターンごとの [role, content, tokens, step_id]）で保存された状態
+            turns = state["turns"]
+            spilled_tokens = array("I", state["spilled_tokens"])
+        else:
+            ids = base64.b64decode(state["step_ids"])
+            step_ids = (ids[i:i + 16] for i in range(0, len(ids), 16))
+            turns = zip(
+                (ROLES[role] for role in base64.b64decode(state["roles"])),
+                state["contents"],
+                _unpack_uint32(state["tokens"]),
+                (None if step_id == NIL_STEP_ID else str(uuid.UUID(bytes=step_id)) for step_id in step_ids),
+            )
+            spilled_tokens = _unpack_uint32(state["spilled_tokens"])
+        for role, content, tokens, step_id in turns:
+            context._turns.append(Turn(role, content, tokens, step_id))
+            context._turn_tokens += tokens
+        context._spilled_ids = bytearray(base64.b64decode(state["spilled_ids"]))
+        context._spilled_tokens = spilled_tokens
+        context._spilled_roles = bytearray(base64.b64decode(state["spilled_roles"]))
+        context._turn_tokens += sum(context._spilled_tokens)
+        context.trimmed_count = state["trimmed_count"]
+        return context
+
+    def _trim(self) -> None:
+        # 最新のメッセージは予算を超えていても必ず残す
+        while self.token_count > self.budget and len(self) > 1:
+            self._drop_oldest()
+        # 履歴がアシスタントの返答から始まらないように揃える
+        while len(self) > 1 and self._oldest_role() == "assistant":
+            self._drop_oldest()
+
+    def _oldest_role(self) -> str:
+        if self._spilled_roles:
+            return ROLES[self._spilled_roles[0]]
+        return self._turns[0].role
+
+    def _drop_oldest(self) -> None:
+        if self._spilled_roles:
+            tokens = self._spilled_tokens.pop(0)
+            del self._spilled_roles[0]
+            del self._spilled_ids[:16]
+        else:
+            tokens = self._turns.popleft().tokens
+        self._turn_tokens -= tokens
+        self.trimmed_count += 1
+
+    def _spill(self) -> None:
+        # ステップ ID のあるターンだけを、古い順に途切れなく手放す
+        while len(self._turns) > self.window and self.loader is not None and self._turns[0].step_id:
+            turn = self._turns.popleft()
+            self._spilled_ids += uuid.UUID(turn.step_id).bytes
+            self._spilled_tokens.append(turn.tokens)
+            self._spilled_roles.append(ROLES.index(turn.role))
+
+    def messages(self) -> list[dict]:
+        """メモリ上のターンだけで API に送信するメッセージのリストを返します"""
+        return [self.system_message, *(turn.message() for turn in self._turns)]
+
+    async def load_messages(self) -> list[dict]:
+        """手放したターンを loader で読み戻し、API に送信するメッセージのリストを返します"""
+        if not self._spilled_roles:
+            return self.messages()
+        step_ids = [str(uuid.UUID(bytes=bytes(self._spilled_ids[i:i + 16]))) for i in range(0, len(self._spilled_ids), 16)]
+        contents = await self.loader(step_ids)
+        spilled = []
+        for step_id, role in zip(step_ids, self._spilled_roles):
+            if (content := contents.get(step_id)) is None:
+                logger.warning(f"会話履歴のステップを読み戻せませんでした: {step_id}")
+                continue
+            spilled.append({"role": ROLES[role], "content": content})
+        return [self.system_message, *spilled, *(turn.message() for turn in self._turns)]
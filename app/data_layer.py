@@ -0,0 +1,673 @@
+import json
+import math
+import unicodedata
+import uuid
+from datetime import datetime
+from typing import TYPE_CHECKING, Dict, List, Optional
+
+import aiohttp
+from chainlit.data.sql_alchemy import SQLAlchemyDataLayer
+from chainlit.data.storage_clients.base import BaseStorageClient
+from chainlit.data.utils import queue_until_user_message
+from chainlit.logger import logger
+from chainlit.types import PageInfo, PaginatedResponse, Pagination, ThreadDict, ThreadFilter
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, async_sessionmaker
+
+from blob_storage import DEFAULT_MIME, BlobStorageClient
+from cache import TTLCache
+from retention import ThreadArchiver
+from settings import Config, get_engine
+from tracing import traced
+from write_behind import WriteBehindQueue
+
+if TYPE_CHECKING:
+    from chainlit.element import Element, ElementDict
+    from chainlit.step import StepDict
+
+
+class DataLayer(SQLAlchemyDataLayer):
+    """
+    settings.get_engine() の共有コネクションプールを使用する SQLAlchemyDataLayer。
+    SQLAlchemyDataLayer.__init__ は独自のエンジンを作成するため呼び出しません。
+
+    WRITE_BEHIND_ENABLED が有効な場合、threads / steps への書き込みは
+    WriteBehindQueue に溜めてまとめて反映します。それ以外の SQL を実行する前には
+    必ずキューをフラッシュするため、読み込みや外部キーを持つ書き込みからは
+    溜まっている書き込みが常に見えます。
+
+    スレッド一覧は (createdAtTs, id) のキーセットでページングし、
+    フィルターなしのページはユーザーごとに TTLCache に保持します。
+    スレッドの作成・更新・削除でそのユーザーのキャッシュを破棄します。
+
+    スレッドの再開（get_thread）はステップ・フィードバック・エレメントを JSON 集約で
+    1 回のクエリにまとめ、長いスレッドのステップは get_thread_steps でページごとに返します。
+    保持期間を過ぎて Blob に退避されたスレッドは、開いた時に復元してから返します。
+    """
+
+    def __init__(
+        self,
+        engine: Optional[AsyncEngine] = None,
+        storage_provider: Optional[BaseStorageClient] = None,
+        user_thread_limit: Optional[int] = 1000,
+        show_logger: Optional[bool] = False,
+    ):
+        self.engine = engine or get_engine()
+        self._conninfo = self.engine.url.render_as_string(hide_password=True)
+        self.user_thread_limit = user_thread_limit
+        self.show_logger = show_logger
+        self.async_session = async_sessionmaker(bind=self.engine, expire_on_commit=False, class_=AsyncSession)
+        self.storage_provider = storage_provider
+        if storage_provider is None:
+            logger.warning("DataLayer storage client is not initialized and elements will not be persisted!")
+        self.write_behind = WriteBehindQueue(self.engine) if Config.WRITE_BEHIND_ENABLED else None
+        self.archiver = ThreadArchiver(storage_provider, self.engine) if isinstance(storage_provider, BlobStorageClient) else None
+        # userId -> {(first, cursor): PaginatedResponse}
+        self.thread_list_cache = TTLCache(Config.THREAD_LIST_CACHE_SIZE, Config.THREAD_LIST_CACHE_TTL)
+        # 所有者を引くための threadId -> userId（所有者は変わらないため失効させない）
+        self._thread_owners = TTLCache(Config.THREAD_OWNER_CACHE_SIZE, float("inf"))
+        # 所有者が分からないまま更新されたスレッド。一覧取得時にまとめて解決する
+        self._dirty_threads = set()
+        self._cache_generation = 0
+
+    async def flush(self):
+        """溜まっている書き込みをデータベースに反映します"""
+        if self.write_behind is not None:
+            await self.write_behind.flush()
+
+    async def close(self):
+        """書き込みを反映してからバックグラウンドタスクを停止します"""
+        if self.write_behind is not None:
+            await self.write_behind.close()
+
+    @traced("db.execute_sql")
+    async def execute_sql(self, query: str, parameters: dict):
+        await self.flush()
+        return await super().execute_sql(query=query, parameters=parameters)
+
+    async def update_thread(
+        self,
+        thread_id: str,
+        name: Optional[str] = None,
+        user_id: Optional[str] = None,
+        metadata: Optional[Dict] = None,
+        tags: Optional[List[str]] = None,
+    ):
+        self._invalidate_thread(thread_id, user_id)
+        if self.write_behind is None:
+            return await super().update_thread(thread_id, name=name, user_id=user_id, metadata=metadata, tags=tags)
+        if self.show_logger:
+            logger.info(f"DataLayer: update_thread, thread_id={thread_id}")
+
+        user_identifier = None
+        if user_id:
+            user_identifier = await self._get_user_identifer_by_id(user_id)
+
+        # SQLAlchemyDataLayer.update_thread と同じ値をキューに積む
+        self.write_behind.enqueue_thread({
+            "id": thread_id,
+            "createdAt": await self.get_current_timestamp() if metadata is None else None,
+            "name": name if name is not None else (metadata.get("name") if metadata and "name" in metadata else None),
+            "userId": user_id,
+            "userIdentifier": user_identifier,
+            "tags": tags,
+            "metadata": metadata or None,
+        })
+
+    @queue_until_user_message()
+    async def create_step(self, step_dict: "StepDict"):
+        if self.write_behind is None:
+            return await super().create_step(step_dict)
+        await self.update_thread(step_dict["threadId"])
+
+        if self.show_logger:
+            logger.info(f"DataLayer: create_step, step_id={step_dict.get('id')}")
+
+        # SQLAlchemyDataLayer.create_step と同じ正規化を行う
+        values = {
+            key: value
+            for key, value in step_dict.items()
+            if value is not None and not (isinstance(value, dict) and not value)
+        }
+        if "showInput" in step_dict:
+            values["showInput"] = str(step_dict.get("showInput", "")).lower()
+        values["metadata"] = step_dict.get("metadata") or {}
+        values["generation"] = step_dict.get("generation") or {}
+        self.write_behind.enqueue_step(values)
+
+    @queue_until_user_message()
+    async def delete_step(self, step_id: str):
+        if self.write_behind is not None:
+            self.write_behind.discard_step(step_id)
+        await super().delete_step(step_id)
+
+    @traced("data_layer.get_step_outputs")
+    async def get_step_outputs(self, step_ids: List[str]) -> Dict[str, str]:
+        """ステップ ID ごとの output を 1 回のクエリで返します（会話履歴の読み戻し用）"""
+        if not step_ids:
+            return {}
+        query = """SELECT "id", "output" FROM steps WHERE "id" = ANY(CAST(:ids AS uuid[]))"""
+        rows = await self.execute_sql(query=query, parameters={"ids": step_ids})
+        if not isinstance(rows, list):
+            return {}
+        return {str(row["id"]): row["output"] for row in rows if row["output"] is not None}
+
+    async def delete_thread(self, thread_id: str):
+        if self.write_behind is not None:
+            self.write_behind.discard_thread(thread_id)
+        user_id = self._thread_owners.get(thread_id) or await self._get_user_id_by_thread(thread_id)
+        self._invalidate_thread(thread_id, user_id)
+        if self.show_logger:
+            logger.info(f"DataLayer: delete_thread, thread_id={thread_id}")
+
+        elements = await self.execute_sql(
+            query="""SELECT "objectKey" FROM elements WHERE "threadId" = :id""", parameters={"id": thread_id}
+        )
+        if self.storage_provider is not None and isinstance(elements, list):
+            for element in filter(lambda x: x["objectKey"], elements):
+                await self.storage_provider.delete_file(object_key=element["objectKey"])
+
+        # SQLAlchemyDataLayer.delete_thread と同じ削除を 1 つのトランザクションで行う。
+        # スレッドの削除は応答・フィードバックの取り消しではないため、退避と同じく集計（response_rollup_*）からは引かない
+        async with self.engine.begin() as conn:
+            await conn.execute(text("SET LOCAL app.skip_rollup = 'on'"))
+            for query in (
+                """DELETE FROM feedbacks WHERE "forId" IN (SELECT "id" FROM steps WHERE "threadId" = :id)""",
+                """DELETE FROM elements WHERE "threadId" = :id""",
+                """DELETE FROM steps WHERE "threadId" = :id""",
+                """DELETE FROM threads WHERE "id" = :id""",
+            ):
+                await conn.execute(text(query), {"id": thread_id})
+
+    ###### Thread resume ######
+    @traced("data_layer.get_thread")
+    async def get_thread(self, thread_id: str) -> Optional[ThreadDict]:
+        """
+        スレッドと直近 THREAD_RESUME_STEPS 件のステップ（フィードバック付き）・エレメントを
+        1 回のクエリで取得します。行の組み立ては Postgres の JSON 集約で行います。
+        それより古いステップがある場合は olderStepsCursor を設定するので、
+        get_thread_steps(before=olderStepsCursor) で続きをページごとに取得できます。
+        """
+        if self.show_logger:
+            logger.info(f"DataLayer: get_thread, thread_id={thread_id}")
+        limit = Config.THREAD_RESUME_STEPS or None
+        query = f"""
+            SELECT json_build_object(
+                'id', t."id",
+                'createdAt', t."createdAt",
+                'name', t."name",
+                'userId', t."userId",
+                'userIdentifier', t."userIdentifier",
+                'tags', t."tags",
+                'metadata', t."metadata",
+                'archiveKey', t."archiveKey",
+                'steps', COALESCE((
+                    SELECT json_agg({STEP_JSON} ORDER BY s."createdAtTs", s."id")
+                    FROM (
+                        SELECT * FROM steps
+                        WHERE "threadId" = t."id"
+                        ORDER BY "createdAtTs" DESC, "id" DESC
+                        LIMIT :limit
+                    ) s
+                    LEFT JOIN feedbacks f ON f."forId" = s."id"
+                ), '[]'::json),
+                'elements', COALESCE((
+                    SELECT json_agg({ELEMENT_JSON})
+                    FROM elements e
+                    WHERE e."threadId" = t."id"
+                ), '[]'::json)
+            )::text AS thread
+            FROM threads t
+            WHERE t."id" = CAST(:thread_id AS uuid)
+        """
+        # 続きがあるかを判定するため 1 件多く取得する
+        rows = await self.execute_sql(query=query, parameters={"thread_id": thread_id, "limit": limit and limit + 1})
+        if not isinstance(rows, list) or not rows:
+            return None
+        thread = json.loads(rows[0]["thread"])
+        if (key := thread.pop("archiveKey")) and self.archiver is not None:
+            try:
+                await self.archiver.restore(thread_id, key)
+                return await self.get_thread(thread_id)
+            except Exception as e:
+                logger.warning(f"DataLayer: failed to restore archived thread {thread_id}: {e}")
+        thread["olderStepsCursor"] = None
+        if limit and len(thread["steps"]) > limit:
+            del thread["steps"][0]
+            thread["olderStepsCursor"] = thread["steps"][0]["id"]
+        if thread["userId"]:
+            self._thread_owners.set(thread["id"], thread["userId"])
+        await self._refresh_read_urls(thread["elements"])
+        return thread
+
+    @traced("data_layer.get_thread_steps")
+    async def get_thread_steps(self, thread_id: str, before: Optional[str] = None, limit: Optional[int] = None) -> Dict:
+        """
+        before（ステップ ID）より古いステップを新しい方から limit 件、古い順に返します。
+        nextCursor が None になるまで before に渡すと、スレッドの先頭まで遡れます。
+        """
+        limit = limit or Config.THREAD_STEPS_PAGE_SIZE
+        conditions = ['s."threadId" = CAST(:thread_id AS uuid)']
+        parameters = {"thread_id": thread_id, "limit": limit + 1}
+        if before:
+            conditions.append(
+                """(s."createdAtTs", s."id") < (SELECT "createdAtTs", "id" FROM steps WHERE "id" = CAST(:before AS uuid))"""
+            )
+            parameters["before"] = before
+        query = f"""
+            SELECT {STEP_JSON}::text AS step
+            FROM steps s
+            LEFT JOIN feedbacks f ON f."forId" = s."id"
+            WHERE {" AND ".join(conditions)}
+            ORDER BY s."createdAtTs" DESC, s."id" DESC
+            LIMIT :limit
+        """
+        rows = await self.execute_sql(query=query, parameters=parameters)
+        steps = [json.loads(row["step"]) for row in rows] if isinstance(rows, list) else []
+        has_more = len(steps) > limit
+        steps = steps[:limit][::-1]
+        return {"steps": steps, "nextCursor": steps[0]["id"] if has_more else None}
+
+    ###### Elements ######
+    @traced("data_layer.get_element")
+    async def get_element(self, thread_id: str, element_id: str) -> Optional["ElementDict"]:
+        element = await super().get_element(thread_id, element_id)
+        if element is not None:
+            await self._refresh_read_urls([element])
+        return element
+
+    async def _refresh_read_urls(self, elements: list) -> None:
+        """保存時の URL は期限切れのため、objectKey の署名付き URL をまとめて差し替えます"""
+        if not isinstance(self.storage_provider, BlobStorageClient) or not self.storage_provider.storage_key:
+            return
+        object_keys = [element["objectKey"] for element in elements if element.get("objectKey")]
+        if not object_keys:
+            return
+        urls = await self.storage_provider.get_read_urls(object_keys)
+        for element in elements:
+            if element.get("objectKey"):
+                element["url"] = urls[element["objectKey"]]
+
+    @queue_until_user_message()
+    @traced("data_layer.create_element")
+    async def create_element(self, element: "Element"):
+        """
+        SQLAlchemyDataLayer.create_element と同じ行を作成します。
+        ファイルや URL の内容はメモリに読み込まず、ブロック単位でアップロードしながら
+        サイズ（sizeBytes）と MIME タイプを求めます。
+        """
+        if not isinstance(self.storage_provider, BlobStorageClient):
+            return await super().create_element(element)
+        if self.show_logger:
+            logger.info(f"DataLayer: create_element, element_id = {element.id}")
+        if not element.for_id:
+            return
+
+        user_id: str = await self._get_user_id_by_thread(element.thread_id) or "unknown"
+        object_key = f"{user_id}/{element.id}" + (f"/{element.name}" if element.name else "")
+
+        if element.path:
+            uploaded_file = await self.storage_provider.upload_path(object_key, element.path, element.mime)
+        elif element.url:
+            async with aiohttp.ClientSession() as session:
+                async with session.get(element.url) as response:
+                    if response.status != 200:
+                        raise ValueError("Content is None, cannot upload file")
+                    uploaded_file = await self.storage_provider.upload_stream(
+                        object_key,
+                        response.content.iter_chunked(self.storage_provider.block_size),
+                        element.mime or response.content_type,
+                    )
+        elif element.content:
+            uploaded_file = await self.storage_provider.upload_file(
+                object_key, element.content, element.mime or DEFAULT_MIME
+            )
+        else:
+            raise ValueError("Element url, path or content must be provided")
+
+        element.mime = uploaded_file["content_type"]
+        element_dict = element.to_dict()
+        element_dict["url"] = uploaded_file.get("url")
+        element_dict["objectKey"] = uploaded_file.get("object_key")
+        element_dict["sizeBytes"] = uploaded_file.get("size")
+
+        values = {k: v for k, v in element_dict.items() if v is not None}
+        if "props" in values:
+            values["props"] = json.dumps(values["props"])
+        columns = ", ".join(f'"{column}"' for column in values)
+        placeholders = ", ".join(f":{column}" for column in values)
+        updates = ", ".join(f'"{column}" = :{column}' for column in values if column != "id")
+        query = f"INSERT INTO elements ({columns}) VALUES ({placeholders}) ON CONFLICT (id) DO UPDATE SET {updates};"
+        await self.execute_sql(query=query, parameters=values)
+
+    ###### Thread list ######
+    def _invalidate_thread(self, thread_id: str, user_id: Optional[str] = None) -> None:
+        """スレッドの所有者のスレッド一覧キャッシュを破棄します"""
+        self._cache_generation += 1
+        user_id = user_id or self._thread_owners.get(thread_id)
+        if user_id is None:
+            self._dirty_threads.add(thread_id)
+            return
+        self._thread_owners.set(thread_id, user_id)
+        self.thread_list_cache.pop(user_id)
+
+    async def _resolve_dirty_threads(self) -> None:
+        if not self._dirty_threads:
+            return
+        thread_ids, self._dirty_threads = list(self._dirty_threads), set()
+        query = """SELECT "id", "userId" FROM threads WHERE "id" = ANY(CAST(:ids AS uuid[]))"""
+        rows = await self.execute_sql(query=query, parameters={"ids": thread_ids})
+        if isinstance(rows, list):
+            for row in rows:
+                if row["userId"]:
+                    self._invalidate_thread(row["id"], row["userId"])
+
+    @traced("data_layer.list_threads")
+    async def list_threads(self, pagination: Pagination, filters: ThreadFilter) -> PaginatedResponse:
+        if self.show_logger:
+            logger.info(f"DataLayer: list_threads, pagination={pagination}, filters={filters}")
+        if not filters.userId:
+            raise ValueError("userId is required")
+
+        cacheable = not filters.search and filters.feedback is None
+        page_key = (pagination.first, pagination.cursor)
+        if cacheable:
+            await self._resolve_dirty_threads()
+            pages = self.thread_list_cache.get(filters.userId)
+            if pages and page_key in pages:
+                return pages[page_key]
+
+        generation = self._cache_generation
+        response = await self._query_threads(pagination, filters)
+
+        # 取得中に更新があった場合は古い結果をキャッシュしない
+        if cacheable and generation == self._cache_generation:
+            pages = self.thread_list_cache.get(filters.userId) or {}
+            if len(pages) < Config.THREAD_LIST_CACHE_PAGES:
+                pages[page_key] = response
+                self.thread_list_cache.set(filters.userId, pages)
+        return response
+
+    async def _query_threads(self, pagination: Pagination, filters: ThreadFilter) -> PaginatedResponse:
+        """
+        (createdAtTs, id) の降順でキーセットページングしたスレッドを取得します。
+        createdAtTs が NULL のスレッドは日時のあるスレッドの後に id の降順で並べます。
+        """
+        conditions = ['"userId" = :user_id']
+        parameters = {"user_id": filters.userId, "limit": pagination.first + 1}
+        keysets = ["TRUE"]
+        if pagination.cursor:
+            if (cursor := await self._decode_cursor(pagination.cursor)) is None:
+                # 読めないカーソルで 1 ページ目を返すと、サイドバーが同じページを読み込み続ける
+                return PaginatedResponse(pageInfo=PageInfo(hasNextPage=False, startCursor=None, endCursor=None), data=[])
+            parameters["cursor_ts"], parameters["cursor_id"] = cursor
+            if parameters["cursor_ts"] is None:
+                keysets = ['"createdAtTs" IS NULL AND "id" < CAST(:cursor_id AS uuid)']
+            else:
+                # NULL の行は行の比較から外れるため、日時のある行の後に続ける。
+                # OR でまとめるとインデックスの範囲で絞り込めないため、別々に取得して合わせる
+                keysets = ['("createdAtTs", "id") < (:cursor_ts, CAST(:cursor_id AS uuid))', '"createdAtTs" IS NULL']
+        if filters.search and filters.search.strip():
+            search = filters.search.strip()
+            if _has_search_grams(search):
+                # 一致したスレッドを GIN インデックスでまとめて求める
+                steps_condition = f"""threads."id" IN (
+                    SELECT s."threadId" FROM steps s WHERE {_search_condition("s", "output", search, SEARCH_OWNER)})"""
+            else:
+                # 1 文字の語はインデックスで絞り込めないため、新しいスレッドから順に調べて件数に達したら止める
+                steps_condition = f"""EXISTS (
+                    SELECT 1 FROM steps s WHERE s."threadId" = threads."id" AND {_search_condition("s", "output", search)})"""
+            conditions.append(f"""({_search_condition("threads", "name", search)} OR {steps_condition})""")
+            parameters["search"] = search
+        if filters.feedback is not None:
+            conditions.append(
+                """EXISTS (SELECT 1 FROM feedbacks f WHERE f."threadId" = threads."id" AND f."value" = :feedback)"""
+            )
+            parameters["feedback"] = int(filters.feedback)
+
+        order = 'ORDER BY "createdAtTs" DESC NULLS LAST, "id" DESC LIMIT :limit'
+        query = " UNION ALL ".join(
+            f"""(
+            SELECT "id", "createdAt", "createdAtTs", "name", "userId", "userIdentifier", "tags", "metadata"
+            FROM threads
+            WHERE {" AND ".join([*conditions, keyset])}
+            {order}
+        )"""
+            for keyset in keysets
+        )
+        if len(keysets) > 1:
+            query = f"SELECT * FROM ({query}) threads {order}"
+        rows = await self.execute_sql(query=query, parameters=parameters)
+        rows = rows if isinstance(rows, list) else []
+
+        has_next_page = len(rows) > pagination.first
+        rows = rows[: pagination.first]
+        threads = []
+        for row in rows:
+            self._thread_owners.set(row["id"], row["userId"])
+            threads.append(
+                ThreadDict(
+                    id=row["id"],
+                    createdAt=row["createdAt"],
+                    name=row["name"],
+                    userId=row["userId"],
+                    userIdentifier=row["userIdentifier"],
+                    tags=row["tags"],
+                    metadata=row["metadata"],
+                    steps=[],
+                    elements=[],
+                )
+            )
+        return PaginatedResponse(
+            pageInfo=PageInfo(
+                hasNextPage=has_next_page,
+                startCursor=_encode_cursor(rows[0]) if rows else None,
+                endCursor=_encode_cursor(rows[-1]) if rows else None,
+            ),
+            data=threads,
+        )
+
+    @traced("data_layer.search_threads")
+    async def search_threads(
+        self, user_identifier: str, query: str, cursor: Optional[str] = None, limit: Optional[int] = None
+    ) -> Dict:
+        """
+        userIdentifier のスレッドから、名前またはメッセージの本文に query を含むものを関連度の高い順に返します。
+        関連度は一致した回数を本文の長さで割り引いた値の最大値で、スレッド名の一致は SEARCH_NAME_WEIGHT 倍します。
+        各スレッドには最も関連度の高い一致（stepId は名前に一致した場合 None）の前後を snippet として付けます。
+        nextCursor が None になるまで cursor に渡すと続きを取得できます。
+        Blob に退避したスレッドのステップは検索対象になりません。
+        """
+        limit = limit or Config.SEARCH_PAGE_SIZE
+        query = query.strip()
+        if not query:
+            return {"data": [], "nextCursor": None}
+        conditions = ["TRUE"]
+        parameters = {"user": user_identifier, "search": query, "name_weight": Config.SEARCH_NAME_WEIGHT, "limit": limit + 1}
+        if cursor and (decoded := _decode_search_cursor(cursor)):
+            conditions.append('(b."rank", b."lastMatchAt", b."threadId") < (:cursor_rank, :cursor_at, CAST(:cursor_id AS uuid))')
+            parameters["cursor_rank"], parameters["cursor_at"], parameters["cursor_id"] = decoded
+        sql = f"""
+            WITH hits AS (
+                SELECT s."threadId", s."id" AS "stepId", s."output" AS "text", s."createdAtTs" AS "matchedAt",
+                       {SEARCH_SCORE.format(doc="n.doc")} AS "score"
+                FROM threads t
+                JOIN steps s ON s."threadId" = t."id"
+                CROSS JOIN LATERAL (SELECT search_normalize(s."output") AS doc OFFSET 0) n
+                WHERE t."userIdentifier" = :user AND {_search_condition("s", "output", query, ":user", "n.doc")}
+                UNION ALL
+                SELECT t."id", NULL, t."name", t."createdAtTs", :name_weight * {SEARCH_SCORE.format(doc="n.doc")}
+                FROM threads t
+                CROSS JOIN LATERAL (SELECT search_normalize(t."name") AS doc OFFSET 0) n
+                WHERE t."userIdentifier" = :user AND {_search_condition("t", "name", query, normalized="n.doc")}
+            ), best AS (
+                SELECT DISTINCT ON (h."threadId")
+                    h."threadId", h."stepId", h."text", h."score" AS "rank",
+                    count(*) OVER w AS "matches",
+                    COALESCE(extract(epoch FROM max(h."matchedAt") OVER w), 0)::float8 AS "lastMatchAt"
+                FROM hits h
+                WINDOW w AS (PARTITION BY h."threadId")
+                ORDER BY h."threadId", h."score" DESC, h."matchedAt" DESC NULLS LAST
+            )
+            SELECT b.*, t."name", t."createdAt"
+            FROM best b
+            JOIN threads t ON t."id" = b."threadId"
+            WHERE {" AND ".join(conditions)}
+            ORDER BY b."rank" DESC, b."lastMatchAt" DESC, b."threadId" DESC
+            LIMIT :limit
+        """
+        rows = await self.execute_sql(query=sql, parameters=parameters)
+        rows = rows if isinstance(rows, list) else []
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        results = [
+            {
+                "threadId": str(row["threadId"]),
+                "name": row["name"],
+                "createdAt": row["createdAt"],
+                "stepId": row["stepId"] and str(row["stepId"]),
+                "snippet": _snippet(row["text"] or "", query, Config.SEARCH_SNIPPET_CHARS),
+                "matches": row["matches"],
+                "rank": row["rank"],
+            }
+            for row in rows
+        ]
+        next_cursor = None
+        if has_more and rows:
+            last = rows[-1]
+            next_cursor = f"{last['rank']!r}|{last['lastMatchAt']!r}|{last['threadId']}"
+        return {"data": results, "nextCursor": next_cursor}
+
+    async def _decode_cursor(self, cursor: str):
+        """
+        カーソルを (createdAtTs, id) に変換します（createdAtTs が NULL のスレッドは (None, id)）。
+        スレッド id だけのカーソルも受け付けます。読めないカーソルや存在しないスレッドの場合は None を返します。
+        """
+        if "|" in cursor:
+            created_at, thread_id = cursor.rsplit("|", 1)
+            try:
+                thread_id = str(uuid.UUID(thread_id))
+                if created_at == NULL_CURSOR:
+                    return None, thread_id
+                return datetime.fromisoformat(created_at), thread_id
+            except ValueError:
+                return None
+        try:
+            thread_id = str(uuid.UUID(cursor))
+        except ValueError:
+            return None
+        query = """SELECT "createdAtTs" FROM threads WHERE "id" = CAST(:id AS uuid)"""
+        rows = await self.execute_sql(query=query, parameters={"id": thread_id})
+        if isinstance(rows, list) and rows:
+            return rows[0]["createdAtTs"], thread_id
+        return None
+
+
+# SQLAlchemyDataLayer.get_all_user_threads と同じ形の StepDict / ElementDict を作る式
+STEP_JSON = """json_build_object(
+    'id', s."id",
+    'name', s."name",
+    'type', s."type",
+    'threadId', s."threadId",
+    'parentId', s."parentId",
+    'streaming', s."streaming",
+    'waitForAnswer', s."waitForAnswer",
+    'isError', s."isError",
+    'metadata', COALESCE(s."metadata", '{}'::jsonb),
+    'tags', s."tags",
+    'input', CASE WHEN s."showInput" IS NULL OR s."showInput" = 'false' THEN '' ELSE s."input" END,
+    'output', s."output",
+    'createdAt', s."createdAt",
+    'start', s."start",
+    'end', s."end",
+    'generation', s."generation",
+    'showInput', s."showInput",
+    'language', s."language",
+    'feedback', CASE WHEN f."value" IS NULL THEN NULL ELSE json_build_object(
+        'forId', s."id", 'id', f."id", 'value', f."value", 'comment', f."comment"
+    ) END
+)"""
+
+ELEMENT_JSON = """json_build_object(
+    'id', e."id",
+    'threadId', e."threadId",
+    'type', e."type",
+    'chainlitKey', e."chainlitKey",
+    'url', e."url",
+    'objectKey', e."objectKey",
+    'name', e."name",
+    'display', e."display",
+    'size', e."size",
+    'language', e."language",
+    'autoPlay', NULL,
+    'playerConfig', NULL,
+    'page', e."page",
+    'props', e."props",
+    'forId', e."forId",
+    'mime', e."mime"
+)"""
+
+
+# list_threads の userId から検索用の所有者（userIdentifier）を引く式
+SEARCH_OWNER = '(SELECT u."identifier" FROM users u WHERE u."id" = :user_id)'
+
+# 正規化した本文 doc での一致回数を長さの対数で割り引いた関連度（短い本文での一致ほど高くなる）
+SEARCH_SCORE = """(
+    (length({doc}) - length(replace({doc}, search_normalize(:search), ''))) / length(search_normalize(:search))::float8
+    / (1 + ln(1 + length({doc})))
+)"""
+
+
+# createdAtTs が NULL のスレッドを指すカーソルの日時の部分
+NULL_CURSOR = "null"
+
+
+def _encode_cursor(row: dict) -> str:
+    created_at = NULL_CURSOR if row["createdAtTs"] is None else row["createdAtTs"].isoformat()
+    return f"{created_at}|{row['id']}"
+
+
+def _search_condition(
+    alias: str, column: str, query: str, owner: Optional[str] = None, normalized: Optional[str] = None
+) -> str:
+    """
+    alias."column" が :search を含む条件。正規化（NFKC・小文字化）した文字列で比較し、
+    "searchGrams" の GIN インデックスで候補を絞り込みます。steps はスレッドの所有者
+    （owner は userIdentifier を返す SQL の式）も "searchGrams" の要素で絞り込みます。
+    normalized には正規化済みの本文の式を渡せます（関連度の計算と共有する場合）。
+    """
+    grams = ["search_grams(:search)"] if _has_search_grams(query) else []
+    if owner:
+        grams.append(f"search_owner({owner})")
+    normalized = normalized or f'search_normalize({alias}."{column}")'
+    condition = f"strpos({normalized}, search_normalize(:search)) > 0"
+    if grams:
+        condition = f'{alias}."searchGrams" @> ({" || ".join(grams)}) AND {condition}'
+    return condition
+
+
+def _has_search_grams(query: str) -> bool:
+    """search_grams() が空でない（空白を含まない 2 文字の並びがある）なら True"""
+    normalized = unicodedata.normalize("NFKC", query).lower()
+    return any(not (a.isspace() or b.isspace()) for a, b in zip(normalized, normalized[1:]))
+
+
+def _decode_search_cursor(cursor: str):
+    """検索のカーソルを (rank, lastMatchAt, threadId) に変換します。不正なカーソルは None を返します"""
+    try:
+        rank, matched_at, thread_id = cursor.split("|", 2)
+        values = float(rank), float(matched_at), str(uuid.UUID(thread_id))
+    except ValueError:
+        return None
+    # nan や inf は行値の比較が常に偽（または真）になり、ページ送りが止まるため受け付けない
+    if not all(math.isfinite(value) for value in values[:2]):
+        return None
+    return values
+
+
+def _snippet(text: str, query: str, width: int) -> str:
+    """text のうち query に一致した位置の前後 width 文字程度を切り出します"""
+    position = max(text.lower().find(query.lower()), 0)
+    start = max(position - width // 2, 0)
+    end = start + width
+    return ("…" if start > 0 else "") + text[start:end] + ("…" if end < len(text) else "")
@@ -0,0 +1,22 @@
+class Lazy:
+    """
+    最初に呼び出された時に factory() でオブジェクトを作成し、以降は同じオブジェクトを返します。
+    import 時に重いライブラリの読み込みやクライアントの作成を行わないために使います。
+    """
+
+    __slots__ = ("factory", "_value", "_created")
+
+    def __init__(self, factory):
+        self.factory = factory
+        self._value = None
+        self._created = False
+
+    def __call__(self):
+        if not self._created:
+            self._value = self.factory()
+            self._created = True
+        return self._value
+
+    def peek(self):
+        """作成済みならそのオブジェクトを、未作成なら None を返します（終了処理用）"""
+        return self._value
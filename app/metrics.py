@@ -0,0 +1,192 @@
+import math
+import os
+import resource
+import sys
+import threading
+from bisect import bisect_left
+
+# 秒単位のレイテンシ向けのデフォルトバケット
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# Prometheus のテキスト形式（/metrics のレスポンス）
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+_registry = {}
+_lock = threading.Lock()
+
+
+class _Metric:
+    type = ""
+
+    def __init__(self, name: str, description: str, labelnames: tuple = ()):
+        self.name = name
+        self.description = description
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+
+    def _key(self, labels: dict) -> tuple:
+        if not self.labelnames:
+            return ()
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def samples(self) -> dict:
+        """ラベル値のタプルをキーにした現在値のコピーを返します"""
+        return dict(self._values)
+
+
+class Counter(_Metric):
+    """単調増加するカウンター"""
+
+    type = "counter"
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0)
+
+
+class Gauge(_Metric):
+    """任意に増減する値。関数を登録すると参照時に値を計算します"""
+
+    type = "gauge"
+
+    def __init__(self, name: str, description: str, labelnames: tuple = ()):
+        super().__init__(name, description, labelnames)
+        self._function = None
+
+    def set(self, value: float, **labels) -> None:
+        self._values[self._key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels) -> None:
+        self.inc(-amount, **labels)
+
+    def set_function(self, function) -> None:
+        self._function = function
+
+    def value(self, **labels) -> float:
+        if self._function is not None:
+            return self._function()
+        return self._values.get(self._key(labels), 0)
+
+    def samples(self) -> dict:
+        if self._function is not None:
+            return {(): self._function()}
+        return super().samples()
+
+
+class Histogram(_Metric):
+    """バケットごとの観測数と合計値を保持するヒストグラム"""
+
+    type = "histogram"
+
+    def __init__(self, name: str, description: str, labelnames: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        super().__init__(name, description, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels) -> None:
+        # ストリームのチャンクごとに呼ばれるため、バケットは二分探索で求める
+        key = self._key(labels)
+        state = self._values.get(key)
+        if state is None:
+            # [バケットごとの件数..., +Inf の件数, 合計値]
+            state = self._values[key] = [0] * (len(self.buckets) + 2)
+        state[bisect_left(self.buckets, value)] += 1
+        state[-1] += value
+
+    def count(self, **labels) -> int:
+        state = self._values.get(self._key(labels))
+        return sum(state[:-1]) if state else 0
+
+    def sum(self, **labels) -> float:
+        state = self._values.get(self._key(labels))
+        return state[-1] if state else 0.0
+
+
+def _get_or_create(cls, name: str, *args, **kwargs):
+    with _lock:
+        metric = _registry.get(name)
+        if metric is None:
+            metric = _registry[name] = cls(name, *args, **kwargs)
+        elif not isinstance(metric, cls):
+            raise ValueError(f"Metric {name} is already registered as {metric.type}")
+        return metric
+
+
+def counter(name: str, description: str, labelnames: tuple = ()) -> Counter:
+    return _get_or_create(Counter, name, description, labelnames)
+
+
+def gauge(name: str, description: str, labelnames: tuple = ()) -> Gauge:
+    return _get_or_create(Gauge, name, description, labelnames)
+
+
+def histogram(name: str, description: str, labelnames: tuple = (), buckets: tuple = DEFAULT_BUCKETS) -> Histogram:
+    return _get_or_create(Histogram, name, description, labelnames, buckets)
+
+
+def registered_metrics() -> list:
+    """登録済みのメトリクスを名前順に返します"""
+    with _lock:
+        return [_registry[name] for name in sorted(_registry)]
+
+
+def resident_memory_bytes() -> int:
+    """プロセスの現在の常駐メモリ（RSS）を返します。/proc が無い環境では最大 RSS で代用します"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # macOS はバイト、Linux は KiB 単位
+        return max_rss if sys.platform == "darwin" else max_rss * 1024
+
+
+def render_prometheus() -> str:
+    """登録済みのメトリクスを Prometheus のテキスト形式で返します"""
+    lines = []
+    for metric in registered_metrics():
+        lines.append(f"# HELP {metric.name} {_escape_help(metric.description)}")
+        lines.append(f"# TYPE {metric.name} {metric.type}")
+        for key, value in sorted(metric.samples().items()):
+            labels = list(zip(metric.labelnames, key))
+            if metric.type != "histogram":
+                lines.append(f"{metric.name}{_format_labels(labels)} {_format_value(value)}")
+                continue
+            # 保持しているのはバケットごとの件数なので累積に直す
+            cumulative = 0
+            for bound, count in zip((*metric.buckets, math.inf), value):
+                cumulative += count
+                bucket_labels = [*labels, ("le", _format_value(bound))]
+                lines.append(f"{metric.name}_bucket{_format_labels(bucket_labels)} {cumulative}")
+            lines.append(f"{metric.name}_sum{_format_labels(labels)} {_format_value(value[-1])}")
+            lines.append(f"{metric.name}_count{_format_labels(labels)} {cumulative}")
+    return "\n".join(lines) + "\n"
+
+
+def _format_labels(labels: list) -> str:
+    if not labels:
+        return ""
+    pairs = ",".join(f'{name}="{_escape_label(value)}"' for name, value in labels)
+    return "{" + pairs + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value)) if abs(value) < 1e15 else repr(value)
+    return repr(value)
+
+
+def _escape_help(text: str) -> str:
+    return text.replace("\\", "\\\\").replace("\n", "\\n")
+
+
+def _escape_label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
@@ -0,0 +1,118 @@
+"""add-indexes-and-timestamptz
+
+Revision ID: 7c2e9a4f1b3d
+Revises: 46bcd210abb8
+Create Date: 2025-04-02 10:12:31.204518
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '7c2e9a4f1b3d'
+down_revision: Union[str, None] = '46bcd210abb8'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# バックフィル1回あたりの更新件数（1トランザクションあたりのロック時間を抑える）
+BACKFILL_BATCH_SIZE = 10000
+
+# Chainlit のデータレイヤーは ISO 8601 文字列を読み書きするため文字列の列は残し、
+# ソート・インデックス用に timestamptz の列をトリガーで同期する
+TIMESTAMP_COLUMNS = {
+    'threads': {'createdAt': 'createdAtTs'},
+    'steps': {'createdAt': 'createdAtTs', 'start': 'startTs', 'end': 'endTs'},
+}
+
+INDEXES = [
+    ('ix_threads_userId_createdAtTs', 'threads', ['"userId"', '"createdAtTs" DESC']),
+    ('ix_threads_userIdentifier_createdAtTs', 'threads', ['"userIdentifier"', '"createdAtTs" DESC']),
+    ('ix_steps_threadId_createdAtTs', 'steps', ['"threadId"', '"createdAtTs"']),
+    ('ix_steps_parentId', 'steps', ['"parentId"']),
+    ('ix_elements_threadId', 'elements', ['"threadId"']),
+    ('ix_elements_forId', 'elements', ['"forId"']),
+    ('ix_feedbacks_forId', 'feedbacks', ['"forId"']),
+    ('ix_feedbacks_threadId', 'feedbacks', ['"threadId"']),
+]
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # 不正な文字列でも書き込みが失敗しないよう、変換できない値は NULL にする
+    op.execute("""
+        CREATE OR REPLACE FUNCTION parse_timestamptz(value text) RETURNS timestamptz
+        LANGUAGE plpgsql STABLE AS $$
+        BEGIN
+            RETURN value::timestamptz;
+        EXCEPTION WHEN others THEN
+            RETURN NULL;
+        END;
+        $$
+    """)
+
+    for table, columns in TIMESTAMP_COLUMNS.items():
+        for source, target in columns.items():
+            op.add_column(table, sa.Column(target, sa.DateTime(timezone=True), nullable=True))
+
+        assignments = '\n'.join(
+            f'NEW."{target}" := parse_timestamptz(NEW."{source}");'
+            for source, target in columns.items()
+        )
+        op.execute(f"""
+            CREATE OR REPLACE FUNCTION {table}_sync_timestamps() RETURNS trigger
+            LANGUAGE plpgsql AS $$
+            BEGIN
+                {assignments}
+                RETURN NEW;
+            END;
+            $$
+        """)
+        op.execute(f"""
+            CREATE TRIGGER {table}_sync_timestamps
+            BEFORE INSERT OR UPDATE ON {table}
+            FOR EACH ROW EXECUTE FUNCTION {table}_sync_timestamps()
+        """)
+
+    # 既存行のバックフィルとインデックス作成は小さなトランザクションに分けてオンラインで行う
+    with op.get_context().autocommit_block():
+        for table, columns in TIMESTAMP_COLUMNS.items():
+            _backfill(table, columns)
+
+        for name, table, columns in INDEXES:
+            op.execute(f'CREATE INDEX CONCURRENTLY IF NOT EXISTS "{name}" ON {table} ({", ".join(columns)})')
+
+
+def _backfill(table: str, columns: dict) -> None:
+    """主キー順に BACKFILL_BATCH_SIZE 件ずつ timestamptz 列を埋めます"""
+    conn = op.get_bind()
+    assignments = ', '.join(f'"{target}" = parse_timestamptz("{source}")' for source, target in columns.items())
+    last_id = None
+    while True:
+        ids = conn.execute(
+            sa.text(f'SELECT id FROM {table} WHERE (CAST(:last_id AS uuid) IS NULL OR id > CAST(:last_id AS uuid)) ORDER BY id LIMIT :limit'),
+            {'last_id': last_id, 'limit': BACKFILL_BATCH_SIZE},
+        ).scalars().all()
+        if not ids:
+            break
+        conn.execute(
+            sa.text(f'UPDATE {table} SET {assignments} WHERE id = ANY(CAST(:ids AS uuid[]))'),
+            {'ids': [str(i) for i in ids]},
+        )
+        last_id = str(ids[-1])
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    with op.get_context().autocommit_block():
+        for name, _, _ in reversed(INDEXES):
+            op.execute(f'DROP INDEX CONCURRENTLY IF EXISTS "{name}"')
+
+    for table, columns in TIMESTAMP_COLUMNS.items():
+        op.execute(f'DROP TRIGGER IF EXISTS {table}_sync_timestamps ON {table}')
+        op.execute(f'DROP FUNCTION IF EXISTS {table}_sync_timestamps()')
+        for target in columns.values():
+            op.drop_column(table, target)
+    op.execute('DROP FUNCTION IF EXISTS parse_timestamptz(text)')
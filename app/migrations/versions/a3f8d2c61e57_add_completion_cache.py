@@ -0,0 +1,38 @@
+"""add-completion-cache
+
+Revision ID: a3f8d2c61e57
+Revises: 7c2e9a4f1b3d
+Create Date: 2025-04-08 15:41:09.338271
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+# revision identifiers, used by Alembic.
+revision: str = 'a3f8d2c61e57'
+down_revision: Union[str, None] = '7c2e9a4f1b3d'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table('completion_cache',
+    sa.Column('key', sa.String(), nullable=False),
+    sa.Column('model', sa.String(), nullable=True),
+    sa.Column('tokens', postgresql.JSONB(astext_type=sa.Text()), nullable=False),
+    sa.Column('hits', sa.Integer(), nullable=False, server_default='0'),
+    sa.Column('createdAt', sa.DateTime(timezone=True), server_default=sa.text('now()'), nullable=False),
+    sa.Column('expiresAt', sa.DateTime(timezone=True), nullable=False),
+    sa.PrimaryKeyConstraint('key')
+    )
+    op.create_index('ix_completion_cache_expiresAt', 'completion_cache', ['expiresAt'], unique=False)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('ix_completion_cache_expiresAt', table_name='completion_cache')
+    op.drop_table('completion_cache')
@@ -0,0 +1,332 @@
+"""add-response-rollups
+
+Revision ID: a8d3f1c7e9b2
+Revises: f7a2c4e8b6d3
+Create Date: 2025-04-24 10:12:37.482915
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+from settings import Config
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'a8d3f1c7e9b2'
+down_revision: Union[str, None] = 'f7a2c4e8b6d3'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# バックフィル1回あたりの集計件数（1トランザクションあたりのロック時間を抑える）
+BACKFILL_BATCH_SIZE = 5000
+
+# 日次の集計の日付はマイグレーション時の USAGE_TIMEZONE で決める（usage_daily と同じ日付）。
+# 後から変更した場合は集計を空にしてバックフィルし直す
+ROLLUP_TIMEZONE = Config.USAGE_TIMEZONE
+
+COUNTERS = (
+    'responses', 'promptTokens', 'completionTokens', 'ttftSecondsSum', 'durationSecondsSum',
+    'feedbackUp', 'feedbackDown',
+)
+
+# 集計テーブルと、時刻 {ts} から集計単位の値を求める式
+ROLLUPS = [
+    ('response_rollup_hourly', 'bucket', "date_trunc('hour', {ts}, 'UTC')"),
+    ('response_rollup_daily', 'day', 'rollup_day({ts})'),
+]
+
+# 応答（使用量が記録された generation）ごとの値
+GENERATION_VALUES = {
+    'promptTokens': "rollup_number({g}, 'inputTokenCount')",
+    'completionTokens': "rollup_number({g}, 'outputTokenCount')",
+    'ttftSecondsSum': "rollup_number({g}, 'ttFirstToken') / 1000",
+    'durationSecondsSum': "rollup_number({g}, 'duration')",
+}
+
+
+def _upsert(table: str, key: str, rows: str) -> str:
+    """集計テーブルに rows（キー 3 列と COUNTERS の順の VALUES / SELECT）を加算する SQL"""
+    columns = ', '.join(f'"{c}"' for c in (key, 'userIdentifier', 'model') + COUNTERS)
+    updates = ', '.join(f'"{c}" = r."{c}" + EXCLUDED."{c}"' for c in COUNTERS)
+    return f"""
+        INSERT INTO {table} AS r ({columns})
+        {rows}
+        ON CONFLICT ("{key}", "userIdentifier", "model") DO UPDATE SET {updates}, "updatedAt" = now()
+    """
+
+
+def _table(table: str, key: str, key_type) -> None:
+    op.create_table(table,
+    sa.Column(key, key_type, nullable=False),
+    sa.Column('userIdentifier', sa.String(), server_default='', nullable=False),
+    sa.Column('model', sa.String(), server_default='', nullable=False),
+    sa.Column('responses', sa.Integer(), server_default='0', nullable=False),
+    sa.Column('promptTokens', sa.BigInteger(), server_default='0', nullable=False),
+    sa.Column('completionTokens', sa.BigInteger(), server_default='0', nullable=False),
+    sa.Column('ttftSecondsSum', sa.Float(), server_default='0', nullable=False),
+    sa.Column('durationSecondsSum', sa.Float(), server_default='0', nullable=False),
+    sa.Column('feedbackUp', sa.Integer(), server_default='0', nullable=False),
+    sa.Column('feedbackDown', sa.Integer(), server_default='0', nullable=False),
+    sa.Column('updatedAt', sa.DateTime(timezone=True), server_default=sa.text('now()'), nullable=False),
+    sa.PrimaryKeyConstraint(key, 'userIdentifier', 'model')
+    )
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # 応答の使用量と 👍/👎 をスレッドの所有者・モデル・時間（日）ごとに加算しておき、
+    # ダッシュボードの集計で steps・feedbacks・threads を結合して走査しないようにする
+    _table('response_rollup_hourly', 'bucket', sa.DateTime(timezone=True))
+    _table('response_rollup_daily', 'day', sa.Date())
+    op.create_table('response_rollup_backfill',
+    sa.Column('source', sa.String(), nullable=False),
+    sa.Column('lastId', sa.UUID(), nullable=True),
+    sa.PrimaryKeyConstraint('source')
+    )
+
+    timezone = ROLLUP_TIMEZONE.replace("'", "''")
+    op.execute(f"""
+        CREATE OR REPLACE FUNCTION rollup_day(ts timestamptz) RETURNS date
+        LANGUAGE sql IMMUTABLE PARALLEL SAFE AS $$
+            SELECT (ts AT TIME ZONE '{timezone}')::date
+        $$
+    """)
+    # generation は任意の JSON のため、数値でない値は 0 として扱いトリガーでエラーにしない
+    op.execute("""
+        CREATE OR REPLACE FUNCTION rollup_number(generation jsonb, key text) RETURNS float8
+        LANGUAGE sql IMMUTABLE PARALLEL SAFE AS $$
+            SELECT CASE WHEN jsonb_typeof(generation -> key) = 'number' THEN (generation ->> key)::float8 ELSE 0 END
+        $$
+    """)
+    values = (
+        "VALUES ({ts}, COALESCE(identifier, ''), COALESCE(model_name, ''), response_count, prompt_tokens, "
+        "completion_tokens, ttft_seconds, duration_seconds, feedback_up, feedback_down)"
+    )
+    op.execute(f"""
+        CREATE OR REPLACE FUNCTION rollup_add(
+            ts timestamptz, identifier text, model_name text, response_count int, prompt_tokens bigint,
+            completion_tokens bigint, ttft_seconds float8, duration_seconds float8, feedback_up int, feedback_down int
+        ) RETURNS void
+        LANGUAGE plpgsql AS $$
+        BEGIN
+            IF ts IS NULL THEN
+                RETURN;
+            END IF;
+            {';'.join(_upsert(table, key, values.format(ts=expression.format(ts='ts'))) for table, key, expression in ROLLUPS)};
+        END;
+        $$
+    """)
+    generation = ', '.join(
+        f'(direction * {GENERATION_VALUES[c].format(g="generation")}){"::bigint" if "Tokens" in c else ""}'
+        for c in COUNTERS[1:5]
+    )
+    op.execute(f"""
+        CREATE OR REPLACE FUNCTION rollup_generation(ts timestamptz, identifier text, generation jsonb, direction int) RETURNS void
+        LANGUAGE sql AS $$
+            SELECT rollup_add(ts, identifier, generation ->> 'model', direction, {generation}, 0, 0)
+        $$
+    """)
+    # フィードバックは対象のステップ（応答）の時刻とモデルに加算する。ステップが無い場合は数えない
+    op.execute("""
+        CREATE OR REPLACE FUNCTION rollup_feedback(for_id uuid, identifier text, value int, direction int) RETURNS void
+        LANGUAGE sql AS $$
+            SELECT rollup_add(
+                s."createdAtTs", identifier, s."generation" ->> 'model', 0, 0, 0, 0, 0,
+                direction * (value > 0)::int, direction * (value <= 0)::int
+            )
+            FROM steps s WHERE s."id" = for_id
+        $$
+    """)
+    # バックフィル中は未集計の範囲の行をトリガーでは数えない（バックフィルが最新の値で数える）。
+    # 進捗の行を共有ロックし、バックフィルの各バッチがコミット済みの変更だけを読むようにする
+    op.execute("""
+        CREATE OR REPLACE FUNCTION rollup_pending(table_name text, row_id uuid) RETURNS boolean
+        LANGUAGE plpgsql AS $$
+        DECLARE
+            last_id uuid;
+        BEGIN
+            SELECT "lastId" INTO last_id FROM response_rollup_backfill WHERE "source" = table_name FOR SHARE;
+            RETURN FOUND AND (last_id IS NULL OR row_id > last_id);
+        END;
+        $$
+    """)
+
+    # 退避・復元（retention.py）は SET LOCAL app.skip_rollup = 'on' で集計から除く
+    op.execute("""
+        CREATE OR REPLACE FUNCTION steps_rollup() RETURNS trigger
+        LANGUAGE plpgsql AS $$
+        DECLARE
+            identifier text;
+        BEGIN
+            IF current_setting('app.skip_rollup', true) = 'on'
+                OR (TG_OP = 'UPDATE' AND OLD."generation" IS NOT DISTINCT FROM NEW."generation")
+                OR NOT (COALESCE(NEW."generation" ? 'inputTokenCount', false)
+                    OR COALESCE(OLD."generation" ? 'inputTokenCount', false))
+                OR rollup_pending('steps', NEW."id") THEN
+                RETURN NULL;
+            END IF;
+            SELECT "userIdentifier" INTO identifier FROM threads WHERE "id" = NEW."threadId";
+            IF COALESCE(OLD."generation" ? 'inputTokenCount', false) THEN
+                PERFORM rollup_generation(OLD."createdAtTs", identifier, OLD."generation", -1);
+            END IF;
+            IF COALESCE(NEW."generation" ? 'inputTokenCount', false) THEN
+                PERFORM rollup_generation(NEW."createdAtTs", identifier, NEW."generation", 1);
+            END IF;
+            RETURN NULL;
+        END;
+        $$
+    """)
+    # スレッドの削除（DataLayer.delete_thread）は app.skip_rollup で、ユーザーの削除に伴う削除
+    # （トリガーの入れ子の中の削除）は入れ子の深さで判定し、どちらも集計から引かない
+    op.execute("""
+        CREATE OR REPLACE FUNCTION feedbacks_rollup() RETURNS trigger
+        LANGUAGE plpgsql AS $$
+        BEGIN
+            IF current_setting('app.skip_rollup', true) = 'on'
+                OR (TG_OP = 'DELETE' AND pg_trigger_depth() > 1)
+                OR (TG_OP = 'UPDATE' AND OLD."value" IS NOT DISTINCT FROM NEW."value"
+                    AND OLD."forId" IS NOT DISTINCT FROM NEW."forId")
+                OR rollup_pending('feedbacks', COALESCE(NEW."id", OLD."id")) THEN
+                RETURN NULL;
+            END IF;
+            IF TG_OP <> 'INSERT' THEN
+                PERFORM rollup_feedback(
+                    OLD."forId", (SELECT "userIdentifier" FROM threads WHERE "id" = OLD."threadId"), OLD."value", -1
+                );
+            END IF;
+            IF TG_OP <> 'DELETE' THEN
+                PERFORM rollup_feedback(
+                    NEW."forId", (SELECT "userIdentifier" FROM threads WHERE "id" = NEW."threadId"), NEW."value", 1
+                );
+            END IF;
+            RETURN NULL;
+        END;
+        $$
+    """)
+    # Chainlit はスレッドの所有者をステップの書き込みと並行して設定するため、後から設定された場合は付け替える
+    op.execute("""
+        CREATE OR REPLACE FUNCTION threads_rollup_owner() RETURNS trigger
+        LANGUAGE plpgsql AS $$
+        BEGIN
+            IF current_setting('app.skip_rollup', true) = 'on' THEN
+                RETURN NULL;
+            END IF;
+            PERFORM rollup_generation(s."createdAtTs", OLD."userIdentifier", s."generation", -1),
+                rollup_generation(s."createdAtTs", NEW."userIdentifier", s."generation", 1)
+            FROM steps s
+            WHERE s."threadId" = NEW."id" AND s."generation" ? 'inputTokenCount' AND NOT rollup_pending('steps', s."id");
+            PERFORM rollup_feedback(f."forId", OLD."userIdentifier", f."value", -1),
+                rollup_feedback(f."forId", NEW."userIdentifier", f."value", 1)
+            FROM feedbacks f
+            WHERE f."threadId" = NEW."id" AND NOT rollup_pending('feedbacks', f."id");
+            RETURN NULL;
+        END;
+        $$
+    """)
+
+    # 既存行は主キー順に BACKFILL_BATCH_SIZE 件ずつ集計する。進捗の行をロックしてから
+    # 新しいスナップショットで読むため、トリガーと二重に数えたり数え漏らしたりしない
+    step_generation = 's."generation"'
+    steps_values = ', '.join(
+        ['count(*)'] + [f'sum({GENERATION_VALUES[c].format(g=step_generation)})' for c in COUNTERS[1:5]] + ['0', '0']
+    )
+    feedback_values = ', '.join(
+        ['0', '0', '0', '0', '0', 'count(*) FILTER (WHERE f."value" > 0)', 'count(*) FILTER (WHERE f."value" <= 0)']
+    )
+    steps_rows = f"""
+        SELECT {{key}}, COALESCE(t."userIdentifier", ''), COALESCE(s."generation" ->> 'model', ''), {steps_values}
+        FROM steps s LEFT JOIN threads t ON t."id" = s."threadId"
+        WHERE s."id" = ANY(ids) AND s."generation" ? 'inputTokenCount' AND s."createdAtTs" IS NOT NULL
+        GROUP BY 1, 2, 3
+    """
+    feedbacks_rows = f"""
+        SELECT {{key}}, COALESCE(t."userIdentifier", ''), COALESCE(s."generation" ->> 'model', ''), {feedback_values}
+        FROM feedbacks f
+        JOIN steps s ON s."id" = f."forId"
+        LEFT JOIN threads t ON t."id" = f."threadId"
+        WHERE f."id" = ANY(ids) AND s."createdAtTs" IS NOT NULL
+        GROUP BY 1, 2, 3
+    """
+    steps_upserts = ';'.join(
+        _upsert(table, key, steps_rows.format(key=expression.format(ts='s."createdAtTs"'))) for table, key, expression in ROLLUPS
+    )
+    feedbacks_upserts = ';'.join(
+        _upsert(table, key, feedbacks_rows.format(key=expression.format(ts='s."createdAtTs"'))) for table, key, expression in ROLLUPS
+    )
+    op.execute(f"""
+        CREATE OR REPLACE FUNCTION rollup_backfill_batch(table_name text, batch_size int) RETURNS boolean
+        LANGUAGE plpgsql AS $$
+        DECLARE
+            last_id uuid;
+            ids uuid[];
+        BEGIN
+            SELECT "lastId" INTO last_id FROM response_rollup_backfill WHERE "source" = table_name FOR UPDATE;
+            IF NOT FOUND THEN
+                RETURN false;
+            END IF;
+            EXECUTE format('SELECT array_agg("id") FROM (SELECT "id" FROM %I WHERE "id" > $1 ORDER BY "id" LIMIT $2) b', table_name)
+                INTO ids USING COALESCE(last_id, '00000000-0000-0000-0000-000000000000'), batch_size;
+            IF ids IS NULL THEN
+                DELETE FROM response_rollup_backfill WHERE "source" = table_name;
+                RETURN false;
+            END IF;
+            IF table_name = 'steps' THEN
+                {steps_upserts};
+            ELSE
+                {feedbacks_upserts};
+            END IF;
+            UPDATE response_rollup_backfill SET "lastId" = ids[array_length(ids, 1)] WHERE "source" = table_name;
+            RETURN true;
+        END;
+        $$
+    """)
+    op.execute("""INSERT INTO response_rollup_backfill ("source") VALUES ('steps'), ('feedbacks')""")
+
+    op.execute("""
+        CREATE TRIGGER steps_rollup
+        AFTER INSERT OR UPDATE OF "generation" ON steps
+        FOR EACH ROW EXECUTE FUNCTION steps_rollup()
+    """)
+    op.execute("""
+        CREATE TRIGGER feedbacks_rollup
+        AFTER INSERT OR UPDATE OF "value", "forId" OR DELETE ON feedbacks
+        FOR EACH ROW EXECUTE FUNCTION feedbacks_rollup()
+    """)
+    op.execute("""
+        CREATE TRIGGER threads_rollup_owner
+        AFTER UPDATE OF "userIdentifier" ON threads
+        FOR EACH ROW WHEN (OLD."userIdentifier" IS DISTINCT FROM NEW."userIdentifier")
+        EXECUTE FUNCTION threads_rollup_owner()
+    """)
+
+    # トリガーを有効にしてから、既存行を小さなトランザクションに分けて集計する
+    with op.get_context().autocommit_block():
+        conn = op.get_bind()
+        for table in ('steps', 'feedbacks'):
+            while conn.execute(
+                sa.text('SELECT rollup_backfill_batch(:table, :limit)'),
+                {'table': table, 'limit': BACKFILL_BATCH_SIZE},
+            ).scalar():
+                pass
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.execute('DROP TRIGGER IF EXISTS threads_rollup_owner ON threads')
+    op.execute('DROP TRIGGER IF EXISTS feedbacks_rollup ON feedbacks')
+    op.execute('DROP TRIGGER IF EXISTS steps_rollup ON steps')
+    op.execute('DROP FUNCTION IF EXISTS threads_rollup_owner()')
+    op.execute('DROP FUNCTION IF EXISTS feedbacks_rollup()')
+    op.execute('DROP FUNCTION IF EXISTS steps_rollup()')
+    op.execute('DROP FUNCTION IF EXISTS rollup_backfill_batch(text, int)')
+    op.execute('DROP FUNCTION IF EXISTS rollup_pending(text, uuid)')
+    op.execute('DROP FUNCTION IF EXISTS rollup_feedback(uuid, text, int, int)')
+    op.execute('DROP FUNCTION IF EXISTS rollup_generation(timestamptz, text, jsonb, int)')
+    op.execute('DROP FUNCTION IF EXISTS rollup_add(timestamptz, text, text, int, bigint, bigint, float8, float8, int, int)')
+    op.execute('DROP FUNCTION IF EXISTS rollup_number(jsonb, text)')
+    op.execute('DROP FUNCTION IF EXISTS rollup_day(timestamptz)')
+    op.drop_table('response_rollup_backfill')
+    op.drop_table('response_rollup_daily')
+    op.drop_table('response_rollup_hourly')
@@ -0,0 +1,28 @@
+"""add-sizebytes-to-elements
+
+Revision ID: b6d41e9c2f08
+Revises: a3f8d2c61e57
+Create Date: 2025-04-09 10:12:44.517203
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'b6d41e9c2f08'
+down_revision: Union[str, None] = 'a3f8d2c61e57'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column('elements', sa.Column('sizeBytes', sa.BigInteger(), nullable=True))
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_column('elements', 'sizeBytes')
@@ -0,0 +1,37 @@
+"""thread-list-nulls-last
+
+Revision ID: b9e4c2a7d5f1
+Revises: a8d3f1c7e9b2
+Create Date: 2025-04-25 10:14:02.318604
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'b9e4c2a7d5f1'
+down_revision: Union[str, None] = 'a8d3f1c7e9b2'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# スレッド一覧は ("createdAtTs" DESC NULLS LAST, "id" DESC) の順にページングするため、
+# 同じ並びのインデックスに作り直す（日時の無いスレッドは最後のページに並ぶ）
+OLD_INDEX = ('ix_threads_userId_createdAtTs', '"userId", "createdAtTs" DESC')
+NEW_INDEX = ('ix_threads_userId_createdAtTs_id', '"userId", "createdAtTs" DESC NULLS LAST, "id" DESC')
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    with op.get_context().autocommit_block():
+        op.execute(f'CREATE INDEX CONCURRENTLY IF NOT EXISTS "{NEW_INDEX[0]}" ON threads ({NEW_INDEX[1]})')
+        op.execute(f'DROP INDEX CONCURRENTLY IF EXISTS "{OLD_INDEX[0]}"')
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    with op.get_context().autocommit_block():
+        op.execute(f'CREATE INDEX CONCURRENTLY IF NOT EXISTS "{OLD_INDEX[0]}" ON threads ({OLD_INDEX[1]})')
+        op.execute(f'DROP INDEX CONCURRENTLY IF EXISTS "{NEW_INDEX[0]}"')
@@ -0,0 +1,36 @@
+"""add-session-state
+
+Revision ID: c4e7a1d9b3f5
+Revises: b6d41e9c2f08
+Create Date: 2025-04-14 10:12:37.514902
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+# revision identifiers, used by Alembic.
+revision: str = 'c4e7a1d9b3f5'
+down_revision: Union[str, None] = 'b6d41e9c2f08'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table('session_state',
+    sa.Column('key', sa.String(), nullable=False),
+    sa.Column('data', postgresql.JSONB(astext_type=sa.Text()), nullable=False),
+    sa.Column('updatedAt', sa.DateTime(timezone=True), server_default=sa.text('now()'), nullable=False),
+    sa.Column('expiresAt', sa.DateTime(timezone=True), nullable=False),
+    sa.PrimaryKeyConstraint('key')
+    )
+    op.create_index('ix_session_state_expiresAt', 'session_state', ['expiresAt'], unique=False)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('ix_session_state_expiresAt', table_name='session_state')
+    op.drop_table('session_state')
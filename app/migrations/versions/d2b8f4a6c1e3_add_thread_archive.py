@@ -0,0 +1,39 @@
+"""add-thread-archive
+
+Revision ID: d2b8f4a6c1e3
+Revises: c4e7a1d9b3f5
+Create Date: 2025-04-16 09:41:03.228417
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'd2b8f4a6c1e3'
+down_revision: Union[str, None] = 'c4e7a1d9b3f5'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column('threads', sa.Column('archiveKey', sa.String(), nullable=True))
+    op.add_column('threads', sa.Column('archivedAt', sa.DateTime(timezone=True), nullable=True))
+    op.add_column('threads', sa.Column('restoredAt', sa.DateTime(timezone=True), nullable=True))
+    # 孤立した Blob を探すための objectKey / archiveKey の検索用（オンラインで作成する）
+    with op.get_context().autocommit_block():
+        op.execute('CREATE INDEX CONCURRENTLY IF NOT EXISTS "ix_threads_archiveKey" ON threads ("archiveKey") WHERE "archiveKey" IS NOT NULL')
+        op.execute('CREATE INDEX CONCURRENTLY IF NOT EXISTS "ix_elements_objectKey" ON elements ("objectKey")')
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    with op.get_context().autocommit_block():
+        op.execute('DROP INDEX CONCURRENTLY IF EXISTS "ix_elements_objectKey"')
+        op.execute('DROP INDEX CONCURRENTLY IF EXISTS "ix_threads_archiveKey"')
+    op.drop_column('threads', 'restoredAt')
+    op.drop_column('threads', 'archivedAt')
+    op.drop_column('threads', 'archiveKey')
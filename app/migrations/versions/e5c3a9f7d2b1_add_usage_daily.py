@@ -0,0 +1,38 @@
+"""add-usage-daily
+
+Revision ID: e5c3a9f7d2b1
+Revises: d2b8f4a6c1e3
+Create Date: 2025-04-18 11:05:42.806113
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'e5c3a9f7d2b1'
+down_revision: Union[str, None] = 'd2b8f4a6c1e3'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table('usage_daily',
+    sa.Column('userIdentifier', sa.String(), nullable=False),
+    sa.Column('day', sa.Date(), nullable=False),
+    sa.Column('requests', sa.Integer(), server_default='0', nullable=False),
+    sa.Column('promptTokens', sa.BigInteger(), server_default='0', nullable=False),
+    sa.Column('completionTokens', sa.BigInteger(), server_default='0', nullable=False),
+    sa.Column('ttftSecondsSum', sa.Float(), server_default='0', nullable=False),
+    sa.Column('durationSecondsSum', sa.Float(), server_default='0', nullable=False),
+    sa.Column('updatedAt', sa.DateTime(timezone=True), server_default=sa.text('now()'), nullable=False),
+    sa.PrimaryKeyConstraint('userIdentifier', 'day')
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_table('usage_daily')
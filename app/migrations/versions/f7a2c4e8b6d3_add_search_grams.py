@@ -0,0 +1,160 @@
+"""add-search-grams
+
+Revision ID: f7a2c4e8b6d3
+Revises: e5c3a9f7d2b1
+Create Date: 2025-04-22 14:38:09.517264
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'f7a2c4e8b6d3'
+down_revision: Union[str, None] = 'e5c3a9f7d2b1'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# バックフィル1回あたりの更新件数（1トランザクションあたりのロック時間を抑える）
+BACKFILL_BATCH_SIZE = 5000
+
+INDEXES = [
+    ('ix_threads_searchGrams', 'threads'),
+    ('ix_steps_searchGrams', 'steps'),
+]
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # 日本語は単語の区切りが無いため、全文検索の辞書や pg_trgm（3 文字単位）ではなく
+    # NFKC 正規化・小文字化した文字列の 2 文字ずつの N-gram を配列にして GIN で索引する
+    op.execute("""
+        CREATE OR REPLACE FUNCTION search_normalize(value text) RETURNS text
+        LANGUAGE sql IMMUTABLE PARALLEL SAFE AS $$
+            SELECT lower(normalize(COALESCE(value, ''), NFKC))
+        $$
+    """)
+    # 空白を含まない 2 文字の並びを重複なく集める。substr() で 1 文字ずつずらすとマルチバイト文字列では
+    # 長さの 2 乗の時間がかかるため、本文と「空白で区切った各語の先頭 1 文字を除いた本文」から
+    # 重ならない 2 文字をそれぞれ正規表現で取り出して合わせる（例: abcde -> ab, cd と bc, de）
+    op.execute("""
+        CREATE OR REPLACE FUNCTION search_grams(value text) RETURNS text[]
+        LANGUAGE sql IMMUTABLE PARALLEL SAFE AS $$
+            SELECT COALESCE(array_agg(DISTINCT m[1]), '{}')
+            FROM (SELECT search_normalize(value) AS doc) n
+            CROSS JOIN LATERAL (
+                SELECT n.doc
+                UNION ALL
+                SELECT regexp_replace(n.doc, '(^|\\s)\\S', '\\1', 'g')
+            ) AS shifted(doc)
+            CROSS JOIN LATERAL regexp_matches(shifted.doc, '\\S\\S', 'g') AS m
+        $$
+    """)
+    # ステップの N-gram にはスレッドの所有者を表す要素（2 文字の N-gram とは重ならない）を加え、
+    # ユーザーで絞り込んだ検索も 1 回の GIN の検索で済むようにする。
+    # 要素ごとの出現頻度は独立とみなして見積もられるため、所有者の条件が別の列にあると
+    # よく使われる語で全ユーザー分の一致を読んでから絞り込む実行計画になりやすい
+    op.execute("""
+        CREATE OR REPLACE FUNCTION search_owner(identifier text) RETURNS text[]
+        LANGUAGE sql IMMUTABLE PARALLEL SAFE AS $$
+            SELECT CASE WHEN identifier IS NULL THEN '{}'::text[] ELSE ARRAY['user:' || identifier] END
+        $$
+    """)
+
+    op.add_column('threads', sa.Column('searchGrams', postgresql.ARRAY(sa.Text()), nullable=True))
+    op.add_column('steps', sa.Column('searchGrams', postgresql.ARRAY(sa.Text()), nullable=True))
+    op.execute("""
+        CREATE OR REPLACE FUNCTION threads_sync_search() RETURNS trigger
+        LANGUAGE plpgsql AS $$
+        BEGIN
+            NEW."searchGrams" := search_grams(NEW."name");
+            RETURN NEW;
+        END;
+        $$
+    """)
+    op.execute("""
+        CREATE TRIGGER threads_sync_search
+        BEFORE INSERT OR UPDATE OF "name" ON threads
+        FOR EACH ROW EXECUTE FUNCTION threads_sync_search()
+    """)
+    op.execute("""
+        CREATE OR REPLACE FUNCTION steps_sync_search() RETURNS trigger
+        LANGUAGE plpgsql AS $$
+        BEGIN
+            NEW."searchGrams" := search_grams(NEW."output")
+                || search_owner((SELECT "userIdentifier" FROM threads WHERE "id" = NEW."threadId"));
+            RETURN NEW;
+        END;
+        $$
+    """)
+    op.execute("""
+        CREATE TRIGGER steps_sync_search
+        BEFORE INSERT OR UPDATE OF "output", "threadId" ON steps
+        FOR EACH ROW EXECUTE FUNCTION steps_sync_search()
+    """)
+    # Chainlit はスレッドの所有者をステップの書き込みと並行して設定するため、後から設定された場合は作り直す
+    op.execute("""
+        CREATE OR REPLACE FUNCTION threads_sync_search_owner() RETURNS trigger
+        LANGUAGE plpgsql AS $$
+        BEGIN
+            UPDATE steps SET "searchGrams" = search_grams("output") || search_owner(NEW."userIdentifier")
+            WHERE "threadId" = NEW."id";
+            RETURN NULL;
+        END;
+        $$
+    """)
+    op.execute("""
+        CREATE TRIGGER threads_sync_search_owner
+        AFTER UPDATE OF "userIdentifier" ON threads
+        FOR EACH ROW WHEN (OLD."userIdentifier" IS DISTINCT FROM NEW."userIdentifier")
+        EXECUTE FUNCTION threads_sync_search_owner()
+    """)
+
+    # 既存行のバックフィルとインデックス作成は小さなトランザクションに分けてオンラインで行う
+    with op.get_context().autocommit_block():
+        _backfill('threads', 'search_grams(t."name")')
+        _backfill(
+            'steps',
+            'search_grams(t."output") || search_owner((SELECT "userIdentifier" FROM threads WHERE "id" = t."threadId"))',
+        )
+
+        for name, table in INDEXES:
+            op.execute(f'CREATE INDEX CONCURRENTLY IF NOT EXISTS "{name}" ON {table} USING gin ("searchGrams")')
+
+
+def _backfill(table: str, expression: str) -> None:
+    """主キー順に BACKFILL_BATCH_SIZE 件ずつ "searchGrams" を埋めます"""
+    conn = op.get_bind()
+    last_id = None
+    while True:
+        ids = conn.execute(
+            sa.text(f'SELECT id FROM {table} WHERE (CAST(:last_id AS uuid) IS NULL OR id > CAST(:last_id AS uuid)) ORDER BY id LIMIT :limit'),
+            {'last_id': last_id, 'limit': BACKFILL_BATCH_SIZE},
+        ).scalars().all()
+        if not ids:
+            break
+        conn.execute(
+            sa.text(f'UPDATE {table} AS t SET "searchGrams" = {expression} WHERE t.id = ANY(CAST(:ids AS uuid[]))'),
+            {'ids': [str(i) for i in ids]},
+        )
+        last_id = str(ids[-1])
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    with op.get_context().autocommit_block():
+        for name, _ in reversed(INDEXES):
+            op.execute(f'DROP INDEX CONCURRENTLY IF EXISTS "{name}"')
+
+    op.execute('DROP TRIGGER IF EXISTS threads_sync_search_owner ON threads')
+    op.execute('DROP FUNCTION IF EXISTS threads_sync_search_owner()')
+    for table in ('steps', 'threads'):
+        op.execute(f'DROP TRIGGER IF EXISTS {table}_sync_search ON {table}')
+        op.execute(f'DROP FUNCTION IF EXISTS {table}_sync_search()')
+        op.drop_column(table, 'searchGrams')
+    op.execute('DROP FUNCTION IF EXISTS search_owner(text)')
+    op.execute('DROP FUNCTION IF EXISTS search_grams(text)')
+    op.execute('DROP FUNCTION IF EXISTS search_normalize(text)')
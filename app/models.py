@@ -1,7 +1,9 @@
 import uuid
-from sqlalchemy import Column, String, ForeignKey, Boolean, Integer, ARRAY, Text
+from sqlalchemy import Column, String, ForeignKey, Boolean, Integer, BigInteger, ARRAY, Text, DateTime, Date, Float, Index, func
 from sqlalchemy.dialects.postgresql import UUID, JSONB
-from settings import Base
+from sqlalchemy.orm import declarative_base
+
+Base = declarative_base()
 
 class User(Base):
     __tablename__ = "users"
@@ -19,17 +21,37 @@ class Thread(Base):
 
     id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
     createdAt = Column(String)
+    # createdAt をトリガーで変換した値（ソート・インデックス用）
+    createdAtTs = Column(DateTime(timezone=True))
     name = Column(String)
     userId = Column(UUID(as_uuid=True), ForeignKey("users.id", ondelete="CASCADE"))
     userIdentifier = Column(String)
     tags = Column(ARRAY(String))
     metadata_ = Column("metadata", JSONB)
+    # ステップを Blob に退避したスレッドのアーカイブ（開いた時に復元する）
+    archiveKey = Column(String)
+    archivedAt = Column(DateTime(timezone=True))
+    # 復元した日時（保持期間はここからも数え直す）
+    restoredAt = Column(DateTime(timezone=True))
+    # name の 2 文字ずつの N-gram（検索用にトリガーで同期する）
+    searchGrams = Column(ARRAY(Text))
 
     def __repr__(self):
         return f"<Thread(id={self.id}, name={self.name})>"
 
+# サイドバーのスレッド一覧は新しい順に取得するため降順のインデックスにする
+Index("ix_threads_userId_createdAtTs_id", Thread.userId, Thread.createdAtTs.desc().nulls_last(), Thread.id.desc())
+Index("ix_threads_userIdentifier_createdAtTs", Thread.userIdentifier, Thread.createdAtTs.desc())
+Index("ix_threads_archiveKey", Thread.archiveKey, postgresql_where=Thread.archiveKey.isnot(None))
+Index("ix_threads_searchGrams", Thread.searchGrams, postgresql_using="gin")
+
 class Step(Base):
     __tablename__ = "steps"
+    __table_args__ = (
+        Index("ix_steps_threadId_createdAtTs", "threadId", "createdAtTs"),
+        Index("ix_steps_parentId", "parentId"),
+        Index("ix_steps_searchGrams", "searchGrams", postgresql_using="gin"),
+    )
 
     id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
     name = Column(String, nullable=False)
@@ -46,6 +68,12 @@ class Step(Base):
     createdAt = Column(String)
     start = Column(String)
     end = Column(String)
+    # createdAt / start / end をトリガーで変換した値（ソート・インデックス用）
+    createdAtTs = Column(DateTime(timezone=True))
+    startTs = Column(DateTime(timezone=True))
+    endTs = Column(DateTime(timezone=True))
+    # output の 2 文字ずつの N-gram（検索用にトリガーで同期する）
+    searchGrams = Column(ARRAY(Text))
     generation = Column(JSONB)
     showInput = Column(String)
     language = Column(String)
@@ -57,6 +85,11 @@ class Step(Base):
 
 class Element(Base):
     __tablename__ = "elements"
+    __table_args__ = (
+        Index("ix_elements_threadId", "threadId"),
+        Index("ix_elements_forId", "forId"),
+        Index("ix_elements_objectKey", "objectKey"),
+    )
 
     id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
     threadId = Column(UUID(as_uuid=True), ForeignKey("threads.id", ondelete="CASCADE"))
@@ -67,6 +100,8 @@ class Element(Base):
     display = Column(String)
     objectKey = Column(String)
     size = Column(String)
+    # アップロード時に求めたファイルのバイト数（size は表示サイズ）
+    sizeBytes = Column(BigInteger)
     page = Column(Integer)
     language = Column(String)
     forId = Column(UUID(as_uuid=True))
@@ -78,6 +113,10 @@ class Element(Base):
 
 class Feedback(Base):
     __tablename__ = "feedbacks"
+    __table_args__ = (
+        Index("ix_feedbacks_forId", "forId"),
+        Index("ix_feedbacks_threadId", "threadId"),
+    )
 
     id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
     forId = Column(UUID(as_uuid=True), nullable=False)
@@ -87,3 +126,103 @@ class Feedback(Base):
 
     def __repr__(self):
         return f"<Feedback(id={self.id}, value={self.value})>"
+
+class CompletionCache(Base):
+    __tablename__ = "completion_cache"
+    __table_args__ = (
+        Index("ix_completion_cache_expiresAt", "expiresAt"),
+    )
+
+    # 正規化した会話履歴と chat_settings() のハッシュ
+    key = Column(String, primary_key=True)
+    model = Column(String)
+    tokens = Column(JSONB, nullable=False)
+    hits = Column(Integer, nullable=False, server_default="0")
+    createdAt = Column(DateTime(timezone=True), nullable=False, server_default=func.now())
+    expiresAt = Column(DateTime(timezone=True), nullable=False)
+
+    def __repr__(self):
+        return f"<CompletionCache(key={self.key}, model={self.model})>"
+
+class SessionState(Base):
+    __tablename__ = "session_state"
+    __table_args__ = (
+        Index("ix_session_state_expiresAt", "expiresAt"),
+    )
+
+    # "<種類>:<セッション ID>" 形式のキー
+    key = Column(String, primary_key=True)
+    data = Column(JSONB, nullable=False)
+    updatedAt = Column(DateTime(timezone=True), nullable=False, server_default=func.now())
+    expiresAt = Column(DateTime(timezone=True), nullable=False)
+
+    def __repr__(self):
+        return f"<SessionState(key={self.key})>"
+
+class UsageDaily(Base):
+    __tablename__ = "usage_daily"
+
+    userIdentifier = Column(String, primary_key=True)
+    day = Column(Date, primary_key=True)
+    requests = Column(Integer, nullable=False, server_default="0")
+    promptTokens = Column(BigInteger, nullable=False, server_default="0")
+    completionTokens = Column(BigInteger, nullable=False, server_default="0")
+    # 平均は合計 / requests で求める
+    ttftSecondsSum = Column(Float, nullable=False, server_default="0")
+    durationSecondsSum = Column(Float, nullable=False, server_default="0")
+    updatedAt = Column(DateTime(timezone=True), nullable=False, server_default=func.now())
+
+    def __repr__(self):
+        return f"<UsageDaily(userIdentifier={self.userIdentifier}, day={self.day})>"
+
+class ResponseRollupHourly(Base):
+    """応答の使用量とフィードバックの 1 時間ごとの集計（steps・feedbacks のトリガーで加算）"""
+    __tablename__ = "response_rollup_hourly"
+
+    bucket = Column(DateTime(timezone=True), primary_key=True)
+    # スレッドの所有者と generation のモデル（不明な場合は空文字）
+    userIdentifier = Column(String, primary_key=True, server_default="")
+    model = Column(String, primary_key=True, server_default="")
+    responses = Column(Integer, nullable=False, server_default="0")
+    promptTokens = Column(BigInteger, nullable=False, server_default="0")
+    completionTokens = Column(BigInteger, nullable=False, server_default="0")
+    # 平均は合計 / responses で求める
+    ttftSecondsSum = Column(Float, nullable=False, server_default="0")
+    durationSecondsSum = Column(Float, nullable=False, server_default="0")
+    feedbackUp = Column(Integer, nullable=False, server_default="0")
+    feedbackDown = Column(Integer, nullable=False, server_default="0")
+    updatedAt = Column(DateTime(timezone=True), nullable=False, server_default=func.now())
+
+    def __repr__(self):
+        return f"<ResponseRollupHourly(bucket={self.bucket}, userIdentifier={self.userIdentifier}, model={self.model})>"
+
+class ResponseRollupDaily(Base):
+    """ResponseRollupHourly と同じ集計の日ごと（USAGE_TIMEZONE の日付）の値"""
+    __tablename__ = "response_rollup_daily"
+
+    day = Column(Date, primary_key=True)
+    userIdentifier = Column(String, primary_key=True, server_default="")
+    model = Column(String, primary_key=True, server_default="")
+    responses = Column(Integer, nullable=False, server_default="0")
+    promptTokens = Column(BigInteger, nullable=False, server_default="0")
+    completionTokens = Column(BigInteger, nullable=False, server_default="0")
+    ttftSecondsSum = Column(Float, nullable=False, server_default="0")
+    durationSecondsSum = Column(Float, nullable=False, server_default="0")
+    feedbackUp = Column(Integer, nullable=False, server_default="0")
+    feedbackDown = Column(Integer, nullable=False, server_default="0")
+    updatedAt = Column(DateTime(timezone=True), nullable=False, server_default=func.now())
+
+    def __repr__(self):
+        return f"<ResponseRollupDaily(day={self.day}, userIdentifier={self.userIdentifier}, model={self.model})>"
+
+class ResponseRollupBackfill(Base):
+    """集計のバックフィルの進捗（完了した元テーブルの行は削除される）"""
+    __tablename__ = "response_rollup_backfill"
+
+    # 元のテーブル名（steps / feedbacks）
+    source = Column(String, primary_key=True)
+    # 集計済みの最後の主キー（NULL ならまだ 1 件も集計していない）
+    lastId = Column(UUID(as_uuid=True))
+
+    def __repr__(self):
+        return f"<ResponseRollupBackfill(source={self.source}, lastId={self.lastId})>"
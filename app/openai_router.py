@@ -0,0 +1,198 @@
+import json
+import logging
+import time
+
+import openai
+from openai import AsyncAzureOpenAI
+
+import metrics
+from scheduler import retry_after
+from settings import Config, chat_settings
+from transport import get_openai_http_client
+
+logger = logging.getLogger(__name__)
+
+DEPLOYMENT_REQUESTS = metrics.counter(
+    "openai_deployment_requests_total",
+    "Requests sent to each Azure OpenAI deployment by outcome",
+    labelnames=("deployment", "outcome"),
+)
+DEPLOYMENT_TTFT_SECONDS = metrics.histogram(
+    "openai_deployment_ttft_seconds",
+    "Time to first chunk for each Azure OpenAI deployment",
+    labelnames=("deployment",),
+)
+DEPLOYMENT_FAILOVERS = metrics.counter(
+    "openai_deployment_failovers_total",
+    "Requests moved to another deployment before the first token",
+)
+
+# 別のデプロイメントで再試行する価値のあるエラー
+FAILOVER_ERRORS = (
+    openai.APIConnectionError,
+    openai.RateLimitError,
+    openai.InternalServerError,
+)
+
+
+def load_deployments() -> list[dict]:
+    """
+    AZURE_OPENAI_DEPLOYMENTS（JSON 配列）からデプロイメント一覧を読み込みます。
+    未設定の場合は AZURE_OPENAI_ENDPOINT と chat_settings() のモデルを使用します。
+    """
+    if Config.AZURE_OPENAI_DEPLOYMENTS:
+        deployments = json.loads(Config.AZURE_OPENAI_DEPLOYMENTS)
+    else:
+        deployments = [{"endpoint": Config.AZURE_OPENAI_ENDPOINT}]
+    for i, deployment in enumerate(deployments):
+        deployment.setdefault("name", f"deployment-{i}")
+        deployment.setdefault("api_key", Config.OPENAI_API_KEY)
+        deployment.setdefault("api_version", Config.OPENAI_API_VERSION)
+        deployment.setdefault("model", chat_settings()["model"])
+    return deployments
+
+
+class Deployment:
+    """1つの Azure OpenAI デプロイメントと、その負荷・健全性の状態"""
+
+    def __init__(self, name: str, client, model: str):
+        self.name = name
+        self.client = client
+        self.model = model
+        self.outstanding_tokens = 0
+        self.ttft_ewma = Config.OPENAI_ROUTER_INITIAL_LATENCY
+        self.consecutive_failures = 0
+        self.open_until = 0.0
+        self.half_open = False
+
+    @property
+    def available(self) -> bool:
+        return time.monotonic() >= self.open_until
+
+    def score(self, cost: float) -> float:
+        # 処理中のトークン数が少なく、応答の速いデプロイメントほど小さくなる
+        return (self.outstanding_tokens + cost) * self.ttft_ewma
+
+    def record_success(self, ttft: float) -> None:
+        alpha = Config.OPENAI_ROUTER_LATENCY_ALPHA
+        self.ttft_ewma = alpha * ttft + (1 - alpha) * self.ttft_ewma
+        self.consecutive_failures = 0
+        self.half_open = False
+
+    def record_failure(self, cooldown: float | None = None) -> None:
+        """失敗を記録します。cooldown（Retry-After）があればその間だけ切り離します"""
+        self.consecutive_failures += 1
+        if cooldown is None and (self.half_open or self.consecutive_failures >= Config.OPENAI_CIRCUIT_FAILURE_THRESHOLD):
+            cooldown = Config.OPENAI_CIRCUIT_COOLDOWN
+            logger.warning(f"デプロイメント {self.name} を {cooldown} 秒間切り離します")
+        if cooldown is not None:
+            self.open_until = time.monotonic() + cooldown
+            # クールダウン明けのリクエストが 1 回でも失敗したら再び切り離す
+            self.half_open = True
+
+
+class RoutedStream:
+    """
+    ルーティング先のストリーム。最初のチャンクを先に読み込んだ状態で返し、
+    終了・エラー・close() のいずれかでデプロイメントの処理中トークン数を戻します。
+    """
+
+    def __init__(self, deployment: Deployment, stream, first_chunk, cost: float):
+        self.deployment = deployment
+        self.stream = stream
+        self.cost = cost
+        self._first_chunk = first_chunk
+        self._released = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self._first_chunk is not None:
+            chunk, self._first_chunk = self._first_chunk, None
+            return chunk
+        try:
+            return await self.stream.__anext__()
+        except BaseException:
+            self._release()
+            raise
+
+    def _release(self) -> None:
+        if not self._released:
+            self._released = True
+            self.deployment.outstanding_tokens -= self.cost
+
+    async def close(self) -> None:
+        self._release()
+        await self.stream.close()
+
+
+class DeploymentRouter:
+    """
+    複数のデプロイメントに処理中トークン数と観測レイテンシでリクエストを振り分けます。
+    最初のチャンクを受け取るまでに失敗した場合は別のデプロイメントに切り替え、
+    連続して失敗したデプロイメントは一定時間切り離します（サーキットブレーカー）。
+    """
+
+    def __init__(self, deployments: list[Deployment]):
+        if not deployments:
+            raise ValueError("At least one deployment is required")
+        self.deployments = deployments
+
+    @classmethod
+    def from_config(cls, client_factory=None) -> "DeploymentRouter":
+        client_factory = client_factory or (
+            lambda d: AsyncAzureOpenAI(
+                api_key=d["api_key"],
+                azure_endpoint=d["endpoint"],
+                api_version=d["api_version"],
+                # 429 の再試行は RequestScheduler が全体で調停する
+                max_retries=0,
+                # 接続プールは全デプロイメントで共有する
+                http_client=get_openai_http_client(),
+            )
+        )
+        return cls([Deployment(d["name"], client_factory(d), d["model"]) for d in load_deployments()])
+
+    def candidates(self, cost: float) -> list[Deployment]:
+        """利用可能なデプロイメントをスコア順に返します。全滅時は最も早く復帰するものを返します"""
+        available = [d for d in self.deployments if d.available]
+        if not available:
+            return [min(self.deployments, key=lambda d: d.open_until)]
+        return sorted(available, key=lambda d: d.score(cost))
+
+    async def stream(self, messages: list[dict], settings: dict, cost: float) -> RoutedStream:
+        """最初のチャンクを受け取れたデプロイメントのストリームを返します"""
+        last_error = None
+        for attempt, deployment in enumerate(self.candidates(cost)):
+            if attempt:
+                DEPLOYMENT_FAILOVERS.inc()
+            deployment.outstanding_tokens += cost
+            started = time.monotonic()
+            stream = None
+            try:
+                stream = await deployment.client.chat.completions.create(
+                    messages=messages, **{**settings, "model": deployment.model}
+                )
+                first_chunk = await stream.__anext__()
+            except FAILOVER_ERRORS as e:
+                deployment.outstanding_tokens -= cost
+                if stream is not None:
+                    await stream.close()
+                cooldown = retry_after(e) if isinstance(e, openai.RateLimitError) else None
+                deployment.record_failure(cooldown)
+                DEPLOYMENT_REQUESTS.inc(deployment=deployment.name, outcome="failover")
+                logger.warning(f"デプロイメント {deployment.name} への接続に失敗しました: {e}")
+                last_error = e
+                continue
+            except BaseException:
+                deployment.outstanding_tokens -= cost
+                if stream is not None:
+                    await stream.close()
+                raise
+            ttft = time.monotonic() - started
+            deployment.record_success(ttft)
+            DEPLOYMENT_TTFT_SECONDS.observe(ttft, deployment=deployment.name)
+            DEPLOYMENT_REQUESTS.inc(deployment=deployment.name, outcome="ok")
+            return RoutedStream(deployment, stream, first_chunk, cost)
+        raise last_error
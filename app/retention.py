@@ -0,0 +1,354 @@
+import asyncio
+import gzip
+import json
+import logging
+import time
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+import metrics
+from blob_storage import BlobStorageClient
+from settings import Config, get_engine
+
+logger = logging.getLogger(__name__)
+
+RETENTION_ROWS_DELETED = metrics.counter(
+    "retention_rows_deleted_total",
+    "Rows removed by the retention job",
+    labelnames=("table",),
+)
+RETENTION_BYTES_RECLAIMED = metrics.counter(
+    "retention_bytes_reclaimed_total",
+    "Bytes reclaimed by the retention job",
+    labelnames=("source",),
+)
+RETENTION_THREADS = metrics.counter(
+    "retention_threads_total",
+    "Threads archived to or restored from blob storage",
+    labelnames=("action",),
+)
+RETENTION_RUN_SECONDS = metrics.histogram(
+    "retention_run_seconds",
+    "Duration of retention job runs",
+    buckets=(1, 5, 10, 30, 60, 300, 600, 1800, 3600),
+)
+
+ARCHIVE_VERSION = 1
+ARCHIVE_MIME = "application/gzip"
+# 複数ワーカーのうち 1 つだけがジョブを実行するためのアドバイザリーロックのキー
+RETENTION_LOCK_KEY = 0x52455445
+# 孤立した Blob を確認する 1 回あたりの件数
+ORPHAN_PAGE_SIZE = 500
+
+
+def load_user_policies(raw: str | None = None) -> dict[str, int]:
+    """RETENTION_USER_POLICIES（userIdentifier -> 保持日数の JSON）を読み込みます"""
+    raw = Config.RETENTION_USER_POLICIES if raw is None else raw
+    if not raw:
+        return {}
+    try:
+        return {str(identifier): int(days) for identifier, days in json.loads(raw).items()}
+    except (ValueError, TypeError, AttributeError) as e:
+        raise ValueError(f"RETENTION_USER_POLICIES is invalid: {e}") from e
+
+
+def archive_key(thread_id: str) -> str:
+    return f"{Config.RETENTION_ARCHIVE_PREFIX}{thread_id}.json.gz"
+
+
+class RetentionReport:
+    """1 回の実行で退避・削除した件数とバイト数"""
+
+    __slots__ = (
+        "threads_archived",
+        "steps_archived",
+        "feedbacks_archived",
+        "archive_bytes",
+        "db_bytes_reclaimed",
+        "orphan_elements",
+        "orphan_blobs",
+        "blob_bytes_reclaimed",
+    )
+
+    def __init__(self):
+        for name in self.__slots__:
+            setattr(self, name, 0)
+
+    @property
+    def rows_reclaimed(self) -> int:
+        return self.steps_archived + self.feedbacks_archived + self.orphan_elements
+
+    def to_dict(self) -> dict:
+        return {
+            **{name: getattr(self, name) for name in self.__slots__},
+            "rows_reclaimed": self.rows_reclaimed,
+        }
+
+
+class ThreadArchiver:
+    """
+    スレッドのステップとフィードバックを gzip 圧縮した JSON として Blob に退避し、
+    threads.archiveKey に退避先を記録します。elements の行と Blob はそのまま残します。
+    restore() は退避したステップを元の行のまま書き戻します（get_thread から呼ばれます）。
+    """
+
+    def __init__(self, storage_client: BlobStorageClient, engine: AsyncEngine | None = None):
+        self.storage_client = storage_client
+        self.engine = engine or get_engine()
+
+    async def export(self, thread_id: str) -> dict:
+        """スレッドのステップとフィードバックを行のまま取得します"""
+        # 検索用の N-gram は復元時にトリガーで作り直すため退避しない
+        query = text("""
+            SELECT
+                COALESCE((SELECT jsonb_agg(to_jsonb(s) - 'searchGrams' ORDER BY s."createdAtTs", s."id") FROM steps s WHERE s."threadId" = CAST(:id AS uuid)), '[]'::jsonb)::text AS steps,
+                COALESCE((SELECT json_agg(f) FROM feedbacks f WHERE f."threadId" = CAST(:id AS uuid)), '[]'::json)::text AS feedbacks,
+                COALESCE((SELECT sum(pg_column_size(s.*)) FROM steps s WHERE s."threadId" = CAST(:id AS uuid)), 0)
+                + COALESCE((SELECT sum(pg_column_size(f.*)) FROM feedbacks f WHERE f."threadId" = CAST(:id AS uuid)), 0) AS bytes
+        """)
+        async with self.engine.connect() as conn:
+            row = (await conn.execute(query, {"id": thread_id})).one()
+        return {
+            "version": ARCHIVE_VERSION,
+            "threadId": thread_id,
+            "steps": json.loads(row.steps),
+            "feedbacks": json.loads(row.feedbacks),
+            "bytes": int(row.bytes),
+        }
+
+    async def archive(self, thread_ids: list[str], report: RetentionReport) -> None:
+        """
+        スレッドを 1 件ずつ Blob にアップロードしてから、1 トランザクションで行を削除します。
+        削除するのはアップロードした行だけなので、途中で追加されたステップは残ります。
+        """
+        archived, step_ids, feedback_ids, db_bytes = [], [], [], 0
+        for thread_id in thread_ids:
+            exported = await self.export(thread_id)
+            payload = gzip.compress(json.dumps(exported, ensure_ascii=False, separators=(",", ":")).encode())
+            key = archive_key(thread_id)
+            await self.storage_client.upload_file(key, payload, ARCHIVE_MIME)
+            archived.append({"id": thread_id, "key": key})
+            step_ids += [step["id"] for step in exported["steps"]]
+            feedback_ids += [feedback["id"] for feedback in exported["feedbacks"]]
+            db_bytes += exported["bytes"]
+            report.archive_bytes += len(payload)
+        if not archived:
+            return
+
+        async with self.engine.begin() as conn:
+            # 退避は応答・フィードバックの取り消しではないため、集計（response_rollup_*）からは引かない
+            await conn.execute(text("SET LOCAL app.skip_rollup = 'on'"))
+            feedbacks = await conn.execute(
+                text("""DELETE FROM feedbacks WHERE "id" = ANY(CAST(:ids AS uuid[]))"""), {"ids": feedback_ids}
+            )
+            steps = await conn.execute(
+                text("""DELETE FROM steps WHERE "id" = ANY(CAST(:ids AS uuid[]))"""), {"ids": step_ids}
+            )
+            await conn.execute(
+                text("""
+                    UPDATE threads SET "archiveKey" = a.key, "archivedAt" = now()
+                    FROM json_to_recordset(CAST(:archived AS json)) AS a(id uuid, key text)
+                    WHERE threads."id" = a.id
+                """),
+                {"archived": json.dumps(archived)},
+            )
+        report.threads_archived += len(archived)
+        report.steps_archived += steps.rowcount
+        report.feedbacks_archived += feedbacks.rowcount
+        report.db_bytes_reclaimed += db_bytes
+        RETENTION_THREADS.inc(len(archived), action="archive")
+        RETENTION_ROWS_DELETED.inc(steps.rowcount, table="steps")
+        RETENTION_ROWS_DELETED.inc(feedbacks.rowcount, table="feedbacks")
+        RETENTION_BYTES_RECLAIMED.inc(db_bytes, source="db")
+
+    async def restore(self, thread_id: str, key: str) -> bool:
+        """退避したステップとフィードバックを書き戻します。他の呼び出しが復元済みなら False"""
+        chunks = [chunk async for chunk in self.storage_client.download_stream(key)]
+        archived = json.loads(gzip.decompress(b"".join(chunks)))
+        async with self.engine.begin() as conn:
+            # 行ロックで同時に開かれた場合の二重の復元を防ぐ
+            claimed = await conn.execute(
+                text("""
+                    UPDATE threads SET "archiveKey" = NULL, "archivedAt" = NULL, "restoredAt" = now()
+                    WHERE "id" = CAST(:id AS uuid) AND "archiveKey" = :key
+                    RETURNING "id"
+                """),
+                {"id": thread_id, "key": key},
+            )
+            if claimed.first() is None:
+                return False
+            # 退避時に集計から引いていないため、書き戻す行も加算しない
+            await conn.execute(text("SET LOCAL app.skip_rollup = 'on'"))
+            await conn.execute(
+                text("""
+                    INSERT INTO steps SELECT * FROM json_populate_recordset(NULL::steps, CAST(:rows AS json))
+                    ON CONFLICT ("id") DO NOTHING
+                """),
+                {"rows": json.dumps(archived["steps"])},
+            )
+            await conn.execute(
+                text("""
+                    INSERT INTO feedbacks SELECT * FROM json_populate_recordset(NULL::feedbacks, CAST(:rows AS json))
+                    ON CONFLICT ("id") DO NOTHING
+                """),
+                {"rows": json.dumps(archived["feedbacks"])},
+            )
+        RETENTION_THREADS.inc(action="restore")
+        # 削除に失敗して残った Blob は、孤立した Blob として次回の実行で削除される
+        await self.storage_client.delete_file(key)
+        return True
+
+
+class RetentionJob:
+    """
+    RETENTION_INTERVAL 秒ごとに次の処理を行うバックグラウンドジョブ。
+
+    - 最後のステップから保持日数（RETENTION_DAYS、ユーザーごとに RETENTION_USER_POLICIES で上書き）
+      を過ぎたスレッドを RETENTION_BATCH_SIZE 件ずつ Blob に退避し、バッチ間は
+      RETENTION_BATCH_DELAY 秒待って DB への負荷を抑える
+    - スレッドが無くなった、または参照先のステップが削除された elements の行と Blob を削除する
+    - どの行からも参照されていない Blob（RETENTION_ORPHAN_GRACE 秒より古いもの）を削除する
+
+    削除した行の領域は autovacuum の後に再利用されます。
+    複数ワーカーで起動した場合も、アドバイザリーロックを取れた 1 プロセスだけが実行します。
+    """
+
+    def __init__(self, storage_client: BlobStorageClient, engine: AsyncEngine | None = None):
+        self.storage_client = storage_client
+        self.engine = engine or get_engine()
+        self.archiver = ThreadArchiver(storage_client, self.engine)
+        self.policies = load_user_policies()
+        self._task = None
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._loop())
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _loop(self) -> None:
+        while True:
+            try:
+                await self.run_once()
+            except Exception as e:
+                logger.warning(f"保持期間の処理に失敗しました: {e}")
+            await asyncio.sleep(Config.RETENTION_INTERVAL)
+
+    async def run_once(self) -> RetentionReport | None:
+        """ロックを取れた場合に 1 回分の処理を行い、結果を返します（他のプロセスが実行中なら None）"""
+        async with self.engine.connect() as lock_conn:
+            # ロックを保持する間もトランザクションを開いたままにしない（vacuum を妨げないため）
+            lock_conn = await lock_conn.execution_options(isolation_level="AUTOCOMMIT")
+            if not await lock_conn.scalar(text("SELECT pg_try_advisory_lock(:key)"), {"key": RETENTION_LOCK_KEY}):
+                return None
+            try:
+                started = time.perf_counter()
+                report = RetentionReport()
+                await self.archive_threads(report)
+                await self.delete_orphan_elements(report)
+                await self.delete_orphan_blobs(report)
+                RETENTION_RUN_SECONDS.observe(time.perf_counter() - started)
+                logger.info(f"保持期間の処理が完了しました: {report.to_dict()}")
+                return report
+            finally:
+                await lock_conn.scalar(text("SELECT pg_advisory_unlock(:key)"), {"key": RETENTION_LOCK_KEY})
+
+    async def archive_threads(self, report: RetentionReport) -> None:
+        # 最後の活動はスレッドの最新のステップ（無ければスレッドの作成日時）か、アーカイブから復元した日時
+        query = text("""
+            SELECT t."id"
+            FROM threads t
+            CROSS JOIN LATERAL (
+                SELECT COALESCE((CAST(:policies AS jsonb) ->> t."userIdentifier")::int, :default_days) AS days
+            ) p
+            WHERE t."archiveKey" IS NULL
+              AND p.days > 0
+              AND GREATEST(
+                  COALESCE((SELECT max(s."createdAtTs") FROM steps s WHERE s."threadId" = t."id"), t."createdAtTs"),
+                  t."restoredAt"
+              ) < now() - make_interval(days => p.days)
+              AND EXISTS (SELECT 1 FROM steps s WHERE s."threadId" = t."id")
+            LIMIT :limit
+        """)
+        parameters = {
+            "policies": json.dumps(self.policies),
+            "default_days": Config.RETENTION_DAYS,
+            "limit": Config.RETENTION_BATCH_SIZE,
+        }
+        while True:
+            async with self.engine.connect() as conn:
+                thread_ids = [str(thread_id) for thread_id in (await conn.execute(query, parameters)).scalars()]
+            if not thread_ids:
+                return
+            await self.archiver.archive(thread_ids, report)
+            await asyncio.sleep(Config.RETENTION_BATCH_DELAY)
+
+    async def delete_orphan_elements(self, report: RetentionReport) -> None:
+        """スレッドの無い、または参照先のステップが削除された（退避は除く）elements を削除します"""
+        query = text("""
+            DELETE FROM elements e
+            WHERE e."id" IN (
+                SELECT e2."id" FROM elements e2
+                LEFT JOIN threads t ON t."id" = e2."threadId"
+                WHERE t."id" IS NULL
+                   OR (t."archiveKey" IS NULL AND e2."forId" IS NOT NULL
+                       AND NOT EXISTS (SELECT 1 FROM steps s WHERE s."id" = e2."forId"))
+                LIMIT :limit
+            )
+            RETURNING e."objectKey", e."sizeBytes"
+        """)
+        while True:
+            async with self.engine.begin() as conn:
+                rows = (await conn.execute(query, {"limit": ORPHAN_PAGE_SIZE})).all()
+            if not rows:
+                return
+            report.orphan_elements += len(rows)
+            RETENTION_ROWS_DELETED.inc(len(rows), table="elements")
+            for row in rows:
+                if row.objectKey and await self.storage_client.delete_file(row.objectKey):
+                    report.orphan_blobs += 1
+                    report.blob_bytes_reclaimed += row.sizeBytes or 0
+                    RETENTION_BYTES_RECLAIMED.inc(row.sizeBytes or 0, source="blob")
+            if len(rows) < ORPHAN_PAGE_SIZE:
+                return
+            await asyncio.sleep(Config.RETENTION_BATCH_DELAY)
+
+    async def delete_orphan_blobs(self, report: RetentionReport) -> None:
+        """elements の objectKey と threads の archiveKey のどちらからも参照されていない Blob を削除します"""
+        cutoff = datetime.now(timezone.utc) - timedelta(seconds=Config.RETENTION_ORPHAN_GRACE)
+        page = {}
+        async for blob in self.storage_client.container_client.list_blobs():
+            if blob.last_modified and blob.last_modified > cutoff:
+                continue
+            page[blob.name] = blob.size or 0
+            if len(page) >= ORPHAN_PAGE_SIZE:
+                await self._delete_unreferenced(page, report)
+                page = {}
+        if page:
+            await self._delete_unreferenced(page, report)
+
+    async def _delete_unreferenced(self, sizes: dict[str, int], report: RetentionReport) -> None:
+        query = text("""
+            SELECT k FROM unnest(CAST(:keys AS text[])) AS k
+            WHERE NOT EXISTS (SELECT 1 FROM elements e WHERE e."objectKey" = k)
+              AND NOT EXISTS (SELECT 1 FROM threads t WHERE t."archiveKey" = k)
+        """)
+        async with self.engine.connect() as conn:
+            keys = (await conn.execute(query, {"keys": list(sizes)})).scalars().all()
+        for key in keys:
+            if await self.storage_client.delete_file(key):
+                report.orphan_blobs += 1
+                report.blob_bytes_reclaimed += sizes[key]
+                RETENTION_BYTES_RECLAIMED.inc(sizes[key], source="blob")
+        if keys:
+            await asyncio.sleep(Config.RETENTION_BATCH_DELAY)
+
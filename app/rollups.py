@@ -0,0 +1,111 @@
+from datetime import date, datetime, time, timedelta
+from typing import Iterable
+from zoneinfo import ZoneInfo
+
+from settings import Config, get_engine
+from tracing import span
+
+# 集計単位と、集計テーブルのモデル名・単位の列
+GRAINS = {
+    "hour": ("ResponseRollupHourly", "bucket"),
+    "day": ("ResponseRollupDaily", "day"),
+}
+# 集計単位のほかにまとめる（または絞り込む）列
+DIMENSIONS = ("userIdentifier", "model")
+COUNTER_COLUMNS = (
+    "responses", "promptTokens", "completionTokens", "ttftSecondsSum", "durationSecondsSum",
+    "feedbackUp", "feedbackDown",
+)
+
+
+def _ratio(numerator, denominator):
+    return numerator / denominator if denominator else None
+
+
+def _bounds(grain: str, start: datetime | None, end: datetime | None) -> tuple:
+    """
+    [start, end) を集計単位の列と比べる値にします（タイムゾーンの無い時刻は USAGE_TIMEZONE とみなす）。
+    day の場合、end が日の途中ならその日も含めます（既定の end は現在時刻のため、今日の集計も返す）。
+    """
+    timezone = ZoneInfo(Config.USAGE_TIMEZONE)
+    end = end or datetime.now(timezone)
+    start = start or end - timedelta(days=Config.ROLLUP_DEFAULT_DAYS)
+    start, end = (value if value.tzinfo else value.replace(tzinfo=timezone) for value in (start, end))
+    if grain == "day":
+        start, end = start.astimezone(timezone), end.astimezone(timezone)
+        upper = end.date() if end.time() == time.min else end.date() + timedelta(days=1)
+        return start.date(), upper
+    return start, end
+
+
+async def query_rollups(
+    grain: str = "day",
+    start: datetime | None = None,
+    end: datetime | None = None,
+    user: str | None = None,
+    model: str | None = None,
+    group_by: Iterable[str] = ("model",),
+    engine=None,
+) -> list[dict]:
+    """
+    応答の使用量とフィードバックの集計（response_rollup_hourly / response_rollup_daily）を
+    grain（hour / day）ごとに [start, end) の範囲（day は end を含む日まで）で返します。既定は直近 ROLLUP_DEFAULT_DAYS 日です。
+    group_by に無い DIMENSIONS の列は合算し、user・model を指定した場合はその値に絞り込みます。
+    各行の thumbsUpRatio は 👍 / (👍 + 👎)、feedbackRate はフィードバックの付いた応答の割合です。
+    """
+    if grain not in GRAINS:
+        raise ValueError(f"grain must be one of {', '.join(GRAINS)}")
+    group_by = list(dict.fromkeys(group_by))
+    if unknown := [column for column in group_by if column not in DIMENSIONS]:
+        raise ValueError(f"group_by must be in {', '.join(DIMENSIONS)}: {', '.join(unknown)}")
+    lower, upper = _bounds(grain, start, end)
+
+    # SQLAlchemy は最初の呼び出しで読み込む（app.py の import を軽くするため）
+    from sqlalchemy import func, select
+
+    import models
+
+    model_name, key = GRAINS[grain]
+    table = getattr(models, model_name).__table__
+    bucket = table.c[key]
+    dimensions = [table.c[column] for column in group_by]
+    sums = {column: func.sum(table.c[column]) for column in COUNTER_COLUMNS}
+    stmt = (
+        select(bucket.label("bucket"), *dimensions, *(value.label(column) for column, value in sums.items()))
+        .where(bucket >= lower, bucket < upper)
+        .group_by(bucket, *dimensions)
+        # スレッドの所有者の付け替えなどで 0 になった行は返さない
+        .having(sums["responses"] + sums["feedbackUp"] + sums["feedbackDown"] != 0)
+        .order_by(bucket, *dimensions)
+        .limit(Config.ROLLUP_MAX_ROWS)
+    )
+    if user is not None:
+        stmt = stmt.where(table.c.userIdentifier == user)
+    if model is not None:
+        stmt = stmt.where(table.c.model == model)
+
+    with span("rollups.query", grain=grain):
+        async with (engine or get_engine()).connect() as conn:
+            rows = (await conn.execute(stmt)).mappings().all()
+
+    results = []
+    for row in rows:
+        # bigint の合計は numeric（Decimal）で返るため数値に揃える
+        counters = {column: float(row[column] or 0) for column in COUNTER_COLUMNS}
+        counters = {column: value if column.endswith("Sum") else int(value) for column, value in counters.items()}
+        responses, up, down = counters["responses"], counters["feedbackUp"], counters["feedbackDown"]
+        value = row["bucket"]
+        results.append({
+            "bucket": value.isoformat() if isinstance(value, (date, datetime)) else value,
+            **{column: row[column] for column in group_by},
+            "responses": responses,
+            "promptTokens": counters["promptTokens"],
+            "completionTokens": counters["completionTokens"],
+            "avgTtftSeconds": _ratio(counters["ttftSecondsSum"], responses),
+            "avgDurationSeconds": _ratio(counters["durationSecondsSum"], responses),
+            "feedbackUp": up,
+            "feedbackDown": down,
+            "thumbsUpRatio": _ratio(up, up + down),
+            "feedbackRate": _ratio(up + down, responses),
+        })
+    return results
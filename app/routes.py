@@ -0,0 +1,34 @@
+import secrets
+
+from chainlit.server import app
+from fastapi import Depends, HTTPException
+from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
+
+from settings import Config
+
+# Chainlit がフロントエンド配信用に登録している catch-all ルート
+CATCH_ALL_PATH = "/{full_path:path}"
+
+
+def add_route(path: str, endpoint, **kwargs) -> None:
+    """
+    Chainlit サーバーにルートを追加します。
+    catch-all ルートより後ろに登録すると到達しないため、その直前に挿入します。
+    """
+    app.add_api_route(path, endpoint, **kwargs)
+    route = app.router.routes.pop()
+    index = next(
+        (i for i, r in enumerate(app.router.routes) if getattr(r, "path", None) == CATCH_ALL_PATH),
+        len(app.router.routes),
+    )
+    app.router.routes.insert(index, route)
+
+
+async def require_metrics_token(
+    credentials: HTTPAuthorizationCredentials | None = Depends(HTTPBearer(auto_error=False)),
+) -> None:
+    """/metrics 以下のルートで、Authorization: Bearer のトークンが METRICS_TOKEN と一致するか確認します"""
+    if not Config.METRICS_TOKEN:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if credentials is None or not secrets.compare_digest(credentials.credentials, Config.METRICS_TOKEN):
+        raise HTTPException(status_code=401, detail="Unauthorized", headers={"WWW-Authenticate": "Bearer"})
@@ -0,0 +1,222 @@
+import asyncio
+import logging
+import random
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from email.utils import parsedate_to_datetime
+
+import openai
+
+import metrics
+from settings import Config
+
+logger = logging.getLogger(__name__)
+
+SCHEDULER_QUEUE_DEPTH = metrics.gauge(
+    "openai_scheduler_queue_depth",
+    "Requests waiting for an OpenAI slot",
+)
+SCHEDULER_ACTIVE = metrics.gauge(
+    "openai_scheduler_active_streams",
+    "OpenAI requests currently holding a slot",
+)
+SCHEDULER_WAIT_SECONDS = metrics.histogram(
+    "openai_scheduler_wait_seconds",
+    "Time spent waiting for an OpenAI slot",
+)
+SCHEDULER_RETRIES = metrics.counter(
+    "openai_scheduler_retries_total",
+    "OpenAI requests retried after a rate limit response",
+)
+
+
+class TokenBucket:
+    """毎分 rate_per_minute ずつ補充されるトークンバケット。0 以下なら無制限"""
+
+    def __init__(self, rate_per_minute: float, clock=time.monotonic):
+        self.capacity = rate_per_minute
+        self.rate = rate_per_minute / 60
+        self.clock = clock
+        self.tokens = rate_per_minute
+        self._updated = clock()
+
+    @property
+    def unlimited(self) -> bool:
+        return self.capacity <= 0
+
+    def _refill(self) -> None:
+        now = self.clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def wait_time(self, cost: float) -> float:
+        """cost 分のトークンが貯まるまでの秒数を返します"""
+        if self.unlimited:
+            return 0.0
+        self._refill()
+        cost = min(cost, self.capacity)
+        return 0.0 if self.tokens >= cost else (cost - self.tokens) / self.rate
+
+    def consume(self, cost: float) -> None:
+        if not self.unlimited:
+            self.tokens -= min(cost, self.capacity)
+
+
+class _Waiter:
+    __slots__ = ("user", "cost", "future", "enqueued_at")
+
+    def __init__(self, user: str, cost: float, future: asyncio.Future):
+        self.user = user
+        self.cost = cost
+        self.future = future
+        self.enqueued_at = time.monotonic()
+
+
+class RequestScheduler:
+    """
+    Azure OpenAI への呼び出しをプロセス全体で調停するスケジューラー。
+
+    - 同時ストリーム数を max_concurrent に制限する
+    - 推定トークン数（プロンプト + max_tokens）と件数をトークンバケットで制限する
+    - ユーザーごとのキューをラウンドロビンで処理し、特定ユーザーによる占有を防ぐ
+    - 429 を受けた場合は Retry-After（無ければジッター付き指数バックオフ）の間、
+      全体の払い出しを止めてから再試行する
+    """
+
+    def __init__(
+        self,
+        max_concurrent: int | None = None,
+        tokens_per_minute: float | None = None,
+        requests_per_minute: float | None = None,
+        max_retries: int | None = None,
+    ):
+        self.max_concurrent = max_concurrent or Config.OPENAI_MAX_CONCURRENT_STREAMS
+        # レート上限はデプロイメント全体の値のため、複数ワーカーで起動した場合は等分する
+        workers = Config.WEB_CONCURRENCY
+        self.token_bucket = TokenBucket(Config.OPENAI_TOKENS_PER_MINUTE / workers if tokens_per_minute is None else tokens_per_minute)
+        self.request_bucket = TokenBucket(Config.OPENAI_REQUESTS_PER_MINUTE / workers if requests_per_minute is None else requests_per_minute)
+        self.max_retries = Config.OPENAI_MAX_RETRIES if max_retries is None else max_retries
+        self.active = 0
+        self._queues: OrderedDict[str, deque] = OrderedDict()
+        self._paused_until = 0.0
+        self._timer = None
+        SCHEDULER_QUEUE_DEPTH.set_function(lambda: self.queue_depth)
+        SCHEDULER_ACTIVE.set_function(lambda: self.active)
+
+    @property
+    def queue_depth(self) -> int:
+        return sum(len(queue) for queue in self._queues.values())
+
+    @asynccontextmanager
+    async def slot(self, user: str, cost: float):
+        """実行枠を確保し、ブロックを抜けるまで保持します"""
+        await self.acquire(user, cost)
+        try:
+            yield
+        finally:
+            self.release()
+
+    async def acquire(self, user: str, cost: float) -> None:
+        future = asyncio.get_running_loop().create_future()
+        waiter = _Waiter(user, cost, future)
+        self._queues.setdefault(user, deque()).append(waiter)
+        self._dispatch()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # 払い出し直後にキャンセルされた場合は枠を返す
+                self.release()
+            else:
+                self._remove(waiter)
+            raise
+        SCHEDULER_WAIT_SECONDS.observe(time.monotonic() - waiter.enqueued_at)
+
+    def release(self) -> None:
+        self.active -= 1
+        self._dispatch()
+
+    def pause(self, seconds: float) -> None:
+        """レート制限を受けたときに払い出しを一時停止します"""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    def _remove(self, waiter: _Waiter) -> None:
+        queue = self._queues.get(waiter.user)
+        if queue is None:
+            return
+        try:
+            queue.remove(waiter)
+        except ValueError:
+            pass
+        if not queue:
+            del self._queues[waiter.user]
+
+    def _dispatch(self) -> None:
+        while self._queues and self.active < self.max_concurrent:
+            user, queue = next(iter(self._queues.items()))
+            waiter = queue[0]
+            wait = max(
+                self._paused_until - time.monotonic(),
+                self.token_bucket.wait_time(waiter.cost),
+                self.request_bucket.wait_time(1),
+            )
+            if wait > 0:
+                self._schedule(wait)
+                return
+            queue.popleft()
+            # 払い出したユーザーは末尾に回す（ラウンドロビン）
+            if queue:
+                self._queues.move_to_end(user)
+            else:
+                del self._queues[user]
+            self.token_bucket.consume(waiter.cost)
+            self.request_bucket.consume(1)
+            self.active += 1
+            waiter.future.set_result(None)
+
+    def _schedule(self, delay: float) -> None:
+        if self._timer is not None and not self._timer.cancelled():
+            self._timer.cancel()
+        loop = asyncio.get_running_loop()
+        self._timer = loop.call_later(delay, self._dispatch)
+
+    async def call(self, fn):
+        """fn() を実行し、429 の場合は待機してから再試行します"""
+        attempt = 0
+        while True:
+            try:
+                return await fn()
+            except openai.RateLimitError as e:
+                if attempt >= self.max_retries:
+                    raise
+                delay = retry_after(e) or backoff_delay(attempt)
+                self.pause(delay)
+                SCHEDULER_RETRIES.inc()
+                logger.warning(f"OpenAI のレート制限を受けました。{delay:.1f} 秒後に再試行します")
+                await asyncio.sleep(delay)
+                attempt += 1
+
+
+def backoff_delay(attempt: int) -> float:
+    """フルジッター付きの指数バックオフ"""
+    return random.uniform(0, min(Config.OPENAI_RETRY_MAX_DELAY, Config.OPENAI_RETRY_BASE_DELAY * 2 ** attempt))
+
+
+def retry_after(error: openai.APIStatusError) -> float | None:
+    """レスポンスヘッダーの Retry-After を秒数で返します"""
+    headers = error.response.headers if error.response is not None else {}
+    if value := headers.get("retry-after-ms"):
+        try:
+            return float(value) / 1000
+        except ValueError:
+            pass
+    if value := headers.get("retry-after"):
+        try:
+            return float(value)
+        except ValueError:
+            try:
+                return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+            except (TypeError, ValueError):
+                return None
+    return None
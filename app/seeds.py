@@ -1,78 +1,467 @@
 import argparse
-from settings import get_db, Base, engine
-from models import User
+import asyncio
 import logging
-from datetime import datetime
+import os
+import random
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+import asyncpg
+from sqlalchemy import select
+from settings import get_engine, get_sessionmaker, postgres_dsn
+from models import Base, User
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-def setup_database():
+async def setup_database():
     """データベースの初期設定を行います"""
     try:
         # テーブルの作成（存在しない場合）
         logger.info("データベーステーブルを初期化しています...")
-        Base.metadata.create_all(engine)
+        async with get_engine().begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
         logger.info("データベースの初期化が完了しました")
     except Exception as e:
         logger.error(f"データベースの初期化中にエラーが発生しました: {e}")
         raise
 
-def seed_user(identifier):
+async def seed_user(identifier):
     """
     指定されたメールアドレスとパスワードでユーザーを作成または更新します
     """
-    db = next(get_db())
+    async with get_sessionmaker()() as db:
+        try:
+            # ユーザーが存在するか確認
+            result = await db.execute(select(User).where(User.identifier == identifier))
+            user = result.scalars().first()
 
-    try:
-        # ユーザーが存在するか確認
-        user = db.query(User).filter(User.identifier == identifier).first()
-
-        # ユーザーのメタデータを設定
-        metadata = {
-            "name": "Default User",
-            "role": "user",
-            "created_at": datetime.now().isoformat(),
-            "last_login": datetime.now().isoformat(),
-            "preferences": {
-                "theme": "light",
-                "language": "ja"
+            # ユーザーのメタデータを設定
+            metadata = {
+                "name": "Default User",
+                "role": "user",
+                "created_at": datetime.now().isoformat(),
+                "last_login": datetime.now().isoformat(),
+                "preferences": {
+                    "theme": "light",
+                    "language": "ja"
+                }
             }
+
+            if user:
+                logger.info(f"既存ユーザー '{identifier}' を更新します")
+                user.metadata_ = metadata
+            else:
+                logger.info(f"新規ユーザー '{identifier}' を作成します")
+                user = User(
+                    identifier=identifier,
+                    metadata_=metadata,
+                    createdAt=datetime.now().isoformat()
+                )
+                db.add(user)
+
+            # 変更をコミット
+            await db.commit()
+            logger.info(f"ユーザー '{identifier}' の設定が完了しました")
+
+            return user
+        except Exception as e:
+            await db.rollback()
+            logger.error(f"ユーザー '{identifier}' の作成/更新中にエラーが発生しました: {e}")
+            raise
+
+# 一括投入するユーザーの identifier の接頭辞（--replace で削除する対象）
+SEED_USER_PREFIX = "seed-user-"
+# 1 回の COPY で投入するステップ数の目安（進捗の表示とワーカー間の負荷の偏りを抑える単位）
+SEED_CHUNK_STEPS = 200_000
+
+SEED_COLUMNS = {
+    "users": ("id", "identifier", "metadata", "createdAt"),
+    "threads": ("id", "createdAt", "createdAtTs", "name", "userId", "userIdentifier", "tags", "metadata"),
+    "steps": (
+        "id", "name", "type", "threadId", "streaming", "metadata", "output",
+        "createdAt", "start", "end", "createdAtTs", "startTs", "endTs", "generation", "showInput",
+    ),
+    "elements": ("id", "threadId", "type", "name", "display", "objectKey", "mime", "forId", "sizeBytes"),
+    "feedbacks": ("id", "forId", "threadId", "value", "comment"),
+}
+
+# 投入中にユーザー定義のトリガー（timestamptz 列・検索用の N-gram・応答の集計）を止めるテーブル。
+# 行ごとのトリガーは COPY でも 1 行ずつ実行されるため、投入後に集合演算でまとめて埋める
+SEED_TRIGGER_TABLES = ("threads", "steps", "feedbacks")
+
+# 集計テーブルと、時刻 {ts} から集計単位の値を求める式（マイグレーション a8d3f1c7e9b2 の ROLLUPS と同じ）
+SEED_ROLLUPS = (
+    ("response_rollup_hourly", "bucket", "date_trunc('hour', {ts}, 'UTC')"),
+    ("response_rollup_daily", "day", "rollup_day({ts})"),
+)
+
+# 日本語と英語が混ざった会話を組み立てるための文
+SEED_PHRASES = (
+    "こんにちは、今日の会議の議事録を要約してください。",
+    "Azure OpenAI のデプロイメントの設定方法を教えてください。",
+    "東京から大阪までの移動手段を比較してください。",
+    "Please summarize the quarterly sales report.",
+    "請求書の処理が遅れている原因を調べています。",
+    "PostgreSQL のインデックスが使われない理由は何ですか？",
+    "The deployment failed with a timeout error.",
+    "来週の出張の予定を確認したいです。",
+    "機械学習モデルの精度を改善する方法を提案してください。",
+    "How do I rotate the storage account keys?",
+    "新しいプロジェクトのリスク一覧を作成してください。",
+    "顧客からの問い合わせメールの返信文を考えてください。",
+)
+
+SEED_OUTPUT_BITS = 12
+
+# 行番号から ID を決める際の、62 ビットの範囲での全単射（奇数との積）
+ID_MASK = (1 << 62) - 1
+ID_MULTIPLIER = 0x9E3779B97F4A7C15
+
+
+def _timestamp(moment: datetime) -> str:
+    # Chainlit と同じ ISO 8601 + Z 形式
+    return moment.replace(tzinfo=None).isoformat() + "Z"
+
+
+class SeedPlan:
+    """
+    一括投入するデータの件数と、行番号から各行の値を決める規則。
+    ID は乱数シードとテーブルごとの名前空間、行番号から決まり、スレッドの内容は
+    スレッドごとの乱数から決まるため、ワーカー数や分割の仕方によらず同じデータになります。
+    """
+
+    def __init__(
+        self,
+        users: int,
+        threads_per_user: int,
+        steps_per_thread: int,
+        feedbacks_per_thread: int = 0,
+        elements_per_thread: int = 0,
+        seed: int = 42,
+        now: datetime | None = None,
+    ):
+        self.users = users
+        self.threads_per_user = threads_per_user
+        self.steps_per_thread = steps_per_thread
+        # フィードバックはアシスタントの応答、エレメントはユーザーのメッセージに付ける
+        self.feedbacks_per_thread = min(feedbacks_per_thread, steps_per_thread // 2)
+        self.elements_per_thread = min(elements_per_thread, (steps_per_thread + 1) // 2)
+        self.seed = seed
+        self.now = now or datetime.now(timezone.utc)
+        rng = random.Random(seed)
+        self.namespaces = {table: rng.getrandbits(128) & ~ID_MASK for table in SEED_COLUMNS}
+        # 本文は事前に組み立てた候補から選ぶ（行ごとに組み立てると生成が COPY より遅くなる）
+        # 候補ごとの番号は検索の性能試験で出現頻度の低い語として使う
+        self.outputs = [
+            " ".join(rng.choices(SEED_PHRASES, k=rng.randint(1, 6))) + f" (ticket {i:04d})"
+            for i in range(1 << SEED_OUTPUT_BITS)
+        ]
+
+    @property
+    def threads(self) -> int:
+        return self.users * self.threads_per_user
+
+    def rows(self, table: str) -> int:
+        per_thread = {
+            "threads": 1,
+            "steps": self.steps_per_thread,
+            "feedbacks": self.feedbacks_per_thread,
+            "elements": self.elements_per_thread,
         }
+        return self.users if table == "users" else self.threads * per_thread[table]
+
+    def id(self, table: str, n: int) -> uuid.UUID:
+        return uuid.UUID(int=self.namespaces[table] | ((n * ID_MULTIPLIER) & ID_MASK), version=4)
+
+    def chunks(self, table: str) -> list[tuple[int, int]]:
+        """COPY 1 回分の範囲（users はユーザー番号、それ以外はスレッド番号）に分割します"""
+        if table == "users":
+            return [(0, self.users)]
+        size = max(1, SEED_CHUNK_STEPS // max(1, self.steps_per_thread))
+        return [(start, min(start + size, self.threads)) for start in range(0, self.threads, size)]
 
-        if user:
-            logger.info(f"既存ユーザー '{identifier}' を更新します")
-            user.metadata_ = metadata
-        else:
-            logger.info(f"新規ユーザー '{identifier}' を作成します")
-            user = User(
-                identifier=identifier,
-                metadata_=metadata,
-                createdAt=datetime.now().isoformat()
+    def records(self, table: str, start: int, stop: int):
+        return getattr(self, f"_{table}")(start, stop)
+
+    def _users(self, start: int, stop: int):
+        created = _timestamp(self.now - timedelta(days=365))
+        for u in range(start, stop):
+            yield (self.id("users", u), f"{SEED_USER_PREFIX}{u}", '{"role": "user"}', created)
+
+    def _thread_rng(self, t: int) -> random.Random:
+        return random.Random(self.seed * 1_000_003 + t)
+
+    def _thread_created(self, rng: random.Random) -> datetime:
+        # 直近 1 年に分散させる
+        return self.now - timedelta(minutes=rng.randrange(525600))
+
+    def _threads(self, start: int, stop: int):
+        for t in range(start, stop):
+            rng = self._thread_rng(t)
+            u = t // self.threads_per_user
+            # timestamptz 列はトリガーを止めて投入するため、文字列の時刻と同じ値を直接入れる
+            created = self._thread_created(rng).replace(tzinfo=timezone.utc)
+            yield (
+                self.id("threads", t),
+                _timestamp(created),
+                created,
+                SEED_PHRASES[rng.randrange(len(SEED_PHRASES))][:30],
+                self.id("users", u),
+                f"{SEED_USER_PREFIX}{u}",
+                None,
+                "{}",
             )
-            db.add(user)
 
-        # 変更をコミット
-        db.commit()
-        logger.info(f"ユーザー '{identifier}' の設定が完了しました")
+    def _steps(self, start: int, stop: int):
+        for t in range(start, stop):
+            rng = self._thread_rng(t)
+            created = self._thread_created(rng).replace(tzinfo=timezone.utc)
+            thread_id = self.id("threads", t)
+            for s in range(self.steps_per_thread):
+                at = created + timedelta(seconds=s * 5)
+                moment = _timestamp(at)
+                output = self.outputs[rng.getrandbits(SEED_OUTPUT_BITS)]
+                if s % 2 == 0:
+                    yield (
+                        self.id("steps", t * self.steps_per_thread + s), "user", "user_message", thread_id,
+                        False, "{}", output, moment, moment, moment, at, at, at, "{}", "json",
+                    )
+                else:
+                    tokens = len(output)
+                    generation = (
+                        f'{{"type": "CHAT", "model": "gpt-35-turbo", "inputTokenCount": {s * 40}, '
+                        f'"outputTokenCount": {tokens}, "ttFirstToken": {200 + rng.getrandbits(10)}}}'
+                    )
+                    yield (
+                        self.id("steps", t * self.steps_per_thread + s), "Assistant", "assistant_message", thread_id,
+                        False, "{}", output, moment, moment, moment, at, at, at, generation, "json",
+                    )
 
-        return user
-    except Exception as e:
-        db.rollback()
-        logger.error(f"ユーザー '{identifier}' の作成/更新中にエラーが発生しました: {e}")
-        raise
+    def _feedbacks(self, start: int, stop: int):
+        for t in range(start, stop):
+            rng = random.Random(f"feedbacks:{self.seed}:{t}")
+            thread_id = self.id("threads", t)
+            for k in range(self.feedbacks_per_thread):
+                n = t * self.feedbacks_per_thread + k
+                step = t * self.steps_per_thread + 2 * k + 1
+                value = 1 if rng.random() < 0.8 else 0
+                comment = None if value else "回答が質問に合っていません"
+                yield (self.id("feedbacks", n), self.id("steps", step), thread_id, value, comment)
+
+    def _elements(self, start: int, stop: int):
+        for t in range(start, stop):
+            thread_id = self.id("threads", t)
+            for k in range(self.elements_per_thread):
+                n = t * self.elements_per_thread + k
+                step = t * self.steps_per_thread + 2 * k
+                # Blob は作成しないため objectKey は設定しない
+                yield (
+                    self.id("elements", n), thread_id, "file", f"seed-{n}.txt", "inline",
+                    None, "text/plain", self.id("steps", step), 1024,
+                )
+
+
+def copy_chunk(plan: SeedPlan, table: str, start: int, stop: int, dsn: str) -> int:
+    """ワーカープロセスで 1 範囲分の行を生成しながら COPY し、投入した行数を返します"""
+
+    async def copy():
+        conn = await asyncpg.connect(dsn)
+        try:
+            status = await conn.copy_records_to_table(
+                table, records=plan.records(table, start, stop), columns=SEED_COLUMNS[table]
+            )
+        finally:
+            await conn.close()
+        return int(status.split()[-1])
+
+    return asyncio.run(copy())
+
+
+async def backfill_seeded(conn) -> dict:
+    """
+    トリガーを止めて投入した行の検索用の N-gram と応答の集計を、
+    トリガーと同じ関数を使ってテーブルごとに 1 回の UPDATE / INSERT ... SELECT で埋めます
+    """
+    pattern = f"{SEED_USER_PREFIX}%"
+    counts = {}
+    status = await conn.execute(
+        'UPDATE threads SET "searchGrams" = search_grams("name") WHERE "userIdentifier" LIKE $1', pattern
+    )
+    counts["threads"] = int(status.split()[-1])
+    # 本文は SEED_OUTPUT_BITS 個の候補から選んでいるため、N-gram は本文ごとに 1 回だけ求める
+    # （MATERIALIZED にしないと副問い合わせが展開され、ステップごとに計算される）
+    status = await conn.execute(
+        """
+        WITH grams AS MATERIALIZED (
+            SELECT "output", search_grams("output") AS "grams"
+            FROM (
+                SELECT DISTINCT s."output" FROM steps s JOIN threads t ON t."id" = s."threadId"
+                WHERE t."userIdentifier" LIKE $1
+            ) outputs
+        )
+        UPDATE steps AS s SET "searchGrams" = g."grams" || search_owner(t."userIdentifier")
+        FROM threads t, grams g
+        WHERE t."id" = s."threadId" AND t."userIdentifier" LIKE $1 AND g."output" = s."output"
+        """,
+        pattern,
+    )
+    counts["steps"] = int(status.split()[-1])
+
+    # 応答（使用量が記録された generation）とフィードバック（対象の応答の時刻とモデルに加算）を
+    # 1 行ずつ並べてから集計単位ごとにまとめる
+    responses = """
+        SELECT {key} AS "key", t."userIdentifier", COALESCE(s."generation" ->> 'model', '') AS "model",
+            1 AS "responses",
+            rollup_number(s."generation", 'inputTokenCount') AS "promptTokens",
+            rollup_number(s."generation", 'outputTokenCount') AS "completionTokens",
+            rollup_number(s."generation", 'ttFirstToken') / 1000 AS "ttftSecondsSum",
+            rollup_number(s."generation", 'duration') AS "durationSecondsSum",
+            0 AS "feedbackUp", 0 AS "feedbackDown"
+        FROM steps s JOIN threads t ON t."id" = s."threadId"
+        WHERE t."userIdentifier" LIKE $1 AND s."generation" ? 'inputTokenCount' AND s."createdAtTs" IS NOT NULL
+        UNION ALL
+        SELECT {key}, t."userIdentifier", COALESCE(s."generation" ->> 'model', ''), 0, 0, 0, 0, 0,
+            (f."value" > 0)::int, (f."value" <= 0)::int
+        FROM feedbacks f JOIN steps s ON s."id" = f."forId" JOIN threads t ON t."id" = f."threadId"
+        WHERE t."userIdentifier" LIKE $1 AND s."createdAtTs" IS NOT NULL
+    """
+    counters = (
+        "responses", "promptTokens", "completionTokens", "ttftSecondsSum", "durationSecondsSum",
+        "feedbackUp", "feedbackDown",
+    )
+    sums = ", ".join(f'sum("{c}")' for c in counters)
+    updates = ", ".join(f'"{c}" = r."{c}" + EXCLUDED."{c}"' for c in counters)
+    for table, key, expression in SEED_ROLLUPS:
+        columns = ", ".join(f'"{c}"' for c in (key, "userIdentifier", "model") + counters)
+        status = await conn.execute(
+            f"""
+            INSERT INTO {table} AS r ({columns})
+            SELECT "key", "userIdentifier", "model", {sums}
+            FROM ({responses.format(key=expression.format(ts='s."createdAtTs"'))}) rows
+            GROUP BY 1, 2, 3
+            ON CONFLICT ("{key}", "userIdentifier", "model") DO UPDATE SET {updates}, "updatedAt" = now()
+            """,
+            pattern,
+        )
+        counts[table] = int(status.split()[-1])
+    return counts
+
+
+async def seed_bulk(plan: SeedPlan, workers: int, replace: bool = False) -> list[dict]:
+    """
+    COPY でユーザー → スレッド → ステップ・エレメント・フィードバックの順に投入し、
+    テーブルごとの行数と毎秒の行数を返します。同じ段階のテーブルは並列に投入します。
+    投入中は SEED_TRIGGER_TABLES のトリガーを止める（テーブル単位の設定のため、
+    アプリケーションからの書き込みも集計などから漏れる。アプリケーションを止めて実行してください）。
+    """
+    dsn = postgres_dsn()
+    conn = await asyncpg.connect(dsn)
+    try:
+        existing = await conn.fetchval("SELECT count(*) FROM users WHERE identifier LIKE $1", f"{SEED_USER_PREFIX}%")
+        if existing and not replace:
+            raise SystemExit(f"投入済みのデータ（{existing} ユーザー）があります。削除して投入し直す場合は --replace を指定してください")
+        if existing:
+            logger.info(f"投入済みの {existing} ユーザーとそのスレッドを削除しています...")
+            await conn.execute("DELETE FROM users WHERE identifier LIKE $1", f"{SEED_USER_PREFIX}%")
+            # 削除したスレッドの応答は集計から引かれないため、投入し直す前に集計も削除する
+            for table in ("response_rollup_hourly", "response_rollup_daily"):
+                await conn.execute(f'DELETE FROM {table} WHERE "userIdentifier" LIKE $1', f"{SEED_USER_PREFIX}%")
+        for table in SEED_TRIGGER_TABLES:
+            await conn.execute(f"ALTER TABLE {table} DISABLE TRIGGER USER")
+        seeding_started = time.perf_counter()
+        try:
+            report = await _copy_all(plan, workers, dsn)
+            started = time.perf_counter()
+            async with conn.transaction():
+                counts = await backfill_seeded(conn)
+        finally:
+            for table in SEED_TRIGGER_TABLES:
+                await conn.execute(f"ALTER TABLE {table} ENABLE TRIGGER USER")
+        seconds = time.perf_counter() - started
+        rows = counts["threads"] + counts["steps"]
+        logger.info(f"検索用の N-gram と集計を埋めました: {counts} ({seconds:.1f} 秒)")
+        report.append({"table": "backfill", "rows": rows, "seconds": seconds, "rows_per_s": rows / seconds})
+        total = sum(row["rows"] for row in report if row["table"] != "backfill")
+        seconds = time.perf_counter() - seeding_started
+        report.append({"table": "total", "rows": total, "seconds": seconds, "rows_per_s": total / seconds})
+
+        # 投入後の統計情報を更新し、計測時の実行計画を実運用に近づける。
+        # バックフィルの UPDATE で残った古い行も回収する
+        await conn.execute("VACUUM ANALYZE users, threads, steps, elements, feedbacks")
+    finally:
+        await conn.close()
+    return report
+
+
+async def _copy_all(plan: SeedPlan, workers: int, dsn: str) -> list[dict]:
+    """段階ごとに COPY を並列に実行し、段階ごとの経過時間をテーブルごとに返します"""
+    loop = asyncio.get_running_loop()
+    report = []
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        # 外部キーの参照先から順に投入する
+        for tables in (("users",), ("threads",), ("steps", "elements", "feedbacks")):
+            tables = [table for table in tables if plan.rows(table)]
+            started = time.perf_counter()
+            finished = {table: 0 for table in tables}
+
+            async def run_table(table):
+                async def run_chunk(start, stop):
+                    rows = await loop.run_in_executor(pool, copy_chunk, plan, table, start, stop, dsn)
+                    finished[table] += rows
+                    elapsed = time.perf_counter() - started
+                    logger.info(f"{table}: {finished[table]}/{plan.rows(table)} 行 ({finished[table] / elapsed:.0f} 行/秒)")
+
+                await asyncio.gather(*(run_chunk(start, stop) for start, stop in plan.chunks(table)))
+                return time.perf_counter() - started
+
+            elapsed = await asyncio.gather(*(run_table(table) for table in tables))
+            for table, seconds in zip(tables, elapsed):
+                report.append({"table": table, "rows": finished[table], "seconds": seconds, "rows_per_s": finished[table] / seconds})
+    return report
+
+
+async def run(args):
+    try:
+        # データベースの初期化
+        await setup_database()
+
+        # デフォルトユーザーの作成
+        await seed_user(args.identifier)
+
+        if args.users:
+            plan = SeedPlan(
+                users=args.users,
+                threads_per_user=args.threads_per_user,
+                steps_per_thread=args.steps_per_thread,
+                feedbacks_per_thread=args.feedbacks_per_thread,
+                elements_per_thread=args.elements_per_thread,
+                seed=args.seed,
+            )
+            logger.info(f"{plan.rows('steps')} ステップを {args.workers} プロセスで投入します")
+            for row in await seed_bulk(plan, args.workers, replace=args.replace):
+                logger.info(f"{row['table']}: {row['rows']} 行 / {row['seconds']:.1f} 秒 ({row['rows_per_s']:.0f} 行/秒)")
+    finally:
+        await get_engine().dispose()
 
 def main():
     parser = argparse.ArgumentParser(description='データベースのシード処理を実行します')
     parser.add_argument('--identifier', default="shuntagami23@gmail.com", help='ユーザーのメールアドレス')
+    # --users を指定すると、性能試験用のデータを COPY で一括投入する
+    parser.add_argument('--users', type=int, default=0, help='一括投入するユーザー数（0 なら投入しない）')
+    parser.add_argument('--threads-per-user', type=int, default=50)
+    parser.add_argument('--steps-per-thread', type=int, default=20)
+    parser.add_argument('--feedbacks-per-thread', type=int, default=2)
+    parser.add_argument('--elements-per-thread', type=int, default=0)
+    parser.add_argument('--seed', type=int, default=42, help='乱数シード（同じ値なら同じデータを投入する）')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='COPY を並列に実行するプロセス数')
+    parser.add_argument('--replace', action='store_true', help='投入済みの一括投入データを削除してから投入する')
 
     args = parser.parse_args()
 
-    # データベースの初期化
-    setup_database()
-
-    # デフォルトユーザーの作成
-    seed_user(args.identifier)
+    asyncio.run(run(args))
 
     logger.info("シード処理が完了しました")
 
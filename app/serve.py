@@ -0,0 +1,60 @@
+"""
+複数のワーカープロセスでアプリケーションを起動します。
+各ワーカーは chainlit run と同じ初期化を行ってから、待ち受けソケットを共有して接続を受け付けます。
+会話履歴は SESSION_STORE、socket.io のワーカー間の配信は SOCKETIO_ADAPTER で共有します。
+
+    cd app && WEB_CONCURRENCY=4 python serve.py --host 0.0.0.0 --port 8000
+"""
+import argparse
+import os
+
+import uvicorn
+
+from settings import Config
+
+
+def create_app():
+    """ワーカーごとに呼ばれ、app.py を読み込んだ Chainlit の ASGI アプリケーションを返します"""
+    from chainlit.cli import assert_app, check_file, ensure_jwt_secret, init_markdown
+    from chainlit.config import config, load_module
+    from chainlit.server import app
+
+    config.run.host = os.environ.get("CHAINLIT_HOST", "127.0.0.1")
+    config.run.port = int(os.environ.get("CHAINLIT_PORT", "8000"))
+    config.run.root_path = os.environ.get("CHAINLIT_ROOT_PATH", "")
+    config.run.headless = True
+
+    check_file("app.py")
+    config.run.module_name = "app.py"
+    load_module(config.run.module_name)
+    ensure_jwt_secret()
+    assert_app()
+    init_markdown(config.root)
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="複数ワーカーでの起動")
+    parser.add_argument("--host", default=os.environ.get("CHAINLIT_HOST", "127.0.0.1"))
+    parser.add_argument("--port", type=int, default=int(os.environ.get("CHAINLIT_PORT", "8000")))
+    parser.add_argument("--workers", type=int, default=Config.WEB_CONCURRENCY)
+    args = parser.parse_args()
+
+    # ワーカーの create_app() が参照する
+    os.environ["CHAINLIT_HOST"] = args.host
+    os.environ["CHAINLIT_PORT"] = str(args.port)
+    uvicorn.run(
+        "serve:create_app",
+        factory=True,
+        host=args.host,
+        port=args.port,
+        workers=args.workers,
+        # chainlit run と同様に uvloop ではなく asyncio のイベントループを使う
+        loop="asyncio",
+        ws_per_message_deflate=os.environ.get("UVICORN_WS_PER_MESSAGE_DEFLATE", "true").lower() in ("true", "1", "yes"),
+        log_level="error",
+    )
+
+
+if __name__ == "__main__":
+    main()
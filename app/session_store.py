@@ -0,0 +1,181 @@
+import asyncio
+import logging
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import delete, select
+from sqlalchemy.dialects.postgresql import insert
+
+import metrics
+from cache import TTLCache
+from models import SessionState
+from settings import Config, get_engine
+
+logger = logging.getLogger(__name__)
+
+SESSION_STORE_EVICTIONS = metrics.counter(
+    "session_store_evictions_total",
+    "Unexpired session states evicted from the in-memory session store because it was full",
+)
+
+
+class SessionStore:
+    """
+    会話履歴などのセッション状態を JSON に変換できる dict として保持する保存先。
+    複数ワーカーで起動した場合、再接続したセッションが別のワーカーに振り分けられても
+    同じ状態を参照できるよう、ワーカー間で共有する実装を使います。
+    """
+
+    async def get(self, key: str) -> dict | None:
+        raise NotImplementedError
+
+    async def set(self, key: str, value: dict) -> None:
+        raise NotImplementedError
+
+    async def delete(self, key: str) -> None:
+        raise NotImplementedError
+
+    def set_later(self, key: str, value: dict) -> None:
+        """
+        書き込みを待たずに返ります。応答の後の会話履歴の保存など、リクエストの経路で
+        完了を待つ必要のない書き込みに使います。反映前の値も同じワーカーの get からは見えます。
+        """
+        raise NotImplementedError
+
+    async def flush(self) -> None:
+        """set_later の書き込みのうち、未反映のものを反映します"""
+
+    async def close(self) -> None:
+        await self.flush()
+
+
+class MemorySessionStore(SessionStore):
+    """
+    プロセス内に保持する実装。単一ワーカーでの起動や動作確認用。
+    SESSION_STORE_MEMORY_SIZE を超えると古いセッションから追い出すため、追い出した場合は警告を記録して数えます
+    （同時に接続するセッション数より大きく設定してください）。
+    """
+
+    def __init__(self, maxsize: int | None = None, ttl: float | None = None):
+        self.cache = TTLCache(
+            Config.SESSION_STORE_MEMORY_SIZE if maxsize is None else maxsize,
+            Config.SESSION_STORE_TTL if ttl is None else ttl,
+        )
+
+    async def get(self, key: str) -> dict | None:
+        return self.cache.get(key)
+
+    async def set(self, key: str, value: dict) -> None:
+        self.set_later(key, value)
+
+    async def delete(self, key: str) -> None:
+        self.cache.pop(key)
+
+    def set_later(self, key: str, value: dict) -> None:
+        evictions = self.cache.evictions
+        self.cache.set(key, value)
+        if evicted := self.cache.evictions - evictions:
+            SESSION_STORE_EVICTIONS.inc(evicted)
+            logger.warning(
+                f"セッションストアが上限（SESSION_STORE_MEMORY_SIZE={self.cache.maxsize}）に達したため、"
+                f"失効前のセッション状態を {evicted} 件削除しました"
+            )
+
+
+class PostgresSessionStore(SessionStore):
+    """
+    session_state テーブルに保持する実装。
+    書き込みのたびに有効期限を延長し、期限切れの行は一定回数の書き込みごとに削除します。
+    set_later の書き込みはキーごとに最新の値だけを溜め、バックグラウンドで 1 回の upsert にまとめて反映します。
+    """
+
+    def __init__(self, engine=None, ttl: int | None = None):
+        self.engine = engine
+        self.ttl = Config.SESSION_STORE_TTL if ttl is None else ttl
+        self._sets_since_prune = 0
+        # set_later で溜めた key -> value
+        self._pending: dict[str, dict] = {}
+        self._flush_task = None
+        # 古い値で新しい値を上書きしないよう、書き込みを直列にする
+        self._write_lock = asyncio.Lock()
+
+    def _engine(self):
+        return self.engine or get_engine()
+
+    async def get(self, key: str) -> dict | None:
+        if key in self._pending:
+            return self._pending[key]
+        table = SessionState.__table__
+        try:
+            async with self._engine().connect() as conn:
+                result = await conn.execute(
+                    select(table.c.data).where(table.c.key == key, table.c.expiresAt > datetime.now(timezone.utc))
+                )
+                return result.scalar()
+        except Exception as e:
+            logger.warning(f"セッション状態の読み込みに失敗しました: {e}")
+            return None
+
+    async def set(self, key: str, value: dict) -> None:
+        async with self._write_lock:
+            self._pending.pop(key, None)
+            await self._write({key: value})
+
+    def set_later(self, key: str, value: dict) -> None:
+        self._pending[key] = value
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.get_running_loop().create_task(self.flush())
+
+    async def flush(self) -> None:
+        async with self._write_lock:
+            while self._pending:
+                values, self._pending = self._pending, {}
+                await self._write(values)
+
+    async def _write(self, values: dict[str, dict]) -> None:
+        """key -> value を 1 回の upsert で書き込み、有効期限を延長します"""
+        table = SessionState.__table__
+        now = datetime.now(timezone.utc)
+        expires_at = now + timedelta(seconds=self.ttl)
+        stmt = insert(table).values([
+            {"key": key, "data": value, "updatedAt": now, "expiresAt": expires_at} for key, value in values.items()
+        ])
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[table.c.key],
+            set_={"data": stmt.excluded.data, "updatedAt": stmt.excluded.updatedAt, "expiresAt": stmt.excluded.expiresAt},
+        )
+        try:
+            async with self._engine().begin() as conn:
+                await conn.execute(stmt)
+            self._sets_since_prune += len(values)
+            if self._sets_since_prune >= Config.SESSION_STORE_PRUNE_EVERY:
+                self._sets_since_prune = 0
+                await self.prune()
+        except Exception as e:
+            logger.warning(f"セッション状態の保存に失敗しました: {e}")
+
+    async def delete(self, key: str) -> None:
+        table = SessionState.__table__
+        async with self._write_lock:
+            self._pending.pop(key, None)
+            try:
+                async with self._engine().begin() as conn:
+                    await conn.execute(delete(table).where(table.c.key == key))
+            except Exception as e:
+                logger.warning(f"セッション状態の削除に失敗しました: {e}")
+
+    async def prune(self) -> int:
+        """期限切れの行を削除し、削除件数を返します"""
+        table = SessionState.__table__
+        async with self._engine().begin() as conn:
+            result = await conn.execute(delete(table).where(table.c.expiresAt <= datetime.now(timezone.utc)))
+        return result.rowcount
+
+
+def create_session_store(kind: str | None = None) -> SessionStore:
+    """SESSION_STORE（memory / postgres）に応じた保存先を作成します"""
+    kind = kind or Config.SESSION_STORE
+    if kind == "postgres":
+        return PostgresSessionStore()
+    if kind == "memory":
+        return MemorySessionStore()
+    raise ValueError(f"Unknown SESSION_STORE: {kind}")
@@ -1,7 +1,9 @@
 import os
-from sqlalchemy import create_engine
-from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+import time
+from urllib.parse import urlsplit, urlunsplit
+
+import metrics
+
 class Config:
     # Database settings
     DB_HOST = os.getenv("APP_DATABASE_HOST")
@@ -11,27 +13,257 @@ class Config:
     DATABASE_URL = f"postgresql://{DB_USERNAME}:{DB_PASSWORD}@{DB_HOST}:5432/{DB_NAME}"
     ASYNC_DATABASE_URL = f"postgresql+asyncpg://{DB_USERNAME}:{DB_PASSWORD}@{DB_HOST}:5432/{DB_NAME}"
 
+    # Database pool settings
+    DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+    DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "5"))
+    DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+    DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+    DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "true").lower() == "true"
+    DB_STATEMENT_CACHE_SIZE = int(os.getenv("DB_STATEMENT_CACHE_SIZE", "100"))
+
     # OpenAI settings
     OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
     OPENAI_API_VERSION = os.getenv("OPENAI_API_VERSION")
 
     AZURE_OPENAI_ENDPOINT = os.getenv("AZURE_OPENAI_ENDPOINT")
+    # 複数デプロイメントの JSON 配列（未設定なら AZURE_OPENAI_ENDPOINT のみ）
+    # 例: [{"name": "japaneast", "endpoint": "https://...", "api_key": "...", "model": "gpt-35-turbo"}]
+    AZURE_OPENAI_DEPLOYMENTS = os.getenv("AZURE_OPENAI_DEPLOYMENTS", "")
+
+    # OpenAI deployment routing
+    OPENAI_ROUTER_INITIAL_LATENCY = float(os.getenv("OPENAI_ROUTER_INITIAL_LATENCY", "1"))
+    OPENAI_ROUTER_LATENCY_ALPHA = float(os.getenv("OPENAI_ROUTER_LATENCY_ALPHA", "0.2"))
+    OPENAI_CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("OPENAI_CIRCUIT_FAILURE_THRESHOLD", "3"))
+    OPENAI_CIRCUIT_COOLDOWN = float(os.getenv("OPENAI_CIRCUIT_COOLDOWN", "30"))
+
+    # OpenAI request scheduling (0 = unlimited)
+    OPENAI_MAX_CONCURRENT_STREAMS = int(os.getenv("OPENAI_MAX_CONCURRENT_STREAMS", "20"))
+    OPENAI_TOKENS_PER_MINUTE = float(os.getenv("OPENAI_TOKENS_PER_MINUTE", "0"))
+    OPENAI_REQUESTS_PER_MINUTE = float(os.getenv("OPENAI_REQUESTS_PER_MINUTE", "0"))
+    OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", "3"))
+    OPENAI_RETRY_BASE_DELAY = float(os.getenv("OPENAI_RETRY_BASE_DELAY", "1"))
+    OPENAI_RETRY_MAX_DELAY = float(os.getenv("OPENAI_RETRY_MAX_DELAY", "30"))
     # Azure Storage settings
     AZURE_STORAGE_ACCOUNT = os.getenv("AZURE_STORAGE_ACCOUNT")
     AZURE_STORAGE_KEY = os.getenv("AZURE_STORAGE_KEY")
     BLOB_CONTAINER_NAME = os.getenv("BLOB_CONTAINER_NAME")
+    # アカウント名が devstoreaccount1（Azurite）の場合の接続先
+    AZURITE_BLOB_ENDPOINT = os.getenv("AZURITE_BLOB_ENDPOINT", "http://azurite:10000/devstoreaccount1")
+    # ファイルはこのサイズのブロックに分けて並列にアップロード・範囲読み込みする
+    BLOB_BLOCK_SIZE = int(os.getenv("BLOB_BLOCK_SIZE", str(4 * 1024 * 1024)))
+    BLOB_UPLOAD_CONCURRENCY = int(os.getenv("BLOB_UPLOAD_CONCURRENCY", "4"))
+    # 読み込み用の署名付き URL は有効期限の BLOB_URL_SAFETY_MARGIN 秒前まで使い回す
+    BLOB_URL_EXPIRY = int(os.getenv("BLOB_URL_EXPIRY", "86400"))
+    BLOB_URL_SAFETY_MARGIN = int(os.getenv("BLOB_URL_SAFETY_MARGIN", "900"))
+    BLOB_URL_CACHE_SIZE = int(os.getenv("BLOB_URL_CACHE_SIZE", "10000"))
+
+    # Write-behind settings
+    WRITE_BEHIND_ENABLED = os.getenv("WRITE_BEHIND_ENABLED", "true").lower() == "true"
+    WRITE_BEHIND_FLUSH_INTERVAL_MS = float(os.getenv("WRITE_BEHIND_FLUSH_INTERVAL_MS", "500"))
+    WRITE_BEHIND_MAX_BATCH = int(os.getenv("WRITE_BEHIND_MAX_BATCH", "500"))
+    WRITE_BEHIND_MAX_RETRIES = int(os.getenv("WRITE_BEHIND_MAX_RETRIES", "3"))
+
+    # Thread list cache settings
+    THREAD_LIST_CACHE_SIZE = int(os.getenv("THREAD_LIST_CACHE_SIZE", "1000"))
+    THREAD_LIST_CACHE_TTL = float(os.getenv("THREAD_LIST_CACHE_TTL", "60"))
+    THREAD_LIST_CACHE_PAGES = int(os.getenv("THREAD_LIST_CACHE_PAGES", "3"))
+    THREAD_OWNER_CACHE_SIZE = int(os.getenv("THREAD_OWNER_CACHE_SIZE", "10000"))
+
+    # Thread resume settings
+    # 再開時に読み込む直近のステップ数（0 で全件）。古いステップは THREAD_STEPS_PAGE_SIZE 件ずつ取得する
+    THREAD_RESUME_STEPS = int(os.getenv("THREAD_RESUME_STEPS", "500"))
+    THREAD_STEPS_PAGE_SIZE = int(os.getenv("THREAD_STEPS_PAGE_SIZE", "100"))
+
+    # Search settings
+    # 検索結果の 1 ページの件数と、スレッド名に一致した場合の関連度の倍率
+    SEARCH_PAGE_SIZE = int(os.getenv("SEARCH_PAGE_SIZE", "20"))
+    SEARCH_NAME_WEIGHT = float(os.getenv("SEARCH_NAME_WEIGHT", "2"))
+    SEARCH_SNIPPET_CHARS = int(os.getenv("SEARCH_SNIPPET_CHARS", "80"))
+
+    # Completion cache settings
+    # 有効にすると、同じ会話履歴・設定への応答は temperature によらず最初の応答を再利用する（明示的に有効にする）
+    COMPLETION_CACHE_ENABLED = os.getenv("COMPLETION_CACHE_ENABLED", "false").lower() == "true"
+    COMPLETION_CACHE_DB_ENABLED = os.getenv("COMPLETION_CACHE_DB_ENABLED", "true").lower() == "true"
+    COMPLETION_CACHE_TTL = int(os.getenv("COMPLETION_CACHE_TTL", "86400"))
+    COMPLETION_CACHE_MEMORY_SIZE = int(os.getenv("COMPLETION_CACHE_MEMORY_SIZE", "1000"))
+    COMPLETION_CACHE_DB_MAX_ROWS = int(os.getenv("COMPLETION_CACHE_DB_MAX_ROWS", "100000"))
+    COMPLETION_CACHE_PRUNE_EVERY = int(os.getenv("COMPLETION_CACHE_PRUNE_EVERY", "500"))
+
+    # Conversation context settings
+    MODEL_CONTEXT_WINDOW = int(os.getenv("MODEL_CONTEXT_WINDOW", "16385"))
+    CONTEXT_MAX_PROMPT_TOKENS = int(os.getenv("CONTEXT_MAX_PROMPT_TOKENS", "0"))
+    TOKENIZER_ENCODING = os.getenv("TOKENIZER_ENCODING", "cl100k_base")
+    # 本文をメモリに保持する直近のターン数（それより前は steps から読み戻す）
+    HISTORY_MEMORY_TURNS = int(os.getenv("HISTORY_MEMORY_TURNS", "20"))
+
+    # Streaming settings
+    STREAM_FLUSH_INTERVAL_MS = float(os.getenv("STREAM_FLUSH_INTERVAL_MS", "30"))
+    STREAM_FLUSH_MAX_CHARS = int(os.getenv("STREAM_FLUSH_MAX_CHARS", "256"))
+    # 切断から再接続を待つ秒数。過ぎても再接続しなければ OpenAI のストリームを閉じる（0 で即座に閉じる）
+    STREAM_DISCONNECT_GRACE = float(os.getenv("STREAM_DISCONNECT_GRACE", "5"))
+
+    # HTTP connection pool settings
+    OPENAI_HTTP_MAX_CONNECTIONS = int(os.getenv("OPENAI_HTTP_MAX_CONNECTIONS", "100"))
+    OPENAI_HTTP_MAX_KEEPALIVE = int(os.getenv("OPENAI_HTTP_MAX_KEEPALIVE", "20"))
+    OPENAI_HTTP_KEEPALIVE_EXPIRY = float(os.getenv("OPENAI_HTTP_KEEPALIVE_EXPIRY", "60"))
+    OPENAI_HTTP2_ENABLED = os.getenv("OPENAI_HTTP2_ENABLED", "true").lower() == "true"
+    BLOB_HTTP_MAX_CONNECTIONS = int(os.getenv("BLOB_HTTP_MAX_CONNECTIONS", "50"))
+    BLOB_HTTP_KEEPALIVE_TIMEOUT = float(os.getenv("BLOB_HTTP_KEEPALIVE_TIMEOUT", "60"))
+    HTTP_DNS_CACHE_TTL = int(os.getenv("HTTP_DNS_CACHE_TTL", "300"))
+
+    # Metrics settings
+    # /metrics 以下を読むための共有トークン（Authorization: Bearer で送る）。未設定なら /metrics 以下は 404 を返す
+    METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
+
+    # Startup warm-up settings
+    WARMUP_ENABLED = os.getenv("WARMUP_ENABLED", "true").lower() == "true"
+    WARMUP_TIMEOUT = float(os.getenv("WARMUP_TIMEOUT", "10"))
+
+    # Usage accounting settings
+    # ユーザー・日ごとの使用量は USAGE_FLUSH_INTERVAL 秒ごとにまとめて加算する
+    USAGE_FLUSH_INTERVAL = float(os.getenv("USAGE_FLUSH_INTERVAL", "5"))
+    USAGE_TIMEZONE = os.getenv("USAGE_TIMEZONE", "Asia/Tokyo")
+    # 1 日あたりのトークン数の上限（0 で無制限）と、ユーザーごとの上書きの JSON。例: {"someone@example.com": 200000}
+    USAGE_DAILY_TOKEN_QUOTA = int(os.getenv("USAGE_DAILY_TOKEN_QUOTA", "0"))
+    USAGE_USER_QUOTAS = os.getenv("USAGE_USER_QUOTAS", "")
+    # 他のワーカーの使用量を読み直すまでの秒数
+    USAGE_QUOTA_CACHE_TTL = float(os.getenv("USAGE_QUOTA_CACHE_TTL", "60"))
+    USAGE_QUOTA_CACHE_SIZE = int(os.getenv("USAGE_QUOTA_CACHE_SIZE", "10000"))
+
+    # Response rollup settings
+    # /project/rollups で期間を省略した場合の日数と、1 回に返す行数の上限
+    ROLLUP_DEFAULT_DAYS = int(os.getenv("ROLLUP_DEFAULT_DAYS", "30"))
+    ROLLUP_MAX_ROWS = int(os.getenv("ROLLUP_MAX_ROWS", "5000"))
+
+    # Multi-worker settings
+    # 1 より大きい場合は entrypoint.sh が serve.py で複数プロセスを起動する
+    WEB_CONCURRENCY = max(int(os.getenv("WEB_CONCURRENCY", "1")), 1)
+    # 会話履歴などのセッション状態の保存先: memory / postgres（未指定なら複数ワーカー時のみ postgres）
+    SESSION_STORE = os.getenv("SESSION_STORE", "") or ("postgres" if WEB_CONCURRENCY > 1 else "memory")
+    SESSION_STORE_TTL = int(os.getenv("SESSION_STORE_TTL", "86400"))
+    # memory の件数上限。超えると失効前の履歴も追い出すため、同時に接続するセッション数より大きくする
+    SESSION_STORE_MEMORY_SIZE = int(os.getenv("SESSION_STORE_MEMORY_SIZE", "10000"))
+    SESSION_STORE_PRUNE_EVERY = int(os.getenv("SESSION_STORE_PRUNE_EVERY", "500"))
+    # socket.io のワーカー間の配信: 空ならプロセス内のみ、postgres（LISTEN/NOTIFY）または redis://...
+    SOCKETIO_ADAPTER = os.getenv("SOCKETIO_ADAPTER", "") or ("postgres" if WEB_CONCURRENCY > 1 else "")
+    SOCKETIO_CHANNEL = os.getenv("SOCKETIO_CHANNEL", "chainlit_socketio")
+
+    # Retention settings
+    # 最後の発言から RETENTION_DAYS 日経過したスレッドのステップを圧縮して Blob に退避する
+    RETENTION_ENABLED = os.getenv("RETENTION_ENABLED", "false").lower() == "true"
+    RETENTION_INTERVAL = float(os.getenv("RETENTION_INTERVAL", "3600"))
+    RETENTION_DAYS = int(os.getenv("RETENTION_DAYS", "90"))
+    # ユーザーごとの保持日数の JSON（0 で退避しない）。例: {"someone@example.com": 365}
+    RETENTION_USER_POLICIES = os.getenv("RETENTION_USER_POLICIES", "")
+    # 1 トランザクションで退避するスレッド数と、バッチ間の待ち時間（秒）
+    RETENTION_BATCH_SIZE = int(os.getenv("RETENTION_BATCH_SIZE", "20"))
+    RETENTION_BATCH_DELAY = float(os.getenv("RETENTION_BATCH_DELAY", "1"))
+    RETENTION_ARCHIVE_PREFIX = os.getenv("RETENTION_ARCHIVE_PREFIX", "archive/")
+    # アップロード中のファイルを消さないよう、これより新しい Blob は孤立していても残す（秒）
+    RETENTION_ORPHAN_GRACE = float(os.getenv("RETENTION_ORPHAN_GRACE", "86400"))
+
+    # Tracing settings（送信先は OTEL_EXPORTER_OTLP_ENDPOINT などの標準の環境変数で指定）
+    TRACING_ENABLED = os.getenv("TRACING_ENABLED", "false").lower() == "true"
+    TRACING_SERVICE_NAME = os.getenv("TRACING_SERVICE_NAME", "azure-chainlit")
+
+DB_POOL_WAIT_SECONDS = metrics.histogram(
+    "db_pool_checkout_wait_seconds",
+    "Time spent waiting for a connection from the database pool",
+)
+DB_POOL_CHECKED_OUT = metrics.gauge(
+    "db_pool_checked_out_connections",
+    "Connections currently checked out of the database pool",
+)
+
+
+_pool_class = None
+
+
+def metered_pool_class():
+    """
+    接続の取得待ち時間をメトリクスに記録するコネクションプールのクラスを返します。
+    Config だけを参照するスクリプトやマイグレーションで SQLAlchemy の非同期拡張を読み込まないよう、
+    最初のエンジン作成時に定義します。
+    """
+    global _pool_class
+    if _pool_class is None:
+        from sqlalchemy.pool import AsyncAdaptedQueuePool
+
+        class MeteredAsyncQueuePool(AsyncAdaptedQueuePool):
+            def _do_get(self):
+                started = time.perf_counter()
+                try:
+                    return super()._do_get()
+                finally:
+                    DB_POOL_WAIT_SECONDS.observe(time.perf_counter() - started)
+
+        _pool_class = MeteredAsyncQueuePool
+    return _pool_class
+
+
+def create_engine(url: str | None = None, **overrides):
+    """環境変数のプール設定を反映した非同期エンジンを作成します"""
+    from sqlalchemy.ext.asyncio import create_async_engine
+
+    options = {
+        "poolclass": metered_pool_class(),
+        "pool_size": Config.DB_POOL_SIZE,
+        "max_overflow": Config.DB_MAX_OVERFLOW,
+        "pool_timeout": Config.DB_POOL_TIMEOUT,
+        "pool_recycle": Config.DB_POOL_RECYCLE,
+        "pool_pre_ping": Config.DB_POOL_PRE_PING,
+        "connect_args": {
+            "prepared_statement_cache_size": Config.DB_STATEMENT_CACHE_SIZE,
+            "statement_cache_size": Config.DB_STATEMENT_CACHE_SIZE,
+        },
+    }
+    options.update(overrides)
+    return create_async_engine(url or Config.ASYNC_DATABASE_URL, **options)
+
+
+_engine = None
+_sessionmaker = None
+
+
+def get_engine():
+    """プロセス内で共有する非同期エンジンを返します（初回呼び出し時に作成）"""
+    global _engine
+    if _engine is None:
+        _engine = create_engine()
+        DB_POOL_CHECKED_OUT.set_function(_engine.pool.checkedout)
+    return _engine
+
+
+def postgres_dsn(url: str | None = None) -> str:
+    """SQLAlchemy の URL（postgresql+asyncpg://...）を asyncpg の DSN に変換します"""
+    parts = urlsplit(url or Config.ASYNC_DATABASE_URL)
+    return urlunsplit(parts._replace(scheme="postgresql"))
+
+
+def pool_stats() -> dict:
+    """共有プールの利用状況と接続取得待ち時間の集計を返します"""
+    pool = get_engine().pool
+    buckets = dict(zip(DB_POOL_WAIT_SECONDS.buckets, DB_POOL_WAIT_SECONDS.samples().get((), [])))
+    return {
+        "size": pool.size(),
+        "checked_out": pool.checkedout(),
+        "overflow": pool.overflow(),
+        "checkout_wait": {
+            "count": DB_POOL_WAIT_SECONDS.count(),
+            "sum_seconds": DB_POOL_WAIT_SECONDS.sum(),
+            "buckets": buckets,
+        },
+    }
+
 
-# Initialize database engine and session
-engine = create_engine(Config.DATABASE_URL)
-Base = declarative_base()
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+def get_sessionmaker():
+    """共有エンジンに紐づいた AsyncSession のファクトリを返します"""
+    from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
 
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
+    global _sessionmaker
+    if _sessionmaker is None:
+        _sessionmaker = async_sessionmaker(bind=get_engine(), expire_on_commit=False, class_=AsyncSession)
+    return _sessionmaker
 
 def chat_settings():
     return {
@@ -41,5 +273,7 @@ def chat_settings():
         "top_p": 1,
         "frequency_penalty": 0,
         "presence_penalty": 0,
-        "stream": True
+        "stream": True,
+        # 最後のチャンクでトークン数を受け取る
+        "stream_options": {"include_usage": True},
     }
@@ -0,0 +1,118 @@
+import asyncio
+import logging
+
+import asyncpg
+import socketio
+from socketio.async_pubsub_manager import AsyncPubSubManager
+
+import metrics
+from settings import Config, postgres_dsn
+
+logger = logging.getLogger(__name__)
+
+SOCKETIO_PUBLISHED = metrics.counter(
+    "socketio_adapter_published_total",
+    "Socket.IO messages published to other workers",
+    labelnames=("method",),
+)
+
+# NOTIFY のペイロードの上限（8000 バイト未満）
+NOTIFY_MAX_BYTES = 7999
+# LISTEN の接続が切れた場合に再接続するまでの秒数
+RECONNECT_DELAY = 1.0
+
+
+class LocalFirstMixin:
+    """
+    宛先のセッションがこのプロセスに接続している場合は、他のワーカーに配信せずに送信します。
+    ストリーミング中のトークンは全て接続中のセッション宛てのため、ワーカー数が増えても
+    pub/sub の通信量はワーカー間で実際に必要なメッセージの分しか増えません。
+    """
+
+    async def emit(self, event, data, namespace=None, room=None, skip_sid=None, callback=None, to=None, **kwargs):
+        room = to or room
+        if isinstance(room, str) and self.is_connected(room, namespace or "/"):
+            kwargs["ignore_queue"] = True
+        return await super().emit(event, data, namespace=namespace, room=room, skip_sid=skip_sid, callback=callback, **kwargs)
+
+    async def _publish(self, data):
+        SOCKETIO_PUBLISHED.inc(method=data.get("method", ""))
+        await super()._publish(data)
+
+
+class _PostgresPubSub(AsyncPubSubManager):
+    """Postgres の LISTEN/NOTIFY でワーカー間に配信するクライアントマネージャー"""
+
+    name = "postgres"
+
+    def __init__(self, dsn: str, channel: str = "socketio", write_only: bool = False, logger=None):
+        super().__init__(channel=channel, write_only=write_only, logger=logger)
+        self.dsn = dsn
+        self._conn = None
+        self._lock = asyncio.Lock()
+
+    async def _publish(self, data):
+        payload = self.json.dumps(data)
+        if len(payload.encode()) > NOTIFY_MAX_BYTES:
+            logger.warning(f"socket.io のメッセージが NOTIFY の上限を超えるため他のワーカーに配信しません: {data.get('event')}")
+            return
+        # 送信用の接続は 1 本を使い回す（asyncpg の接続は同時に使えないためロックする）
+        async with self._lock:
+            if self._conn is None or self._conn.is_closed():
+                self._conn = await asyncpg.connect(self.dsn)
+            await self._conn.execute("SELECT pg_notify($1, $2)", self.channel, payload)
+
+    async def _listen(self):
+        queue = asyncio.Queue()
+        conn = await asyncpg.connect(self.dsn)
+        try:
+            await conn.add_listener(self.channel, lambda _conn, _pid, _channel, payload: queue.put_nowait(payload))
+            conn.add_termination_listener(lambda _conn: queue.put_nowait(None))
+            while (payload := await queue.get()) is not None:
+                yield payload
+        finally:
+            await conn.close()
+        # 呼び出し元（_thread）が例外を受けて _listen をやり直す
+        logger.warning("socket.io の LISTEN 接続が切断されたため再接続します")
+        await asyncio.sleep(RECONNECT_DELAY)
+        raise ConnectionError("LISTEN connection closed")
+
+
+class PostgresPubSubManager(LocalFirstMixin, _PostgresPubSub):
+    """
+    Redis を用意せずにアプリの DB だけで複数ワーカーを構成するためのクライアントマネージャー。
+    NOTIFY のペイロードには上限があるため、超えるメッセージは配信せずに警告を出します。
+    """
+
+
+class RedisPubSubManager(LocalFirstMixin, socketio.AsyncRedisManager):
+    """Redis の pub/sub でワーカー間に配信するクライアントマネージャー"""
+
+
+def create_client_manager(adapter: str | None = None):
+    """SOCKETIO_ADAPTER に応じたクライアントマネージャーを作成します。空ならプロセス内のみ"""
+    adapter = Config.SOCKETIO_ADAPTER if adapter is None else adapter
+    if not adapter:
+        return None
+    if adapter == "postgres":
+        return PostgresPubSubManager(postgres_dsn(), channel=Config.SOCKETIO_CHANNEL)
+    if adapter.startswith(("redis://", "rediss://")):
+        try:
+            import redis.asyncio  # noqa: F401
+        except ImportError as e:
+            raise RuntimeError("SOCKETIO_ADAPTER に Redis を指定する場合は redis パッケージが必要です") from e
+        return RedisPubSubManager(adapter, channel=Config.SOCKETIO_CHANNEL)
+    raise ValueError(f"Unknown SOCKETIO_ADAPTER: {adapter}")
+
+
+def install_client_manager(sio: socketio.AsyncServer, adapter: str | None = None) -> bool:
+    """Chainlit の socket.io サーバーのクライアントマネージャーを差し替えます（最初の接続より前に呼ぶ）"""
+    manager = create_client_manager(adapter)
+    if manager is None:
+        return False
+    if sio.manager_initialized:
+        raise RuntimeError("socket.io のクライアントマネージャーは接続を受け付ける前に差し替える必要があります")
+    sio.manager = manager
+    manager.set_server(sio)
+    logger.info(f"socket.io のワーカー間配信に {manager.name} を使用します")
+    return True
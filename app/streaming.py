@@ -0,0 +1,230 @@
+import asyncio
+import time
+
+import metrics
+from settings import Config
+
+STREAM_CHUNK_INTERVAL_SECONDS = metrics.histogram(
+    "chat_stream_chunk_interval_seconds",
+    "Time between consecutive OpenAI stream chunks",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5),
+)
+STREAM_TOKENS_PER_SECOND = metrics.histogram(
+    "chat_stream_tokens_per_second",
+    "Content chunks per second from the first chunk to the end of the stream",
+    buckets=(5, 10, 20, 40, 60, 80, 120, 200, 400, 1000),
+)
+STREAM_TOKENS = metrics.counter(
+    "chat_stream_tokens_total",
+    "Content chunks relayed to clients",
+)
+EMIT_SECONDS = metrics.histogram(
+    "chat_emit_seconds",
+    "Time spent in msg.stream_token per coalesced emit",
+)
+STREAM_CANCELLED = metrics.counter(
+    "chat_stream_cancelled_total",
+    "OpenAI streams closed before completion because the user stopped or disconnected",
+    labelnames=("reason",),
+)
+STREAM_TOKENS_SAVED = metrics.counter(
+    "chat_stream_tokens_saved_total",
+    "Completion tokens not generated because the stream was cancelled (max_tokens minus tokens received)",
+)
+
+# 切断による取り消しで CancelledError に渡すメッセージ（それ以外は停止ボタンによる取り消し）
+DISCONNECT_REASON = "disconnect"
+
+# cancel_on_disconnect で作成したタスク（完了前にガベージコレクションされないよう参照を保持する）
+_disconnect_tasks: set = set()
+
+
+class StreamStats:
+    """
+    1 本のストリームのチャンク間隔・毎秒トークン数・emit 時間を記録します。
+    チャンクごとの処理は時刻の取得とヒストグラムへの加算だけにとどめます。
+    stream_options.include_usage を指定した場合は、最後のチャンクの使用量を usage に保持します。
+    """
+
+    __slots__ = ("clock", "started", "last", "tokens", "usage")
+
+    def __init__(self, clock=time.perf_counter):
+        self.clock = clock
+        self.started = self.last = clock()
+        self.tokens = 0
+        self.usage = None
+
+    def begin(self) -> None:
+        """ストリームの読み込み開始時刻を記録します（チャンク間隔の起点）"""
+        self.started = self.last = self.clock()
+
+    def chunk(self) -> None:
+        now = self.clock()
+        STREAM_CHUNK_INTERVAL_SECONDS.observe(now - self.last)
+        self.last = now
+
+    def emitted(self, seconds: float) -> None:
+        EMIT_SECONDS.observe(seconds)
+
+    def finish(self) -> None:
+        elapsed = self.last - self.started
+        STREAM_TOKENS.inc(self.tokens)
+        if self.tokens and elapsed > 0:
+            STREAM_TOKENS_PER_SECOND.observe(self.tokens / elapsed)
+
+
+async def relay_stream(stream, coalescer: "TokenCoalescer", tokens: list, stats: StreamStats | None = None) -> str | None:
+    """
+    ストリームの差分トークンを tokens に追加しながら coalescer に渡し、finish_reason を返します。
+    途中で取り消された場合も、それまでに受け取ったトークン数を stats に記録します。
+    """
+    finish_reason = None
+    if stats is not None:
+        stats.begin()
+    try:
+        async for part in stream:
+            if stats is not None:
+                stats.chunk()
+            if part.choices and len(part.choices) > 0:
+                finish_reason = part.choices[0].finish_reason or finish_reason
+                if token := part.choices[0].delta.content or "":
+                    tokens.append(token)
+                    await coalescer.add(token)
+            elif stats is not None and part.usage is not None:
+                # 使用量は choices が空の最後のチャンクで届く
+                stats.usage = part.usage
+    finally:
+        if stats is not None:
+            stats.tokens += len(tokens)
+            stats.finish()
+    return finish_reason
+
+
+async def relay_until_cancelled(
+    stream, coalescer: "TokenCoalescer", tokens: list, stats: StreamStats | None = None
+) -> tuple[str | None, asyncio.CancelledError | None]:
+    """
+    relay_stream を実行して (finish_reason, None) を返します。停止・切断でタスクが取り消された場合は
+    続きを読まずにストリーム（HTTP のレスポンス）を閉じ、(None, CancelledError) を返します。
+    受け取った分を保存してから、呼び出し側で CancelledError を送出し直してください。
+    """
+    try:
+        return await relay_stream(stream, coalescer, tokens, stats), None
+    except asyncio.CancelledError as e:
+        return None, e
+    finally:
+        await stream.close()
+
+
+def cancel_reason(error: asyncio.CancelledError) -> str:
+    """取り消しの理由（disconnect / stop）"""
+    return DISCONNECT_REASON if DISCONNECT_REASON in error.args else "stop"
+
+
+def record_cancelled(reason: str, max_tokens: int, completion_tokens: int) -> None:
+    """取り消したストリームを数え、生成されずに済んだ出力トークン数（上限からの残り）を加算します"""
+    STREAM_CANCELLED.inc(reason=reason)
+    STREAM_TOKENS_SAVED.inc(max(max_tokens - completion_tokens, 0))
+
+
+def cancel_on_disconnect(session, grace: float | None = None) -> None:
+    """
+    切断したセッションで実行中のタスク（応答のストリーミング）を grace 秒後に取り消します。
+    それまでに同じワーカーへ再接続した場合（socket_id が変わる）は取り消さず、
+    新しいチャットへの切り替え（to_clear）の場合は待たずに取り消します。
+    """
+    grace = Config.STREAM_DISCONNECT_GRACE if grace is None else grace
+    socket_id = session.socket_id
+
+    async def cancel():
+        if grace > 0 and not session.to_clear:
+            await asyncio.sleep(grace)
+        task = session.current_task
+        if session.socket_id == socket_id and task is not None and not task.done():
+            task.cancel(DISCONNECT_REASON)
+
+    task = asyncio.get_running_loop().create_task(cancel())
+    _disconnect_tasks.add(task)
+    task.add_done_callback(_disconnect_tasks.discard)
+
+
+class TokenCoalescer:
+    """
+    OpenAI から届く差分トークンをバッファし、一定時間または一定文字数ごとに
+    まとめて msg.stream_token() に渡すことで websocket への emit 回数を減らします。
+    最初のトークンは体感速度を落とさないよう即座に送信します。
+    次のトークンが届かなくても（モデルの生成が止まった場合など）、バッファに溜まったトークンは
+    interval_ms 後にタイマーで送信します。
+    """
+
+    def __init__(
+        self,
+        msg,
+        interval_ms: float | None = None,
+        max_chars: int | None = None,
+        clock=time.perf_counter,
+        stats: StreamStats | None = None,
+    ):
+        self.msg = msg
+        self.stats = stats
+        if interval_ms is None:
+            interval_ms = Config.STREAM_FLUSH_INTERVAL_MS
+        self.interval = interval_ms / 1000
+        self.max_chars = max_chars if max_chars is not None else Config.STREAM_FLUSH_MAX_CHARS
+        self.clock = clock
+        self.emit_count = 0
+        self._buffer = []
+        self._size = 0
+        self._last_flush = float("-inf")
+        # 送信の順序を保つため、タイマーからの送信と add() からの送信を直列にする
+        self._lock = asyncio.Lock()
+        self._timer: asyncio.TimerHandle | None = None
+        self._timer_flush: asyncio.Task | None = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.flush()
+        # タイマーから開始した送信の完了を待つ（送信のエラーもここで伝える）
+        if self._timer_flush is not None:
+            await self._timer_flush
+
+    async def add(self, token: str) -> None:
+        """トークンをバッファに追加し、閾値を超えていれば送信します"""
+        if not token:
+            return
+        self._buffer.append(token)
+        self._size += len(token)
+        elapsed = self.clock() - self._last_flush
+        if self._size >= self.max_chars or elapsed >= self.interval:
+            await self.flush()
+        elif self._timer is None:
+            # バッファが空から溜まり始めたら、前回の送信から interval_ms 後に送信するタイマーを設定する
+            self._timer = asyncio.get_running_loop().call_later(self.interval - elapsed, self._on_timer)
+
+    def _on_timer(self) -> None:
+        self._timer = None
+        self._timer_flush = asyncio.ensure_future(self.flush())
+
+    async def flush(self) -> None:
+        """バッファに溜まったトークンをまとめて送信します"""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._buffer:
+            return
+        async with self._lock:
+            if not self._buffer:
+                return
+            text = "".join(self._buffer)
+            self._buffer.clear()
+            self._size = 0
+            self._last_flush = self.clock()
+            self.emit_count += 1
+            if self.stats is None:
+                await self.msg.stream_token(text)
+                return
+            started = self.clock()
+            await self.msg.stream_token(text)
+            self.stats.emitted(self.clock() - started)
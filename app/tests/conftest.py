@@ -0,0 +1,43 @@
+import os
+import shutil
+import tempfile
+from pathlib import Path
+
+import pytest
+
+APP_DIR = Path(__file__).resolve().parent.parent
+
+# chainlit は import 時に不足している翻訳ファイルを APP_ROOT/.chainlit に書き出すため、
+# 設定ファイルだけをコピーした一時ディレクトリを APP_ROOT にする
+_app_root = tempfile.mkdtemp(prefix="chainlit-test-")
+shutil.copytree(APP_DIR / ".chainlit", Path(_app_root) / ".chainlit", ignore=shutil.ignore_patterns("translations"))
+os.environ["CHAINLIT_APP_ROOT"] = _app_root
+
+
+@pytest.fixture
+def engine():
+    """
+    テスト用のデータベースに接続するエンジン。接続できない場合はテストをスキップします。
+    テストごとに asyncio.run でイベントループが変わるため、接続はプールしません。
+    """
+    import asyncio
+
+    from sqlalchemy import text
+    from sqlalchemy.ext.asyncio import create_async_engine
+    from sqlalchemy.pool import NullPool
+
+    from settings import Config
+
+    engine = create_async_engine(Config.ASYNC_DATABASE_URL, poolclass=NullPool)
+
+    async def ping():
+        async with engine.connect() as conn:
+            await conn.execute(text("SELECT 1"))
+
+    try:
+        asyncio.run(ping())
+    except Exception as e:
+        asyncio.run(engine.dispose())
+        pytest.skip(f"データベースに接続できません: {e}")
+    yield engine
+    asyncio.run(engine.dispose())
@@ -0,0 +1,66 @@
+"""データベースを使うテストでテスト用の行を作成・削除するヘルパー"""
+import json
+import uuid
+
+from sqlalchemy import text
+
+GENERATION = {"model": "gpt-4o", "inputTokenCount": 10, "outputTokenCount": 20, "ttFirstToken": 500, "duration": 2}
+
+
+async def create_user(conn) -> tuple[str, str]:
+    user_id, identifier = str(uuid.uuid4()), f"test-{uuid.uuid4()}"
+    await conn.execute(
+        text("""INSERT INTO users ("id", "identifier", "metadata", "createdAt") VALUES (:id, :identifier, '{}', :created_at)"""),
+        {"id": user_id, "identifier": identifier, "created_at": "2026-01-01T00:00:00Z"},
+    )
+    return user_id, identifier
+
+
+async def create_thread(conn, user_id: str, identifier: str, created_at: str | None) -> str:
+    thread_id = str(uuid.uuid4())
+    await conn.execute(
+        text("""
+            INSERT INTO threads ("id", "createdAt", "name", "userId", "userIdentifier")
+            VALUES (:id, :created_at, 'テスト', :user_id, :identifier)
+        """),
+        {"id": thread_id, "created_at": created_at, "user_id": user_id, "identifier": identifier},
+    )
+    return thread_id
+
+
+async def create_response(
+    conn, thread_id: str, value: int | None = None, created_at: str = "2026-01-01T00:00:00Z"
+) -> str:
+    """トークン数の付いた応答のステップと、value を指定した場合はそのフィードバックを作成します"""
+    step_id = str(uuid.uuid4())
+    await conn.execute(
+        text("""
+            INSERT INTO steps ("id", "name", "type", "threadId", "streaming", "createdAt", "generation")
+            VALUES (:id, 'Assistant', 'assistant_message', :thread_id, false, :created_at, CAST(:generation AS jsonb))
+        """),
+        {"id": step_id, "thread_id": thread_id, "created_at": created_at, "generation": json.dumps(GENERATION)},
+    )
+    if value is not None:
+        await conn.execute(
+            text("""INSERT INTO feedbacks ("id", "forId", "threadId", "value") VALUES (:id, :for_id, :thread_id, :value)"""),
+            {"id": str(uuid.uuid4()), "for_id": step_id, "thread_id": thread_id, "value": value},
+        )
+    return step_id
+
+
+async def delete_user(conn, user_id: str, identifier: str) -> None:
+    await conn.execute(text("""DELETE FROM threads WHERE "userId" = :id"""), {"id": user_id})
+    await conn.execute(text("""DELETE FROM users WHERE "id" = :id"""), {"id": user_id})
+    for table in ("response_rollup_hourly", "response_rollup_daily"):
+        await conn.execute(text(f"""DELETE FROM {table} WHERE "userIdentifier" = :identifier"""), {"identifier": identifier})
+
+
+async def rollup_rows(conn, identifier: str) -> list[dict]:
+    result = await conn.execute(
+        text("""
+            SELECT "day", "model", "responses", "promptTokens", "completionTokens", "feedbackUp", "feedbackDown"
+            FROM response_rollup_daily WHERE "userIdentifier" = :identifier ORDER BY "day", "model"
+        """),
+        {"identifier": identifier},
+    )
+    return [dict(row) for row in result.mappings()]
@@ -0,0 +1,130 @@
+import asyncio
+from types import SimpleNamespace
+
+import chainlit as cl
+import pytest
+from chainlit.context import ChainlitContext, context_var
+from chainlit.session import HTTPSession
+from chainlit.server import app as server
+from chainlit.user_session import user_sessions
+from fastapi.testclient import TestClient
+
+import app
+from lazy import Lazy
+from session_store import MemorySessionStore
+from settings import Config
+
+
+class CountingSessionStore(MemorySessionStore):
+    """共有のセッションストアへの読み書きの回数を数える"""
+
+    def __init__(self):
+        super().__init__()
+        self.gets = 0
+
+    async def get(self, key: str) -> dict | None:
+        self.gets += 1
+        return await super().get(key)
+
+
+def use_session(session_id: str, worker_changed: bool = False) -> None:
+    """同じセッション ID で接続したコンテキストに切り替えます（worker_changed なら別のワーカー）"""
+    if worker_changed:
+        user_sessions.pop(session_id, None)
+    context_var.set(ChainlitContext(HTTPSession(id=session_id, client_type="webapp")))
+
+
+@pytest.fixture
+def store(monkeypatch):
+    # 2 つのワーカーが同じセッションストアを共有する
+    store = CountingSessionStore()
+    monkeypatch.setattr(app, "session_store", Lazy(lambda: store))
+    monkeypatch.setattr(app, "data_layer", Lazy(lambda: SimpleNamespace(get_step_outputs=None)))
+    return store
+
+
+@pytest.fixture
+def sent(monkeypatch):
+    sent = []
+
+    async def send(self):
+        sent.append(self.content)
+        return self
+
+    monkeypatch.setattr(cl.Message, "send", send)
+    return sent
+
+
+def test_start_keeps_history_saved_by_another_worker(store, sent):
+    async def scenario():
+        use_session("session-1")
+        await app.start()
+        history = await app.load_message_history()
+        history.append("user", "こんにちは")
+        history.append("assistant", "こんにちは！")
+        app.save_message_history(history)
+
+        # threadId の無い再接続が別のワーカーに振り分けられ、on_chat_start が再び呼ばれる
+        use_session("session-1", worker_changed=True)
+        await app.start()
+        return await app.load_message_history()
+
+    history = asyncio.run(scenario())
+    assert [message["content"] for message in history.messages()[1:]] == ["こんにちは", "こんにちは！"]
+    assert len(sent) == 1
+
+
+def test_messages_use_the_worker_copy_of_the_history(store, sent):
+    async def scenario():
+        use_session("session-2")
+        await app.start()
+        gets = store.gets
+        for content in ("1", "2", "3"):
+            history = await app.load_message_history()
+            history.append("user", content)
+            app.save_message_history(history)
+        local_gets = store.gets - gets
+
+        # 別のワーカーでは共有のセッションストアから 1 回だけ読み込む
+        use_session("session-2", worker_changed=True)
+        for _ in range(2):
+            history = await app.load_message_history()
+        return local_gets, store.gets - gets - local_gets, history
+
+    local_gets, remote_gets, history = asyncio.run(scenario())
+    assert local_gets == 0 and remote_gets == 1
+    assert [message["content"] for message in history.messages()[1:]] == ["1", "2", "3"]
+
+
+def test_end_deletes_the_history_of_a_cleared_session(store, sent, monkeypatch):
+    monkeypatch.setattr(app, "data_layer", Lazy(lambda: SimpleNamespace(get_step_outputs=None, flush=noop)))
+    monkeypatch.setattr(app, "cancel_on_disconnect", lambda session: None)
+
+    async def scenario():
+        use_session("session-3")
+        await app.start()
+        key = app.history_key()
+        # 新しいチャットに切り替えるとセッションが終了する
+        cl.context.session.to_clear = True
+        await app.end()
+        # 取り消された応答の保存でも履歴を作り直さない
+        app.save_message_history(app.new_message_history())
+        return await store.get(key)
+
+    assert asyncio.run(scenario()) is None
+
+
+async def noop():
+    pass
+
+
+@pytest.mark.parametrize("path", ["/metrics", "/metrics/db-pool", "/metrics/startup"])
+def test_metrics_routes_require_the_metrics_token(path, monkeypatch):
+    client = TestClient(server)
+    monkeypatch.setattr(Config, "METRICS_TOKEN", "")
+    assert client.get(path, headers={"Authorization": "Bearer anything"}).status_code == 404
+
+    monkeypatch.setattr(Config, "METRICS_TOKEN", "secret")
+    assert client.get(path).status_code == 401
+    assert client.get(path, headers={"Authorization": "Bearer wrong"}).status_code == 401
+    assert client.get(path, headers={"Authorization": "Bearer secret"}).status_code == 200
@@ -0,0 +1,18 @@
+import asyncio
+
+from completion_cache import CompletionCache
+from settings import Config, chat_settings
+
+
+def test_enabled_cache_applies_at_the_default_temperature(monkeypatch):
+    monkeypatch.setattr(Config, "COMPLETION_CACHE_DB_ENABLED", False)
+    messages = [{"role": "user", "content": "こんにちは"}]
+    settings = chat_settings()
+    assert settings["temperature"] > 0
+
+    async def scenario(cache):
+        await cache.set(messages, settings, ["こん", "にちは"])
+        return await cache.get(messages, settings)
+
+    assert asyncio.run(scenario(CompletionCache(enabled=True))) == ["こん", "にちは"]
+    assert asyncio.run(scenario(CompletionCache(enabled=False))) is None
@@ -0,0 +1,54 @@
+import asyncio
+import json
+import uuid
+
+from conversation import ConversationContext
+
+SYSTEM_PROMPT = "あなたは親切なAIアシスタントです。"
+
+
+def build(outputs: dict) -> ConversationContext:
+    async def loader(step_ids):
+        return {step_id: outputs[step_id] for step_id in step_ids}
+
+    context = ConversationContext(SYSTEM_PROMPT, budget=10**6, window=2, loader=loader)
+    for i in range(5):
+        step_id = str(uuid.uuid4())
+        outputs[step_id] = f"メッセージ {i}"
+        context.append("user" if i % 2 == 0 else "assistant", outputs[step_id], step_id=step_id)
+    # ステップ ID の無いターン（手放さずにメモリに残す）
+    context.append("user", "保存前のメッセージ")
+    return context
+
+
+def test_state_round_trip_keeps_spilled_and_in_memory_turns():
+    outputs = {}
+    context = build(outputs)
+    # セッションストア（session_state.data）と同じく JSON を経由する
+    state = json.loads(json.dumps(context.to_state()))
+    restored = ConversationContext.from_state(SYSTEM_PROMPT, state, loader=context.loader)
+
+    assert isinstance(state["contents"], list) and all(isinstance(state[key], str) for key in ("roles", "tokens", "step_ids"))
+    assert restored.spilled_count == context.spilled_count == 4
+    assert restored.token_count == context.token_count
+    assert [(turn.role, turn.content, turn.tokens, turn.step_id) for turn in restored._turns] == [
+        (turn.role, turn.content, turn.tokens, turn.step_id) for turn in context._turns
+    ]
+    assert asyncio.run(restored.load_messages()) == asyncio.run(context.load_messages())
+
+
+def test_from_state_reads_the_previous_format():
+    context = ConversationContext(SYSTEM_PROMPT, budget=10**6, window=10)
+    step_id = str(uuid.uuid4())
+    state = {
+        "budget": 10**6,
+        "window": 10,
+        "turns": [["user", "こんにちは", 9, step_id], ["assistant", "こんにちは！", 10, None]],
+        "spilled_ids": "",
+        "spilled_tokens": [],
+        "spilled_roles": "",
+        "trimmed_count": 0,
+    }
+    restored = ConversationContext.from_state(SYSTEM_PROMPT, state)
+    assert restored.messages()[1:] == [{"role": "user", "content": "こんにちは"}, {"role": "assistant", "content": "こんにちは！"}]
+    assert restored.token_count == context.token_count + 19
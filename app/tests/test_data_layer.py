@@ -0,0 +1,80 @@
+import asyncio
+
+from chainlit.types import Pagination, ThreadFilter
+from sqlalchemy import text
+
+from data_layer import DataLayer, _decode_search_cursor
+from factories import create_response, create_thread, create_user, delete_user, rollup_rows
+
+
+def test_delete_thread_keeps_rollups(engine):
+    async def scenario():
+        async with engine.begin() as conn:
+            user_id, identifier = await create_user(conn)
+            thread_id = await create_thread(conn, user_id, identifier, "2026-01-01T00:00:00Z")
+            await create_response(conn, thread_id, value=1)
+            await create_response(conn, thread_id, value=0)
+        try:
+            async with engine.connect() as conn:
+                before = await rollup_rows(conn, identifier)
+            await DataLayer(engine=engine).delete_thread(thread_id)
+            async with engine.connect() as conn:
+                after = await rollup_rows(conn, identifier)
+                remaining = await conn.execute(text("""SELECT count(*) FROM steps WHERE "threadId" = :id"""), {"id": thread_id})
+                return before, after, remaining.scalar()
+        finally:
+            async with engine.begin() as conn:
+                await delete_user(conn, user_id, identifier)
+
+    before, after, remaining = asyncio.run(scenario())
+    assert before and before[0]["responses"] == 2 and before[0]["feedbackUp"] == 1 and before[0]["feedbackDown"] == 1
+    assert after == before
+    assert remaining == 0
+
+
+def test_list_threads_pages_through_threads_without_created_at(engine):
+    async def scenario():
+        async with engine.begin() as conn:
+            user_id, identifier = await create_user(conn)
+            dated = [
+                await create_thread(conn, user_id, identifier, f"2026-01-0{day}T00:00:00Z") for day in (1, 2, 3)
+            ]
+            undated = [await create_thread(conn, user_id, identifier, None) for _ in range(2)]
+        try:
+            data_layer = DataLayer(engine=engine)
+            filters = ThreadFilter(userId=user_id)
+            pages, cursor = [], None
+            # 同じページを返し続けた場合に止まるよう、ページ数に上限を設ける
+            while len(pages) < 10:
+                response = await data_layer.list_threads(Pagination(first=2, cursor=cursor), filters)
+                pages.append([thread["id"] for thread in response.data])
+                if not response.pageInfo.hasNextPage:
+                    break
+                cursor = response.pageInfo.endCursor
+            invalid = await data_layer.list_threads(Pagination(first=2, cursor="not-a-cursor"), filters)
+            # スレッド id だけのカーソル（日時の無いスレッド）も続きから返す
+            legacy = await data_layer.list_threads(Pagination(first=2, cursor=max(undated)), filters)
+            return dated, undated, pages, invalid, legacy
+        finally:
+            async with engine.begin() as conn:
+                await delete_user(conn, user_id, identifier)
+
+    dated, undated, pages, invalid, legacy = asyncio.run(scenario())
+    assert [thread_id for page in pages for thread_id in page] == dated[::-1] + sorted(undated, reverse=True)
+    assert len(pages) == 3
+    assert invalid.data == [] and not invalid.pageInfo.hasNextPage
+    assert [thread["id"] for thread in legacy.data] == [min(undated)]
+
+
+def test_decode_search_cursor_rejects_malformed_cursors():
+    thread_id = "0b5c2d2e-8f7a-4c3e-9a51-6d0f4b1e2a37"
+    assert _decode_search_cursor(f"0.5|1767225600.0|{thread_id}") == (0.5, 1767225600.0, thread_id)
+    for cursor in (
+        "",
+        "0.5|1767225600.0",
+        "0.5|1767225600.0|not-a-uuid",
+        f"nan|1767225600.0|{thread_id}",
+        f"0.5|inf|{thread_id}",
+        f"0.5|-inf|{thread_id}",
+    ):
+        assert _decode_search_cursor(cursor) is None
@@ -0,0 +1,25 @@
+import asyncio
+from datetime import datetime, timezone
+
+from factories import GENERATION, create_response, create_thread, create_user, delete_user
+from rollups import query_rollups
+
+
+def test_day_rollups_include_today_by_default(engine):
+    now = datetime.now(timezone.utc).isoformat()
+
+    async def scenario():
+        async with engine.begin() as conn:
+            user_id, identifier = await create_user(conn)
+            thread_id = await create_thread(conn, user_id, identifier, now)
+            await create_response(conn, thread_id, value=1, created_at=now)
+        try:
+            return await query_rollups("day", user=identifier, engine=engine)
+        finally:
+            async with engine.begin() as conn:
+                await delete_user(conn, user_id, identifier)
+
+    rows = asyncio.run(scenario())
+    assert len(rows) == 1
+    assert rows[0]["model"] == GENERATION["model"]
+    assert rows[0]["responses"] == 1 and rows[0]["feedbackUp"] == 1
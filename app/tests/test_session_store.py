@@ -0,0 +1,45 @@
+import asyncio
+import uuid
+
+from session_store import SESSION_STORE_EVICTIONS, MemorySessionStore, PostgresSessionStore
+
+
+def test_postgres_set_later_writes_in_the_background(engine):
+    keys = [f"history:{uuid.uuid4()}" for _ in range(3)]
+
+    async def scenario():
+        store = PostgresSessionStore(engine=engine)
+        other_worker = PostgresSessionStore(engine=engine)
+        try:
+            for i, key in enumerate(keys):
+                store.set_later(key, {"turns": [i]})
+                # 同じキーへの書き込みは最新の値だけが反映される
+                store.set_later(key, {"turns": [i, i]})
+            # 反映前の値も同じワーカーからは読める
+            pending = await store.get(keys[0])
+            await store.flush()
+            saved = [await other_worker.get(key) for key in keys]
+            await store.delete(keys[0])
+            return pending, saved, await other_worker.get(keys[0])
+        finally:
+            for key in keys:
+                await store.delete(key)
+
+    pending, saved, deleted = asyncio.run(scenario())
+    assert pending == {"turns": [0, 0]}
+    assert saved == [{"turns": [i, i]} for i in range(3)]
+    assert deleted is None
+
+
+def test_memory_store_counts_evicted_live_sessions(caplog):
+    store = MemorySessionStore(maxsize=2, ttl=60)
+    evictions = SESSION_STORE_EVICTIONS.value()
+
+    async def scenario():
+        for i in range(3):
+            await store.set(f"history:{i}", {"turns": [i]})
+        return [await store.get(f"history:{i}") for i in range(3)]
+
+    assert asyncio.run(scenario()) == [None, {"turns": [1]}, {"turns": [2]}]
+    assert SESSION_STORE_EVICTIONS.value() == evictions + 1
+    assert "SESSION_STORE_MEMORY_SIZE" in caplog.text
@@ -0,0 +1,168 @@
+import asyncio
+import time
+from types import SimpleNamespace
+
+import pytest
+from openai import AsyncAzureOpenAI
+
+from benchmarks.bench_streaming import FakeMessage
+from benchmarks.fake_openai import FakeStream, create_app, start_server
+from openai_router import Deployment, DeploymentRouter
+from streaming import (
+    DISCONNECT_REASON,
+    STREAM_CANCELLED,
+    STREAM_TOKENS_SAVED,
+    StreamStats,
+    TokenCoalescer,
+    cancel_on_disconnect,
+    cancel_reason,
+    record_cancelled,
+    relay_until_cancelled,
+)
+
+SETTINGS = {"max_tokens": 400, "stream": True}
+
+
+def test_buffered_token_is_sent_after_interval_without_more_tokens():
+    async def scenario():
+        msg = FakeMessage(emit_cost_us=0)
+        async with TokenCoalescer(msg, interval_ms=50, max_chars=1000) as coalescer:
+            await coalescer.add("こん")
+            await coalescer.add("にちは")
+            buffered = msg.content
+            # 次のトークンが届かないまま interval_ms が過ぎる
+            await asyncio.sleep(0.2)
+            return buffered, msg.content, coalescer.emit_count
+
+    buffered, sent, emit_count = asyncio.run(scenario())
+    assert buffered == "こん"
+    assert sent == "こんにちは"
+    assert emit_count == 2
+
+
+def test_tokens_before_a_stall_are_not_held_until_the_stream_resumes():
+    async def scenario():
+        stream = FakeStream(n_tokens=6, ttft=0, tokens_per_second=1000, stall_after=3, stall=0.5)
+        msg = FakeMessage(emit_cost_us=0)
+        async with TokenCoalescer(msg, interval_ms=50, max_chars=1000) as coalescer:
+            async for part in stream:
+                if part.choices and (token := part.choices[0].delta.content):
+                    await coalescer.add(token)
+                    if len(stream.produced_at) == 3:
+                        stalled_at = time.perf_counter()
+        # 停滞の直前のトークンは、停滞が終わる前に送信されている
+        before_stall = "".join(stream.tokens[:3])
+        sent_at = next(at for at, chars in zip(msg.emitted_at, msg.emitted_chars) if chars >= len(before_stall))
+        return sent_at - stalled_at, msg.content == "".join(stream.tokens)
+
+    delay, complete = asyncio.run(scenario())
+    assert delay < 0.25
+    assert complete
+
+
+async def respond(router: DeploymentRouter, msg: FakeMessage, result: dict) -> None:
+    """app.py の reply() と同じ手順でストリームを中継し、取り消された場合は途中までの本文を記録します"""
+    tokens = []
+    async with TokenCoalescer(msg, interval_ms=0, stats=StreamStats()) as coalescer:
+        stream = await router.stream([{"role": "user", "content": "こんにちは"}], SETTINGS, cost=SETTINGS["max_tokens"])
+        result["started"] = True
+        result["finish_reason"], cancelled = await relay_until_cancelled(stream, coalescer, tokens)
+    result["tokens"] = tokens
+    if cancelled is not None:
+        result["reason"] = cancel_reason(cancelled)
+        record_cancelled(result["reason"], SETTINGS["max_tokens"], len(tokens))
+        raise cancelled
+
+
+async def run_with_slow_server(scenario, n_tokens: int = 400) -> tuple[dict, FakeMessage, dict]:
+    """毎秒 50 トークンを返す偽サーバーに対して応答を開始し、scenario(task) で停止・切断します"""
+    app = create_app(n_tokens=n_tokens, ttft=0, tokens_per_second=50)
+    runner, endpoint = await start_server(app)
+    client = AsyncAzureOpenAI(api_key="fake", azure_endpoint=endpoint, api_version="2024-02-01", max_retries=0)
+    router = DeploymentRouter([Deployment("fake", client, "gpt-35-turbo")])
+    msg, result = FakeMessage(emit_cost_us=0), {}
+    try:
+        task = asyncio.create_task(respond(router, msg, result))
+        while "started" not in result or not msg.content:
+            await asyncio.sleep(0.005)
+        await scenario(task)
+        try:
+            await task
+        except asyncio.CancelledError:
+            result["cancelled"] = True
+        # 偽サーバーは次のトークンを書き込む時に切断を検知する
+        for _ in range(200):
+            if app["stats"]["disconnected"] or app["stats"]["completed"]:
+                break
+            await asyncio.sleep(0.01)
+        return result, msg, app["stats"]
+    finally:
+        await client.close()
+        await runner.cleanup()
+
+
+def test_stop_closes_the_stream_and_keeps_the_partial_reply():
+    cancelled = STREAM_CANCELLED.value(reason="stop")
+    saved = STREAM_TOKENS_SAVED.value()
+
+    async def stop(task):
+        await asyncio.sleep(0.1)
+        task.cancel()
+
+    result, msg, stats = asyncio.run(run_with_slow_server(stop))
+    assert result["cancelled"] and result["reason"] == "stop" and result["finish_reason"] is None
+    # 受け取った途中までの本文がメッセージの内容と一致する
+    assert msg.content and msg.content == "".join(result["tokens"])
+    # HTTP のレスポンスが閉じられ、偽サーバーが残りのトークンを送らずに済んだ
+    assert stats["disconnected"] == 1 and stats["unsent_tokens"] > 0
+    assert STREAM_CANCELLED.value(reason="stop") == cancelled + 1
+    assert STREAM_TOKENS_SAVED.value() > saved
+
+
+def test_disconnect_cancels_the_reply_after_the_grace_period():
+    async def disconnect(task):
+        session = SimpleNamespace(socket_id="sid-1", to_clear=False, current_task=task)
+        cancel_on_disconnect(session, grace=0.05)
+
+    result, msg, stats = asyncio.run(run_with_slow_server(disconnect))
+    assert result["cancelled"] and result["reason"] == DISCONNECT_REASON
+    assert msg.content == "".join(result["tokens"])
+    assert stats["disconnected"] == 1
+
+
+def test_reconnect_within_the_grace_period_keeps_the_reply():
+    async def reconnect(task):
+        session = SimpleNamespace(socket_id="sid-1", to_clear=False, current_task=task)
+        cancel_on_disconnect(session, grace=0.2)
+        await asyncio.sleep(0.05)
+        session.socket_id = "sid-2"
+
+    result, msg, stats = asyncio.run(run_with_slow_server(reconnect, n_tokens=30))
+    assert "cancelled" not in result and result["finish_reason"] == "stop"
+    assert len(result["tokens"]) == 30 and msg.content == "".join(result["tokens"])
+    assert stats["completed"] == 1 and stats["disconnected"] == 0
+
+
+@pytest.mark.parametrize("args, reason", [((), "stop"), ((DISCONNECT_REASON,), DISCONNECT_REASON)])
+def test_cancel_reason(args, reason):
+    assert cancel_reason(asyncio.CancelledError(*args)) == reason
+
+
+def test_relay_until_cancelled_closes_the_stream_when_cancelled():
+    async def scenario():
+        stream, msg, tokens = FakeStream(n_tokens=100, ttft=0, tokens_per_second=50), FakeMessage(emit_cost_us=0), []
+
+        async def relay():
+            async with TokenCoalescer(msg, interval_ms=0) as coalescer:
+                return await relay_until_cancelled(stream, coalescer, tokens)
+
+        task = asyncio.create_task(relay())
+        await asyncio.sleep(0.1)
+        task.cancel()
+        finish_reason, cancelled = await task
+        return stream, msg, tokens, finish_reason, cancelled
+
+    stream, msg, tokens, finish_reason, cancelled = asyncio.run(scenario())
+    assert stream.closed
+    assert finish_reason is None and isinstance(cancelled, asyncio.CancelledError)
+    assert tokens and msg.content == "".join(tokens)
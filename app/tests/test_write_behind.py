@@ -0,0 +1,51 @@
+import asyncio
+import uuid
+
+from sqlalchemy import text
+
+from settings import Config
+from write_behind import WRITE_BEHIND_ROWS, WriteBehindQueue
+
+
+def step(thread_id: str) -> dict:
+    return {
+        "id": str(uuid.uuid4()), "name": "Assistant", "type": "assistant_message", "threadId": thread_id,
+        "streaming": False, "createdAt": "2026-01-01T00:00:00Z", "output": "こんにちは",
+    }
+
+
+def test_flush_drops_only_the_failing_row(engine, monkeypatch):
+    monkeypatch.setattr(Config, "WRITE_BEHIND_MAX_RETRIES", 1)
+    thread_id = str(uuid.uuid4())
+    steps = [step(thread_id), step(thread_id)]
+    # スレッドが存在しないため外部キー制約で失敗する行
+    poison = step(str(uuid.uuid4()))
+    dropped = WRITE_BEHIND_ROWS.value(table="steps", result="dropped")
+
+    async def scenario():
+        queue = WriteBehindQueue(engine, flush_interval_ms=60_000)
+        queue.enqueue_thread({"id": thread_id, "createdAt": "2026-01-01T00:00:00Z", "name": "テスト"})
+        for values in (steps[0], poison, steps[1]):
+            queue.enqueue_step(values)
+        try:
+            await queue.flush()
+            # 失敗した行だけが残り、WRITE_BEHIND_MAX_RETRIES 回目の再試行の後に破棄される
+            pending = [queue.pending]
+            await queue.flush()
+            pending.append(queue.pending)
+            async with engine.connect() as conn:
+                result = await conn.execute(
+                    text("""SELECT "id" FROM steps WHERE "id" = ANY(CAST(:ids AS uuid[]))"""),
+                    {"ids": [values["id"] for values in (*steps, poison)]},
+                )
+                return pending, {str(row_id) for row_id in result.scalars()}
+        finally:
+            await queue.close()
+            async with engine.begin() as conn:
+                await conn.execute(text("""DELETE FROM steps WHERE "threadId" = :id"""), {"id": thread_id})
+                await conn.execute(text("""DELETE FROM threads WHERE "id" = :id"""), {"id": thread_id})
+
+    pending, written = asyncio.run(scenario())
+    assert pending == [1, 0]
+    assert written == {values["id"] for values in steps}
+    assert WRITE_BEHIND_ROWS.value(table="steps", result="dropped") == dropped + 1
@@ -0,0 +1,82 @@
+import asyncio
+import logging
+import time
+from contextlib import contextmanager, nullcontext
+from functools import wraps
+
+import metrics
+from settings import Config
+
+logger = logging.getLogger(__name__)
+
+SPAN_SECONDS = metrics.histogram(
+    "span_seconds",
+    "Duration of instrumented operations",
+    labelnames=("span", "outcome"),
+)
+
+_provider = None
+_tracer = None
+
+
+def configure_tracing() -> bool:
+    """
+    TRACING_ENABLED の場合、span() を OpenTelemetry のスパンとしても記録し、
+    OTLP（送信先は OTEL_EXPORTER_OTLP_ENDPOINT などの標準の環境変数）で送信します。
+    """
+    global _provider, _tracer
+    if not Config.TRACING_ENABLED or _tracer is not None:
+        return _tracer is not None
+    try:
+        from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+        from opentelemetry.sdk.resources import Resource
+        from opentelemetry.sdk.trace import TracerProvider
+        from opentelemetry.sdk.trace.export import BatchSpanProcessor
+    except ImportError as e:  # OpenTelemetry が無い環境ではヒストグラムのみ記録する
+        logger.warning(f"OpenTelemetry の SDK が無いためトレースを送信しません: {e}")
+        return False
+    # グローバルのプロバイダーは Chainlit 側の計装と共有しないよう設定しない
+    _provider = TracerProvider(resource=Resource.create({"service.name": Config.TRACING_SERVICE_NAME}))
+    _provider.add_span_processor(BatchSpanProcessor(OTLPSpanExporter()))
+    _tracer = _provider.get_tracer(__name__)
+    return True
+
+
+def shutdown_tracing() -> None:
+    """未送信のスパンを送信してから停止します"""
+    global _provider, _tracer
+    if _provider is not None:
+        _provider.shutdown()
+        _provider = _tracer = None
+
+
+@contextmanager
+def span(name: str, **attributes):
+    """ブロックの所要時間を span_seconds{span=name} に記録します"""
+    started = time.perf_counter()
+    outcome = "ok"
+    with _tracer.start_as_current_span(name, attributes=attributes) if _tracer else nullcontext():
+        try:
+            yield
+        except asyncio.CancelledError:
+            outcome = "cancelled"
+            raise
+        except BaseException:
+            outcome = "error"
+            raise
+        finally:
+            SPAN_SECONDS.observe(time.perf_counter() - started, span=name, outcome=outcome)
+
+
+def traced(name: str):
+    """非同期関数の呼び出しを span(name) で囲むデコレーター"""
+
+    def decorator(fn):
+        @wraps(fn)
+        async def wrapper(*args, **kwargs):
+            with span(name):
+                return await fn(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
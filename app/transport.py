@@ -0,0 +1,69 @@
+import importlib.util
+import logging
+
+import aiohttp
+import httpx
+from azure.core.pipeline.transport import AioHttpTransport
+from openai import DefaultAsyncHttpxClient
+
+from settings import Config
+
+logger = logging.getLogger(__name__)
+
+_openai_http_client = None
+
+
+def http2_available() -> bool:
+    """httpx の HTTP/2 に必要な h2 がインストールされているかを返します"""
+    return importlib.util.find_spec("h2") is not None
+
+
+def get_openai_http_client() -> httpx.AsyncClient:
+    """
+    すべての OpenAI デプロイメントで共有する httpx クライアントを返します。
+    接続はホストごとにプールされ、keep-alive で再利用されます。
+    """
+    global _openai_http_client
+    if _openai_http_client is None or _openai_http_client.is_closed:
+        http2 = Config.OPENAI_HTTP2_ENABLED and http2_available()
+        if Config.OPENAI_HTTP2_ENABLED and not http2:
+            logger.info("h2 がインストールされていないため、OpenAI への接続は HTTP/1.1 を使用します")
+        _openai_http_client = DefaultAsyncHttpxClient(
+            http2=http2,
+            limits=httpx.Limits(
+                max_connections=Config.OPENAI_HTTP_MAX_CONNECTIONS,
+                max_keepalive_connections=Config.OPENAI_HTTP_MAX_KEEPALIVE,
+                keepalive_expiry=Config.OPENAI_HTTP_KEEPALIVE_EXPIRY,
+            ),
+        )
+    return _openai_http_client
+
+
+class PooledAioHttpTransport(AioHttpTransport):
+    """
+    接続数と keep-alive を設定した aiohttp セッションを使う Blob 用トランスポート。
+    aiohttp のセッションはイベントループ上で作る必要があるため、最初の open() で作成します。
+    aiohttp は HTTP/2 に対応していないため HTTP/1.1 の keep-alive で接続を再利用します。
+    """
+
+    async def open(self):
+        if self.session is None and self._session_owner and not self._has_been_opened:
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    limit=Config.BLOB_HTTP_MAX_CONNECTIONS,
+                    keepalive_timeout=Config.BLOB_HTTP_KEEPALIVE_TIMEOUT,
+                    ttl_dns_cache=Config.HTTP_DNS_CACHE_TTL,
+                ),
+                trust_env=self._use_env_settings,
+                cookie_jar=aiohttp.DummyCookieJar(),
+                auto_decompress=False,
+            )
+        await super().open()
+
+
+async def close_transports() -> None:
+    """共有している HTTP クライアントを閉じます"""
+    global _openai_http_client
+    if _openai_http_client is not None:
+        await _openai_http_client.aclose()
+        _openai_http_client = None
@@ -0,0 +1,222 @@
+import asyncio
+import json
+import logging
+from datetime import date, datetime
+from zoneinfo import ZoneInfo
+
+import chainlit as cl
+import metrics
+from cache import TTLCache
+from settings import Config, get_engine
+
+logger = logging.getLogger(__name__)
+
+USAGE_TOKENS = metrics.counter(
+    "chat_usage_tokens_total",
+    "Prompt and completion tokens consumed by completions",
+    labelnames=("kind",),
+)
+USAGE_QUOTA_REJECTED = metrics.counter(
+    "chat_usage_quota_rejected_total",
+    "Messages rejected because the user exceeded the daily token quota",
+)
+USAGE_FLUSH_ROWS = metrics.counter(
+    "usage_flush_rows_total",
+    "Per-user daily usage rows upserted",
+)
+
+# usage_daily に加算する列
+COUNTER_COLUMNS = ("requests", "promptTokens", "completionTokens", "ttftSecondsSum", "durationSecondsSum")
+
+
+class GenerationMessage(cl.Message):
+    """generation（トークン数・レイテンシ）をステップの generation 列に保存するメッセージ"""
+
+    generation: dict | None = None
+
+    def to_dict(self):
+        step = super().to_dict()
+        if self.generation:
+            step["generation"] = self.generation
+        return step
+
+
+def build_generation(
+    model: str,
+    settings: dict,
+    prompt_tokens: int,
+    completion_tokens: int,
+    ttft: float,
+    duration: float,
+    estimated: bool = False,
+    **metadata,
+) -> dict:
+    """Chainlit の ChatGeneration と同じキーの dict を作ります（ttFirstToken はミリ秒、duration は秒）"""
+    streamed = max(duration - ttft, 0)
+    return {
+        "type": "CHAT",
+        "provider": "azure-openai",
+        "model": model,
+        "settings": {k: v for k, v in settings.items() if k not in ("stream", "stream_options")},
+        "inputTokenCount": prompt_tokens,
+        "outputTokenCount": completion_tokens,
+        "tokenCount": prompt_tokens + completion_tokens,
+        "ttFirstToken": ttft * 1000,
+        "duration": duration,
+        "tokenThroughputInSeconds": completion_tokens / streamed if streamed > 0 else None,
+        # 使用量のチャンクを受け取れなかった場合は概算値
+        "metadata": {"estimatedUsage": estimated, **metadata},
+    }
+
+
+def load_user_quotas(raw: str | None = None) -> dict[str, int]:
+    """USAGE_USER_QUOTAS（userIdentifier -> 1 日あたりのトークン数の JSON）を読み込みます"""
+    raw = Config.USAGE_USER_QUOTAS if raw is None else raw
+    if not raw:
+        return {}
+    try:
+        return {str(identifier): int(tokens) for identifier, tokens in json.loads(raw).items()}
+    except (ValueError, TypeError, AttributeError) as e:
+        raise ValueError(f"USAGE_USER_QUOTAS is invalid: {e}") from e
+
+
+class UsageRecorder:
+    """
+    ユーザー・日ごとのトークン数とレイテンシの合計を usage_daily に記録します。
+    record() はメモリ上の差分に加算するだけで、USAGE_FLUSH_INTERVAL 秒ごとに
+    全ユーザー分を 1 回の複数行 upsert（既存の値への加算）で反映します。
+
+    used_today() は上限の確認用に、DB 上の合計（他のワーカーの分を含む）と未反映の差分を
+    足した今日の使用量を返します。DB 上の合計はフラッシュ時の RETURNING で更新し、
+    キャッシュに無いユーザーだけ USAGE_QUOTA_CACHE_TTL 秒ごとに DB から読み直します。
+    """
+
+    def __init__(self, engine=None, flush_interval: float | None = None):
+        self.engine = engine
+        self.flush_interval = Config.USAGE_FLUSH_INTERVAL if flush_interval is None else flush_interval
+        self.timezone = ZoneInfo(Config.USAGE_TIMEZONE)
+        self.quotas = load_user_quotas()
+        # (userIdentifier, day) -> [requests, promptTokens, completionTokens, ttftSecondsSum, durationSecondsSum]
+        self._pending: dict[tuple[str, date], list] = {}
+        # (userIdentifier, day) -> DB に反映済みのトークン数の合計
+        self._totals = TTLCache(Config.USAGE_QUOTA_CACHE_SIZE, Config.USAGE_QUOTA_CACHE_TTL)
+        self._flush_lock = asyncio.Lock()
+        self._task = None
+
+    def _engine(self):
+        return self.engine or get_engine()
+
+    def today(self) -> date:
+        return datetime.now(self.timezone).date()
+
+    def quota(self, user: str) -> int:
+        """1 日あたりのトークン数の上限（0 で無制限）"""
+        return self.quotas.get(user, Config.USAGE_DAILY_TOKEN_QUOTA)
+
+    def record(self, user: str, prompt_tokens: int, completion_tokens: int, ttft: float, duration: float) -> None:
+        USAGE_TOKENS.inc(prompt_tokens, kind="prompt")
+        USAGE_TOKENS.inc(completion_tokens, kind="completion")
+        key = (user, self.today())
+        row = self._pending.setdefault(key, [0, 0, 0, 0.0, 0.0])
+        for i, value in enumerate((1, prompt_tokens, completion_tokens, ttft, duration)):
+            row[i] += value
+        self._ensure_started()
+
+    async def used_today(self, user: str) -> int:
+        """今日使用したトークン数（プロンプトと補完の合計）"""
+        key = (user, self.today())
+        total = self._totals.get(key)
+        if total is None:
+            total = await self._load_total(key)
+        pending = self._pending.get(key)
+        return total + (pending[1] + pending[2] if pending else 0)
+
+    async def check_quota(self, user: str) -> bool:
+        """今日の使用量が上限未満なら True"""
+        quota = self.quota(user)
+        if quota <= 0:
+            return True
+        if await self.used_today(user) < quota:
+            return True
+        USAGE_QUOTA_REJECTED.inc()
+        return False
+
+    async def _load_total(self, key: tuple[str, date]) -> int:
+        from sqlalchemy import select
+
+        from models import UsageDaily
+
+        table = UsageDaily.__table__
+        try:
+            async with self._engine().connect() as conn:
+                result = await conn.execute(
+                    select(table.c.promptTokens + table.c.completionTokens).where(
+                        table.c.userIdentifier == key[0], table.c.day == key[1]
+                    )
+                )
+                total = result.scalar() or 0
+        except Exception as e:
+            # 読み込めない場合は制限しない（次回の参照で読み直す）
+            logger.warning(f"使用量の読み込みに失敗しました: {e}")
+            return 0
+        self._totals.set(key, total)
+        return total
+
+    def _ensure_started(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    async def flush(self) -> None:
+        """溜まっている差分を usage_daily に加算し、DB 上の合計でキャッシュを更新します"""
+        async with self._flush_lock:
+            if not self._pending:
+                return
+            pending, self._pending = self._pending, {}
+            # SQLAlchemy は最初のフラッシュで読み込む（app.py の import を軽くするため）
+            from sqlalchemy import func
+            from sqlalchemy.dialects.postgresql import insert
+
+            from models import UsageDaily
+
+            table = UsageDaily.__table__
+            stmt = insert(table).values([
+                {"userIdentifier": user, "day": day, **dict(zip(COUNTER_COLUMNS, values))}
+                for (user, day), values in pending.items()
+            ])
+            stmt = stmt.on_conflict_do_update(
+                index_elements=[table.c.userIdentifier, table.c.day],
+                set_={
+                    **{column: table.c[column] + stmt.excluded[column] for column in COUNTER_COLUMNS},
+                    "updatedAt": func.now(),
+                },
+            ).returning(table.c.userIdentifier, table.c.day, table.c.promptTokens + table.c.completionTokens)
+            try:
+                async with self._engine().begin() as conn:
+                    rows = (await conn.execute(stmt)).all()
+            except Exception as e:
+                logger.warning(f"使用量の書き込みに失敗しました。次回のフラッシュで再試行します: {e}")
+                for key, values in pending.items():
+                    row = self._pending.setdefault(key, [0, 0, 0, 0.0, 0.0])
+                    for i, value in enumerate(values):
+                        row[i] += value
+                return
+            USAGE_FLUSH_ROWS.inc(len(rows))
+            for user, day, total in rows:
+                self._totals.set((user, day), total)
+
+    async def close(self) -> None:
+        """バックグラウンドタスクを止め、残りの差分を反映します"""
+        if self._task is not None:
+            async with self._flush_lock:
+                self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
@@ -0,0 +1,84 @@
+import asyncio
+import logging
+import time
+
+import metrics
+from settings import Config, get_engine
+
+logger = logging.getLogger(__name__)
+
+# このモジュールの import 時刻をプロセス起動時刻の近似値として使う
+STARTED_AT = time.monotonic()
+
+STARTUP_SECONDS = metrics.gauge(
+    "startup_seconds",
+    "Seconds from process start to each startup milestone",
+    labelnames=("phase",),
+)
+
+_timings: dict[str, float] = {}
+
+
+def record(phase: str) -> float:
+    """起動からの経過秒数を phase として一度だけ記録し、その値を返します"""
+    if phase not in _timings:
+        _timings[phase] = time.monotonic() - STARTED_AT
+        STARTUP_SECONDS.set(_timings[phase], phase=phase)
+        logger.info(f"起動から {phase} まで {_timings[phase]:.3f} 秒")
+    return _timings[phase]
+
+
+def record_first_token() -> None:
+    """最初の応答トークンを受け取った時刻を記録します（コールドスタートの計測用）"""
+    if "first_token" not in _timings:
+        record("first_token")
+
+
+def startup_timings() -> dict:
+    return dict(_timings)
+
+
+async def _prime_db_pool(engine) -> None:
+    from sqlalchemy import text
+
+    # プールサイズ分の接続を同時に開いてからプールに戻す
+    async def ping():
+        async with engine.connect() as conn:
+            await conn.execute(text("SELECT 1"))
+
+    await asyncio.gather(*(ping() for _ in range(Config.DB_POOL_SIZE)))
+
+
+async def _open_openai_connections(router) -> None:
+    # 課金の発生しないリクエストで TLS 接続を確立しておく（ステータスは問わない）
+    from transport import get_openai_http_client
+
+    http_client = get_openai_http_client()
+    await asyncio.gather(*(http_client.head(str(d.client.base_url)) for d in router.deployments))
+
+
+async def _run(name: str, coro) -> None:
+    started = time.monotonic()
+    try:
+        await asyncio.wait_for(coro, Config.WARMUP_TIMEOUT)
+        logger.info(f"ウォームアップ完了: {name} ({time.monotonic() - started:.3f} 秒)")
+    except Exception as e:
+        # ウォームアップの失敗で起動を止めない
+        logger.warning(f"ウォームアップに失敗しました: {name}: {e!r}")
+
+
+async def warm_up(router=None, storage_client=None, engine=None) -> dict:
+    """
+    DB プール・OpenAI・Blob Storage への接続を並行して確立します。
+    on_app_startup から呼ぶと、完了するまでサーバーはリクエスト（ヘルスチェック）を受け付けません。
+    """
+    record("app_loaded")
+    if Config.WARMUP_ENABLED:
+        tasks = [_run("database", _prime_db_pool(engine or get_engine()))]
+        if router is not None:
+            tasks.append(_run("openai", _open_openai_connections(router)))
+        if storage_client is not None:
+            tasks.append(_run("blob", storage_client.warm_up()))
+        await asyncio.gather(*tasks)
+    record("ready")
+    return startup_timings()
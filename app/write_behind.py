@@ -0,0 +1,215 @@
+import asyncio
+import logging
+import uuid
+
+from sqlalchemy import func
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+import metrics
+from models import Step, Thread
+from settings import Config
+
+logger = logging.getLogger(__name__)
+
+UUID_COLUMNS = {"id", "threadId", "parentId", "userId"}
+
+WRITE_BEHIND_PENDING = metrics.gauge(
+    "write_behind_pending_rows",
+    "Rows waiting in the write-behind queue",
+)
+WRITE_BEHIND_FLUSH_SECONDS = metrics.histogram(
+    "write_behind_flush_seconds",
+    "Duration of write-behind flushes",
+)
+WRITE_BEHIND_ROWS = metrics.counter(
+    "write_behind_rows_total",
+    "Rows written (or dropped after repeated failures) by the write-behind queue",
+    labelnames=("table", "result"),
+)
+WRITE_BEHIND_COALESCED = metrics.counter(
+    "write_behind_coalesced_total",
+    "Updates merged into an already pending row",
+    labelnames=("table",),
+)
+
+
+def _to_row(table, values: dict) -> dict:
+    """テーブルに存在する列だけを取り出し、UUID 列を変換します"""
+    row = {}
+    for key, value in values.items():
+        if key not in table.c or value is None:
+            continue
+        if key in UUID_COLUMNS and isinstance(value, str):
+            value = uuid.UUID(value)
+        row[key] = value
+    return row
+
+
+def _upsert(table, rows: list[dict]):
+    """
+    複数行の INSERT ... ON CONFLICT (id) DO UPDATE を作成します。
+    値が None の列は既存の値を残します。
+    """
+    columns = sorted({key for row in rows for key in row})
+    values = [{column: row.get(column) for column in columns} for row in rows]
+    stmt = insert(table).values(values)
+    return stmt.on_conflict_do_update(
+        index_elements=[table.c.id],
+        set_={
+            column: func.coalesce(stmt.excluded[column], table.c[column])
+            for column in columns
+            if column != "id"
+        },
+    )
+
+
+class WriteBehindQueue:
+    """
+    threads / steps への書き込みをメモリ上に溜め、一定間隔または一定件数ごとに
+    複数行の upsert としてまとめて反映します。
+    同じ id への更新は送信前にマージされるため、ストリーミング中の
+    update_step が何度呼ばれても 1 行の書き込みで済みます。
+    まとめた書き込みが失敗した場合は 1 行ずつ書き込み直し、失敗した行だけを再試行します。
+    WRITE_BEHIND_MAX_RETRIES 回続けて失敗した行は破棄します。
+    """
+
+    def __init__(self, engine: AsyncEngine, flush_interval_ms: float | None = None, max_batch: int | None = None):
+        self.engine = engine
+        if flush_interval_ms is None:
+            flush_interval_ms = Config.WRITE_BEHIND_FLUSH_INTERVAL_MS
+        self.flush_interval = flush_interval_ms / 1000
+        self.max_batch = max_batch or Config.WRITE_BEHIND_MAX_BATCH
+        self._threads: dict[str, dict] = {}
+        self._steps: dict[str, dict] = {}
+        self._flush_lock = asyncio.Lock()
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self._failures = 0
+
+    @property
+    def pending(self) -> int:
+        return len(self._threads) + len(self._steps)
+
+    def enqueue_thread(self, values: dict) -> None:
+        self._merge(self._threads, Thread.__table__, values)
+
+    def enqueue_step(self, values: dict) -> None:
+        self._merge(self._steps, Step.__table__, values)
+
+    def discard_step(self, step_id: str) -> None:
+        self._steps.pop(str(step_id), None)
+        WRITE_BEHIND_PENDING.set(self.pending)
+
+    def discard_thread(self, thread_id: str) -> None:
+        thread_id = str(thread_id)
+        self._threads.pop(thread_id, None)
+        for step_id in [k for k, v in self._steps.items() if str(v.get("threadId")) == thread_id]:
+            del self._steps[step_id]
+        WRITE_BEHIND_PENDING.set(self.pending)
+
+    def _merge(self, pending: dict, table, values: dict) -> None:
+        row = _to_row(table, values)
+        key = str(row["id"])
+        if key in pending:
+            pending[key].update(row)
+            WRITE_BEHIND_COALESCED.inc(table=table.name)
+        else:
+            pending[key] = row
+        WRITE_BEHIND_PENDING.set(self.pending)
+        self._ensure_started()
+        if self.pending >= self.max_batch:
+            self._wakeup.set()
+
+    def _ensure_started(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            if self.pending:
+                await self.flush()
+
+    async def flush(self) -> None:
+        """溜まっている書き込みをすべてデータベースに反映します"""
+        if not self.pending:
+            return
+        async with self._flush_lock:
+            if not self.pending:
+                return
+            threads, self._threads = self._threads, {}
+            steps, self._steps = self._steps, {}
+            WRITE_BEHIND_PENDING.set(self.pending)
+            loop = asyncio.get_running_loop()
+            started = loop.time()
+            failed_threads, failed_steps = {}, {}
+            try:
+                # steps は threads への外部キーを持つため threads を先に書き込む
+                async with self.engine.begin() as conn:
+                    for table, rows in ((Thread.__table__, threads), (Step.__table__, steps)):
+                        batch = list(rows.values())
+                        for i in range(0, len(batch), self.max_batch):
+                            await conn.execute(_upsert(table, batch[i:i + self.max_batch]))
+            except Exception as e:
+                # 1 行の不正な値（外部キーの無いステップなど）で他の行まで失わないよう、1 行ずつ書き込み直す
+                failed_threads, failed_steps, error = await self._write_rows(threads, steps, e)
+            finally:
+                WRITE_BEHIND_FLUSH_SECONDS.observe(loop.time() - started)
+            WRITE_BEHIND_ROWS.inc(len(threads) - len(failed_threads), table="threads", result="written")
+            WRITE_BEHIND_ROWS.inc(len(steps) - len(failed_steps), table="steps", result="written")
+            if failed_threads or failed_steps:
+                self._requeue(failed_threads, failed_steps, error)
+            else:
+                self._failures = 0
+
+    async def _write_rows(self, threads: dict, steps: dict, error: Exception) -> tuple[dict, dict, Exception]:
+        """
+        1 行ずつ SAVEPOINT の中で書き込み、書き込めなかった threads・steps の行と最後のエラーを返します。
+        接続できないなど、トランザクション自体が失敗した場合はすべての行を返します。
+        """
+        failed_threads, failed_steps = {}, {}
+        try:
+            async with self.engine.begin() as conn:
+                for table, rows, failed in ((Thread.__table__, threads, failed_threads), (Step.__table__, steps, failed_steps)):
+                    for key, row in rows.items():
+                        try:
+                            async with conn.begin_nested():
+                                await conn.execute(_upsert(table, [row]))
+                        except Exception as e:
+                            failed[key], error = row, e
+        except Exception as e:
+            return threads, steps, e
+        return failed_threads, failed_steps, error
+
+    def _requeue(self, threads: dict, steps: dict, error: Exception) -> None:
+        self._failures += 1
+        if self._failures > Config.WRITE_BEHIND_MAX_RETRIES:
+            logger.error(f"書き込みに失敗したため {len(threads) + len(steps)} 件を破棄します: {error}")
+            WRITE_BEHIND_ROWS.inc(len(threads), table="threads", result="dropped")
+            WRITE_BEHIND_ROWS.inc(len(steps), table="steps", result="dropped")
+            self._failures = 0
+            return
+        logger.warning(f"書き込みに失敗しました。次回のフラッシュで再試行します: {error}")
+        # 失敗中に追加された新しい値を優先してマージし直す
+        for pending, failed in ((self._threads, threads), (self._steps, steps)):
+            for key, row in failed.items():
+                pending[key] = {**row, **pending.get(key, {})}
+        WRITE_BEHIND_PENDING.set(self.pending)
+
+    async def close(self) -> None:
+        """バックグラウンドタスクを止め、残りの書き込みを反映します"""
+        if self._task is not None:
+            # フラッシュ中にキャンセルして書き込みを失わないようロックを取ってから止める
+            async with self._flush_lock:
+                self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
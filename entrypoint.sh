@@ -8,4 +8,8 @@ cd /workspace/app
 
 # アプリケーションを起動
 echo "アプリケーションを起動中..."
+if [ "${WEB_CONCURRENCY:-1}" -gt 1 ]; then
+  # 複数ワーカーで起動（会話履歴と socket.io の配信は Postgres で共有する）
+  exec python serve.py --host 0.0.0.0 --port 8000 --workers "$WEB_CONCURRENCY"
+fi
 exec chainlit run app.py --host 0.0.0.0 --port 8000